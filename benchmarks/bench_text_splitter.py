@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+文本分割器微基准 - 验证分割耗时随文本长度线性增长
+
+用法: python benchmarks/bench_text_splitter.py [最大MB数]
+"""
+
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from document_analyzer import TextSplitter, TokenBudgetSplitter
+
+ENGLISH_SENTENCES = [
+    "Prompt engineering is the practice of designing inputs for language models.",
+    "Good prompts state the task, the context and the expected output format!",
+    "Why does a small change in wording change the answer so much?",
+    "Examples inside the prompt often work better than long instructions.",
+]
+CHINESE_SENTENCES = [
+    "提示词写作是为大语言模型设计输入的实践。",
+    "好的提示词会说明任务、背景和期望的输出格式！",
+    "为什么措辞上的细微变化会让回答差这么多？",
+    "在提示词中给出示例往往比冗长的说明更有效；",
+]
+
+def make_text(size: int, sentences, paragraph_sentences: int) -> str:
+    """生成约size个字符的文本；paragraph_sentences为0时整篇没有段落分隔"""
+    rng = random.Random(42)
+    parts = []
+    length = 0
+    count = 0
+    while length < size:
+        sentence = rng.choice(sentences)
+        count += 1
+        if paragraph_sentences and count % paragraph_sentences == 0:
+            sentence += "\n\n"
+        elif sentences is ENGLISH_SENTENCES:
+            sentence += " "
+        parts.append(sentence)
+        length += len(sentence)
+    return "".join(parts)
+
+def split_chars(text: str) -> int:
+    return len(TextSplitter.split_spans(text, 3000))
+
+def split_tokens(text: str) -> int:
+    return len(TokenBudgetSplitter(2800).split_text(text))
+
+def split_stream(text: str, page_size: int = 4000) -> int:
+    splitter = TokenBudgetSplitter(2800)
+    chunks = 0
+    for start in range(0, len(text), page_size):
+        chunks += len(splitter.feed(text[start:start + page_size]))
+    return chunks + len(splitter.flush())
+
+def main():
+    max_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    sizes = []
+    mb = 1
+    while mb <= max_mb:
+        sizes.append(mb)
+        mb *= 2
+    
+    corpora = [
+        ("英文/有段落", ENGLISH_SENTENCES, 8),
+        ("中文/有段落", CHINESE_SENTENCES, 8),
+        ("中文/无段落", CHINESE_SENTENCES, 0),
+    ]
+    modes = [("按字符", split_chars), ("按token", split_tokens), ("流式4KB", split_stream)]
+    
+    print(f"{'文本':<10}{'方式':<8}{'MB':>4}{'块数':>8}{'耗时(s)':>10}{'每MB(ms)':>10}")
+    for name, sentences, paragraph_sentences in corpora:
+        for mode, func in modes:
+            per_mb = []
+            for mb in sizes:
+                text = make_text(mb * 1024 * 1024, sentences, paragraph_sentences)
+                start = time.perf_counter()
+                chunks = func(text)
+                elapsed = time.perf_counter() - start
+                per_mb.append(elapsed * 1000 / mb)
+                print(f"{name:<10}{mode:<8}{mb:>4}{chunks:>8}{elapsed:>10.3f}{per_mb[-1]:>10.1f}")
+            # 线性时每MB耗时基本不变
+            print(f"{'':<10}{mode:<8}最大/最小每MB耗时比: {max(per_mb) / min(per_mb):.2f}")
+
+if __name__ == "__main__":
+    main()
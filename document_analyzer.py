@@ -1,13 +1,31 @@
 import gradio as gr
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
 import os
 import tempfile
 from pathlib import Path
 import time
-from typing import Generator, Tuple, List
+from typing import AsyncGenerator, Generator, Tuple, List
 import re
 import subprocess
+import socket
+import shutil
+import secrets
+import atexit
+import threading
+import multiprocessing
+import multiprocessing.connection
+import asyncio
+import weakref
+import contextvars
+from contextlib import contextmanager, asynccontextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import hashlib
+from collections import OrderedDict, deque, Counter
+from graphrag_process import GraphRAGQueryProcess, kill_process_tree, process_group_kwargs
 
 # 文档处理库
 try:
@@ -26,32 +44,355 @@ try:
 except ImportError:
     print("请安装pdfplumber: pip install pdfplumber")
 
+# 异步HTTP客户端
+try:
+    import httpx
+except ImportError:
+    print("请安装httpx: pip install httpx")
+
+# 可选：GraphRAG内置本地检索读取parquet索引需要pandas（及pyarrow）和NumPy
+try:
+    import numpy as np
+    import pandas as pd
+except ImportError:
+    np = None
+    pd = None
+
+# 可选：更快的JSON解析，未安装时使用标准库json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# 并发配置：同时发往Ollama的最大请求数
+OLLAMA_MAX_CONCURRENCY = int(os.environ.get("OLLAMA_MAX_CONCURRENCY", "4"))
+
+# Ollama连接配置
+OLLAMA_BASE_URL = os.environ.get("OLLAMA_BASE_URL", "http://localhost:11434")
+OLLAMA_POOL_SIZE = int(os.environ.get("OLLAMA_POOL_SIZE", "32"))
+OLLAMA_MAX_RETRIES = int(os.environ.get("OLLAMA_MAX_RETRIES", "3"))
+OLLAMA_BACKOFF_FACTOR = float(os.environ.get("OLLAMA_BACKOFF_FACTOR", "0.5"))
+OLLAMA_CONNECT_TIMEOUT = float(os.environ.get("OLLAMA_CONNECT_TIMEOUT", "5"))
+OLLAMA_READ_TIMEOUT = float(os.environ.get("OLLAMA_READ_TIMEOUT", "300"))
+
+# 多节点配置：逗号分隔的Ollama地址（默认只有OLLAMA_BASE_URL），故障节点的健康检查间隔（秒）
+OLLAMA_BACKENDS = [url.strip() for url in os.environ.get("OLLAMA_BACKENDS", OLLAMA_BASE_URL).split(",") if url.strip()]
+OLLAMA_HEALTH_CHECK_INTERVAL = float(os.environ.get("OLLAMA_HEALTH_CHECK_INTERVAL", "10"))
+
+# 调度配置：文档分析等后台请求共用的并发数（默认每个节点OLLAMA_MAX_CONCURRENCY个），
+# 以及额外保留给对话等交互请求的并发数
+OLLAMA_SCHEDULER_SLOTS = int(os.environ.get("OLLAMA_SCHEDULER_SLOTS", str(OLLAMA_MAX_CONCURRENCY * len(OLLAMA_BACKENDS))))
+OLLAMA_INTERACTIVE_SLOTS = int(os.environ.get("OLLAMA_INTERACTIVE_SLOTS", "1"))
+
+# 界面事件的并发数与排队长度：可在JSON文件（EVENT_LIMITS_FILE）中按事件名覆盖，
+# 环境变量 <事件名大写>_CONCURRENCY / <事件名大写>_MAX_QUEUE 优先级最高
+EVENT_LIMITS_FILE = os.environ.get("EVENT_LIMITS_FILE", "event_limits.json")
+DEFAULT_EVENT_LIMITS = {
+    "process_all_tasks": {"concurrency_limit": 2, "max_queue": 4},
+    "graphrag_query": {"concurrency_limit": 2, "max_queue": 8},
+    "chat_with_ollama": {"concurrency_limit": 8, "max_queue": 32},
+}
+# 其他事件使用Gradio自身的队列：每个事件的默认并发数和整个队列的最大长度（空表示不限）
+GRADIO_DEFAULT_CONCURRENCY = int(os.environ.get("GRADIO_DEFAULT_CONCURRENCY", "1"))
+GRADIO_QUEUE_MAX_SIZE = int(os.environ["GRADIO_QUEUE_MAX_SIZE"]) if os.environ.get("GRADIO_QUEUE_MAX_SIZE") else None
+
+# 上下文窗口配置：num_ctx、为模型输出预留的token数、相邻文本块的重叠token数
+OLLAMA_NUM_CTX = int(os.environ.get("OLLAMA_NUM_CTX", "4096"))
+OLLAMA_RESPONSE_RESERVE = int(os.environ.get("OLLAMA_RESPONSE_RESERVE", "1024"))
+CHUNK_OVERLAP_TOKENS = int(os.environ.get("CHUNK_OVERLAP_TOKENS", "0"))
+
+# 汇总模式：每轮合并时一组最多包含的部分结果数
+REDUCE_FAN_IN = int(os.environ.get("REDUCE_FAN_IN", "4"))
+
+# token估算参数：每个中日韩字符的token数、其他文字平均每token的字符数
+TOKENS_PER_CJK_CHAR = float(os.environ.get("TOKENS_PER_CJK_CHAR", "1.0"))
+CHARS_PER_TOKEN = float(os.environ.get("CHARS_PER_TOKEN", "3.5"))
+
+# 缓存配置
+APP_CACHE_DIR = os.environ.get("APP_CACHE_DIR", "./cache")
+ANALYSIS_CACHE_MAX_MB = int(os.environ.get("ANALYSIS_CACHE_MAX_MB", "512"))
+EXTRACTION_CACHE_MAX_MB = int(os.environ.get("EXTRACTION_CACHE_MAX_MB", "1024"))
+GRAPHRAG_CACHE_MAX_MB = int(os.environ.get("GRAPHRAG_CACHE_MAX_MB", "64"))
+
+# PDF并行提取配置：进程数，以及启用并行的最少页数
+PDF_EXTRACT_WORKERS = int(os.environ.get("PDF_EXTRACT_WORKERS", str(min(4, os.cpu_count() or 1))))
+PDF_PARALLEL_MIN_PAGES = int(os.environ.get("PDF_PARALLEL_MIN_PAGES", "40"))
+
+# Ollama客户端以文本形式返回的错误前缀，这类结果不写入缓存
+OLLAMA_ERROR_PREFIXES = ("错误: HTTP", "连接错误:")
+
+# 流式输出刷新界面的节奏：距上次刷新超过该秒数，或新增内容超过该字节数时才推送
+UI_STREAM_INTERVAL = float(os.environ.get("UI_STREAM_INTERVAL", "0.1"))
+UI_STREAM_MAX_BYTES = int(os.environ.get("UI_STREAM_MAX_BYTES", "512"))
+
+# 分析进度回调每秒最多触发的次数
+PROGRESS_MAX_RATE = float(os.environ.get("PROGRESS_MAX_RATE", "4"))
+
+# GraphRAG配置：conda环境和项目目录；查询默认交给常驻进程（graphrag_worker.py），
+# 设置GRAPHRAG_USE_WORKER=0则每次查询调用命令行。超时单位为秒
+GRAPHRAG_CONDA_ENV = os.environ.get("GRAPHRAG_CONDA_ENV", "graphrag-0.50")
+GRAPHRAG_ROOT = os.environ.get("GRAPHRAG_ROOT", "./ragtest")
+GRAPHRAG_USE_WORKER = os.environ.get("GRAPHRAG_USE_WORKER", "1") != "0"
+GRAPHRAG_WORKER_PORT = int(os.environ.get("GRAPHRAG_WORKER_PORT", "8765"))
+GRAPHRAG_WORKER_START_TIMEOUT = float(os.environ.get("GRAPHRAG_WORKER_START_TIMEOUT", "300"))
+GRAPHRAG_QUERY_TIMEOUT = float(os.environ.get("GRAPHRAG_QUERY_TIMEOUT", "600"))
+# 启动时在后台预先查询所有预设问题并写入缓存
+GRAPHRAG_PREWARM = os.environ.get("GRAPHRAG_PREWARM", "1") != "0"
+# auto查询方法的路由记录（JSON Lines），用于根据实际耗时调整路由规则
+GRAPHRAG_ROUTING_LOG = os.environ.get("GRAPHRAG_ROUTING_LOG", os.path.join(APP_CACHE_DIR, "graphrag_routing.jsonl"))
+
+# 结果翻译：按章节/段落分段，每段最多的字符数，以及同时翻译的段数
+TRANSLATION_SEGMENT_CHARS = int(os.environ.get("TRANSLATION_SEGMENT_CHARS", "1500"))
+TRANSLATION_WORKERS = int(os.environ.get("TRANSLATION_WORKERS", "4"))
+# 翻译记忆：按段落缓存译文；近似匹配忽略大小写、空白、Markdown标记和数字差异
+TRANSLATION_MEMORY_MAX_MB = int(os.environ.get("TRANSLATION_MEMORY_MAX_MB", "64"))
+TRANSLATION_MEMORY_NEAR_MATCH = os.environ.get("TRANSLATION_MEMORY_NEAR_MATCH", "1") != "0"
+
+class DiskCache:
+    """基于磁盘的LRU缓存，按总大小淘汰，线程安全"""
+    
+    def __init__(self, cache_dir: str, max_bytes: int):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> 字节数，按最近使用排序
+        self._total_bytes = 0
+        self._load_index()
+    
+    @staticmethod
+    def make_key(*parts) -> str:
+        """根据可JSON序列化的内容生成内容寻址的缓存键"""
+        raw = json.dumps(parts, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+    
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / f"{key}.json"
+    
+    def _load_index(self):
+        """从磁盘恢复索引，按文件修改时间还原LRU顺序"""
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            files = sorted(self.cache_dir.glob("*.json"), key=lambda f: f.stat().st_mtime)
+        except OSError as e:
+            print(f"缓存目录不可用: {e}")
+            return
+        
+        for file in files:
+            size = file.stat().st_size
+            self._entries[file.stem] = size
+            self._total_bytes += size
+        self._evict()
+    
+    def get(self, key: str):
+        """读取缓存，未命中时返回None"""
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            
+            path = self._path(key)
+            try:
+                with open(path, 'r', encoding='utf-8') as file:
+                    value = json.load(file)
+                # 更新修改时间，重启后仍能保持LRU顺序
+                os.utime(path)
+            except (OSError, ValueError):
+                self._total_bytes -= self._entries.pop(key)
+                self.misses += 1
+                return None
+            
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+    
+    def set(self, key: str, value):
+        """写入缓存，超出容量时淘汰最久未使用的条目"""
+        data = json.dumps(value, ensure_ascii=False).encode('utf-8')
+        if len(data) > self.max_bytes:
+            return
+        
+        with self._lock:
+            path = self._path(key)
+            temp_path = path.with_suffix(".tmp")
+            try:
+                with open(temp_path, 'wb') as file:
+                    file.write(data)
+                os.replace(temp_path, path)
+            except OSError as e:
+                print(f"缓存写入失败: {e}")
+                return
+            
+            if key in self._entries:
+                self._total_bytes -= self._entries.pop(key)
+            self._entries[key] = len(data)
+            self._total_bytes += len(data)
+            self._evict()
+    
+    def _evict(self):
+        while self._total_bytes > self.max_bytes and self._entries:
+            key, size = self._entries.popitem(last=False)
+            self._total_bytes -= size
+            try:
+                self._path(key).unlink()
+            except OSError:
+                pass
+    
+    def stats(self) -> dict:
+        """返回命中统计和占用情况"""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "bytes": self._total_bytes
+            }
+
+_analysis_cache = None
+_analysis_cache_lock = threading.Lock()
+
+def get_analysis_cache() -> DiskCache:
+    """获取全局共享的分析结果缓存"""
+    global _analysis_cache
+    if _analysis_cache is None:
+        with _analysis_cache_lock:
+            if _analysis_cache is None:
+                _analysis_cache = DiskCache(
+                    os.path.join(APP_CACHE_DIR, "analysis"),
+                    ANALYSIS_CACHE_MAX_MB * 1024 * 1024
+                )
+    return _analysis_cache
+
+_extraction_cache = None
+_extraction_cache_lock = threading.Lock()
+
+def get_extraction_cache() -> DiskCache:
+    """获取全局共享的文本提取缓存"""
+    global _extraction_cache
+    if _extraction_cache is None:
+        with _extraction_cache_lock:
+            if _extraction_cache is None:
+                _extraction_cache = DiskCache(
+                    os.path.join(APP_CACHE_DIR, "extraction"),
+                    EXTRACTION_CACHE_MAX_MB * 1024 * 1024
+                )
+    return _extraction_cache
+
+_graphrag_cache = None
+_graphrag_cache_lock = threading.Lock()
+
+def get_graphrag_cache() -> DiskCache:
+    """获取全局共享的GraphRAG查询结果缓存"""
+    global _graphrag_cache
+    if _graphrag_cache is None:
+        with _graphrag_cache_lock:
+            if _graphrag_cache is None:
+                _graphrag_cache = DiskCache(
+                    os.path.join(APP_CACHE_DIR, "graphrag"),
+                    GRAPHRAG_CACHE_MAX_MB * 1024 * 1024
+                )
+    return _graphrag_cache
+
+def graphrag_index_version(root: str = GRAPHRAG_ROOT) -> str:
+    """按output目录下各parquet文件的名称、大小和修改时间计算索引版本，没有索引时返回空字符串
+
+    重新建索引后版本随之改变，旧版本的缓存结果不再命中，之后按LRU淘汰。
+    """
+    output_dir = Path(root) / "output"
+    digest = hashlib.sha256()
+    found = False
+    try:
+        for path in sorted(output_dir.rglob("*.parquet")):
+            stat = path.stat()
+            digest.update(f"{path.relative_to(output_dir).as_posix()}:{stat.st_size}:{stat.st_mtime_ns}\n".encode("utf-8"))
+            found = True
+    except OSError:
+        return ""
+    return digest.hexdigest()[:16] if found else ""
+
 class DocumentProcessor:
     """文档处理类"""
     
+    def __init__(self, cache: DiskCache = None, pdf_workers: int = PDF_EXTRACT_WORKERS):
+        self.cache = cache
+        self.pdf_workers = pdf_workers
+    
     @staticmethod
-    def extract_text_from_pdf(file_path: str) -> str:
-        """从PDF文件提取文本"""
-        text = ""
+    def count_pdf_pages(file_path: str) -> int:
+        """获取PDF页数"""
         try:
             with pdfplumber.open(file_path) as pdf:
-                for page_num, page in enumerate(pdf.pages):
-                    page_text = page.extract_text()
-                    if page_text:
-                        text += f"\n--- 第 {page_num + 1} 页 ---\n"
-                        text += page_text
+                return len(pdf.pages)
+        except Exception:
+            with open(file_path, 'rb') as file:
+                return len(PyPDF2.PdfReader(file).pages)
+    
+    @staticmethod
+    def iter_pdf_page_records(file_path: str, workers: int = PDF_EXTRACT_WORKERS) -> Generator[Tuple[int, str, str, float], None, None]:
+        """按页码顺序逐页产出PDF提取记录(页码, 文本, 提取器, 耗时)
+
+        页数较多时按页码区间分给进程池并行提取，每个区间完成后按顺序产出。
+        """
+        try:
+            page_count = DocumentProcessor.count_pdf_pages(file_path)
         except Exception as e:
             print(f"PDF读取错误: {e}")
-            # 备用方法
-            try:
-                with open(file_path, 'rb') as file:
-                    pdf_reader = PyPDF2.PdfReader(file)
-                    for page_num, page in enumerate(pdf_reader.pages):
-                        text += f"\n--- 第 {page_num + 1} 页 ---\n"
-                        text += page.extract_text()
-            except Exception as e2:
-                print(f"备用PDF读取也失败: {e2}")
-        return text
+            return
+        
+        if workers <= 1 or page_count < PDF_PARALLEL_MIN_PAGES:
+            yield from _iter_pdf_page_range(file_path, 0, page_count)
+            return
+        
+        # 区间数多于进程数，让快慢不一的页面在进程间更均衡
+        step = max(1, -(-page_count // (workers * 4)))
+        ranges = [(start, min(start + step, page_count)) for start in range(0, page_count, step)]
+        executor = get_pdf_extract_pool(workers)
+        futures = [executor.submit(_extract_pdf_page_range, file_path, start, end) for start, end in ranges]
+        try:
+            for future in futures:
+                yield from future.result()
+        except BrokenProcessPool:
+            # 工作进程异常退出（如内存不足被结束）时丢弃该进程池，下一份文档重新创建
+            discard_pdf_extract_pool(executor)
+            raise
+        finally:
+            # 调用方提前停止时不再等待剩余区间
+            for future in futures:
+                future.cancel()
+    
+    @staticmethod
+    def extract_pages_from_pdf(file_path: str, workers: int = PDF_EXTRACT_WORKERS) -> Tuple[List[Tuple[int, str]], str, List[Tuple[int, float]]]:
+        """从PDF文件逐页提取文本
+
+        返回(页码, 文本)列表、所用的提取器以及每页耗时(页码, 秒)。
+        """
+        records = list(DocumentProcessor.iter_pdf_page_records(file_path, workers))
+        pages = [(page_num, page_text) for page_num, page_text, _, _ in records if page_text]
+        extractors = dict.fromkeys(extractor for _, page_text, extractor, _ in records if page_text)
+        timings = [(page_num, elapsed) for page_num, _, _, elapsed in records]
+        return pages, "+".join(extractors), timings
+    
+    @staticmethod
+    def join_pages(pages: List[Tuple[int, str]]) -> Tuple[str, List[List[int]]]:
+        """拼接分页文本，返回全文和每页[页码, 起始偏移, 结束偏移]"""
+        parts = []
+        boundaries = []
+        offset = 0
+        for page_num, page_text in pages:
+            header = f"\n--- 第 {page_num} 页 ---\n"
+            parts.append(header)
+            parts.append(page_text)
+            offset += len(header)
+            boundaries.append([page_num, offset, offset + len(page_text)])
+            offset += len(page_text)
+        return "".join(parts), boundaries
+    
+    @staticmethod
+    def extract_text_from_pdf(file_path: str) -> str:
+        """从PDF文件提取文本"""
+        pages, _, _ = DocumentProcessor.extract_pages_from_pdf(file_path)
+        return DocumentProcessor.join_pages(pages)[0]
     
     @staticmethod
     def extract_text_from_docx(file_path: str) -> str:
@@ -82,106 +423,1244 @@ class DocumentProcessor:
         except Exception as e:
             print(f"TXT读取错误: {e}")
             return ""
+    
+    @staticmethod
+    def file_hash(file_path: str) -> str:
+        """计算文件内容的SHA-256"""
+        digest = hashlib.sha256()
+        with open(file_path, 'rb') as file:
+            for block in iter(lambda: file.read(1024 * 1024), b""):
+                digest.update(block)
+        return digest.hexdigest()
+    
+    @staticmethod
+    def is_supported(file_path: str) -> bool:
+        """是否为支持的文件格式"""
+        return Path(file_path).suffix.lower() in ('.pdf', '.docx', '.txt')
+    
+    def iter_document_text(self, file_path: str) -> Generator[str, None, dict]:
+        """逐页产出文本片段，拼接结果与extract_document()["text"]一致
+
+        PDF每提取完一页就产出该页，后续处理无需等待整份文档解析完成。
+        生成器结束时返回完整的提取结果（文本、分页边界、提取器），并写入缓存；
+        不支持的格式直接返回None。
+        """
+        if not self.is_supported(file_path):
+            return None
+        file_extension = Path(file_path).suffix.lower()
+        
+        cache_key = None
+        if self.cache is not None:
+            cache_key = self.cache.make_key("extraction", self.file_hash(file_path), file_extension)
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                if cached["text"]:
+                    yield cached["text"]
+                return cached
+        
+        timings = []
+        if file_extension == '.pdf':
+            start_time = time.time()
+            parts = []
+            boundaries = []
+            extractors = {}
+            offset = 0
+            for page_num, page_text, extractor, elapsed in self.iter_pdf_page_records(file_path, self.pdf_workers):
+                timings.append((page_num, elapsed))
+                if not page_text:
+                    continue
+                header = f"\n--- 第 {page_num} 页 ---\n"
+                parts.append(header)
+                parts.append(page_text)
+                offset += len(header)
+                boundaries.append([page_num, offset, offset + len(page_text)])
+                offset += len(page_text)
+                extractors[extractor] = True
+                yield header + page_text
+            text, extractor = "".join(parts), "+".join(extractors)
+            if timings:
+                slowest = max(timings, key=lambda timing: timing[1])
+                print(f"PDF提取完成: {len(timings)} 页，{self.pdf_workers} 进程，"
+                      f"用时 {time.time() - start_time:.2f}s，最慢第 {slowest[0]} 页 {slowest[1]:.2f}s")
+        else:
+            if file_extension == '.docx':
+                text, extractor = self.extract_text_from_docx(file_path), "python-docx"
+            else:
+                text, extractor = self.extract_text_from_txt(file_path), "text"
+            boundaries = [[1, 0, len(text)]]
+            if text:
+                yield text
+        
+        document = {"text": text, "pages": boundaries, "extractor": extractor, "page_timings": timings}
+        # 提取失败（空文本）不缓存，下次重新尝试
+        if cache_key is not None and text:
+            self.cache.set(cache_key, document)
+        return document
+    
+    def extract_document(self, file_path: str) -> dict:
+        """提取文本、分页边界和提取器信息，按文件内容哈希缓存；不支持的格式返回None"""
+        pieces = self.iter_document_text(file_path)
+        while True:
+            try:
+                next(pieces)
+            except StopIteration as stop:
+                return stop.value
+
+def _extract_pdf_page_range(file_path: str, start: int, end: int) -> List[Tuple[int, str, str, float]]:
+    """提取PDF中[start, end)区间的页面（在进程池中运行，因此定义在模块级别）"""
+    return list(_iter_pdf_page_range(file_path, start, end))
+
+_pdf_extract_pools = {}
+_pdf_extract_pools_lock = threading.Lock()
+
+def get_pdf_extract_pool(workers: int = PDF_EXTRACT_WORKERS) -> ProcessPoolExecutor:
+    """获取长期复用的PDF提取进程池
+
+    界面是多线程服务，fork出的子进程会复制其他线程持有的锁而死锁，因此用spawn启动；
+    spawn启动需要重新导入本模块，进程池在各文档间共用，只在第一次使用时付出启动开销。
+    """
+    with _pdf_extract_pools_lock:
+        executor = _pdf_extract_pools.get(workers)
+        if executor is None:
+            executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+            _pdf_extract_pools[workers] = executor
+        return executor
+
+def discard_pdf_extract_pool(executor: ProcessPoolExecutor):
+    """丢弃已损坏的进程池"""
+    with _pdf_extract_pools_lock:
+        for workers, pool in list(_pdf_extract_pools.items()):
+            if pool is executor:
+                del _pdf_extract_pools[workers]
+    executor.shutdown(wait=False, cancel_futures=True)
+
+def _iter_pdf_page_range(file_path: str, start: int, end: int) -> Generator[Tuple[int, str, str, float], None, None]:
+    """逐页产出PDF中[start, end)区间的(页码, 文本, 提取器, 耗时)
+
+    单页用pdfplumber失败时只对该页改用PyPDF2。
+    """
+    pdf = None
+    fallback_reader = None
+    fallback_file = None
+    
+    def extract_with_pypdf2(page_index):
+        nonlocal fallback_reader, fallback_file
+        try:
+            if fallback_reader is None:
+                fallback_file = open(file_path, 'rb')
+                fallback_reader = PyPDF2.PdfReader(fallback_file)
+            return fallback_reader.pages[page_index].extract_text() or ""
+        except Exception as e:
+            print(f"备用PDF读取也失败(第 {page_index + 1} 页): {e}")
+            return ""
+    
+    try:
+        try:
+            pdf = pdfplumber.open(file_path)
+        except Exception as e:
+            print(f"PDF读取错误: {e}")
+        
+        for page_index in range(start, end):
+            page_start = time.time()
+            page_text, extractor = "", "PyPDF2"
+            if pdf is not None:
+                try:
+                    page = pdf.pages[page_index]
+                    page_text, extractor = page.extract_text() or "", "pdfplumber"
+                    # 释放该页的解析缓存，避免大文档内存持续增长
+                    page.close()
+                except Exception as e:
+                    print(f"PDF读取错误(第 {page_index + 1} 页): {e}")
+                    page_text = extract_with_pypdf2(page_index)
+            else:
+                page_text = extract_with_pypdf2(page_index)
+            yield page_index + 1, page_text, extractor, time.time() - page_start
+    finally:
+        if pdf is not None:
+            pdf.close()
+        if fallback_file is not None:
+            fallback_file.close()
+
+class OllamaSession:
+    """共享的Ollama HTTP连接池（keep-alive、重试与超时）"""
+    
+    def __init__(self, pool_size: int = OLLAMA_POOL_SIZE, max_retries: int = OLLAMA_MAX_RETRIES,
+                 backoff_factor: float = OLLAMA_BACKOFF_FACTOR, connect_timeout: float = OLLAMA_CONNECT_TIMEOUT,
+                 read_timeout: float = OLLAMA_READ_TIMEOUT):
+        self.timeout = (connect_timeout, read_timeout)
+        
+        # 只重试连接失败和服务繁忙，已开始生成的请求不重发
+        retry = Retry(
+            total=max_retries,
+            connect=max_retries,
+            read=0,
+            status=max_retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset(["GET", "POST"]),
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+    
+    def post(self, url: str, **kwargs) -> requests.Response:
+        """发送POST请求，未指定超时时使用默认超时"""
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.post(url, **kwargs)
+    
+    def get(self, url: str, **kwargs) -> requests.Response:
+        """发送GET请求，未指定超时时使用默认超时"""
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.get(url, **kwargs)
+
+_ollama_session = None
+_ollama_session_lock = threading.Lock()
+
+def get_ollama_session() -> OllamaSession:
+    """获取全局共享的Ollama连接池"""
+    global _ollama_session
+    if _ollama_session is None:
+        with _ollama_session_lock:
+            if _ollama_session is None:
+                _ollama_session = OllamaSession()
+    return _ollama_session
+
+class OllamaBackend:
+    """单个Ollama节点的负载与健康状态"""
+    
+    def __init__(self, url: str):
+        self.url = url.rstrip("/")
+        self.in_flight = 0       # 在途请求数
+        self.latency = None      # 收到响应头的耗时（秒），指数滑动平均
+        self.healthy = True
+        self.requests = 0
+        self.failures = 0
+        self.last_error = ""
+
+class OllamaRouter:
+    """多个Ollama节点之间的负载均衡
+
+    每个请求发往在途请求最少的健康节点（相同时选延迟低的）；连接失败或返回502/503/504的节点
+    移出轮换，由后台线程定期检查 /api/tags，恢复后重新加入。所有节点都故障时仍会尝试。
+    其他500错误（模型加载失败、显存不足、提示词有问题等）多与单个请求有关，只算该请求失败，
+    不影响其他模型和用户使用该节点；已开始输出后的读取超时同样不算节点故障。
+    """
+    
+    LATENCY_SMOOTHING = 0.3
+    # 表示节点本身不可用的状态码
+    NODE_FAILURE_STATUS = frozenset({502, 503, 504})
+    
+    def __init__(self, urls: List[str], health_check_interval: float = OLLAMA_HEALTH_CHECK_INTERVAL,
+                 session: OllamaSession = None):
+        self.backends = [OllamaBackend(url) for url in dict.fromkeys(urls)]
+        if not self.backends:
+            raise ValueError("至少需要一个Ollama节点")
+        self.health_check_interval = health_check_interval
+        self.session = session or get_ollama_session()
+        self._lock = threading.Lock()
+        self._health_thread = None
+    
+    def acquire(self, exclude: List[OllamaBackend] = ()) -> OllamaBackend:
+        """选出负载最低的节点并登记一个在途请求；exclude为本次请求已经失败过的节点"""
+        with self._lock:
+            candidates = [backend for backend in self.backends if backend not in exclude]
+            candidates = [backend for backend in candidates if backend.healthy] or candidates or self.backends
+            # 还没有延迟数据的节点按0计，优先试用
+            backend = min(candidates, key=lambda item: (item.in_flight, item.latency or 0.0))
+            backend.in_flight += 1
+            backend.requests += 1
+            return backend
+    
+    def release(self, backend: OllamaBackend, latency: float = None):
+        """请求结束；latency为收到响应头的耗时，失败时为None"""
+        with self._lock:
+            backend.in_flight -= 1
+            if latency is not None:
+                if backend.latency is None:
+                    backend.latency = latency
+                else:
+                    backend.latency += self.LATENCY_SMOOTHING * (latency - backend.latency)
+    
+    def mark_failed(self, backend: OllamaBackend, error):
+        """把节点移出轮换，并启动后台健康检查"""
+        with self._lock:
+            backend.healthy = False
+            backend.failures += 1
+            backend.last_error = str(error)
+            if self._health_thread is None:
+                self._health_thread = threading.Thread(target=self._health_loop, daemon=True)
+                self._health_thread.start()
+    
+    def check_health(self, backend: OllamaBackend) -> bool:
+        """节点能正常返回模型列表即视为健康"""
+        try:
+            response = self.session.get(f"{backend.url}/api/tags", timeout=(OLLAMA_CONNECT_TIMEOUT, OLLAMA_CONNECT_TIMEOUT))
+            return response.status_code == 200
+        except requests.exceptions.RequestException:
+            return False
+    
+    def _health_loop(self):
+        while True:
+            time.sleep(self.health_check_interval)
+            for backend in [backend for backend in self.backends if not backend.healthy]:
+                if self.check_health(backend):
+                    with self._lock:
+                        backend.healthy = True
+                    print(f"Ollama节点已恢复: {backend.url}")
+            with self._lock:
+                if all(backend.healthy for backend in self.backends):
+                    self._health_thread = None
+                    return
+    
+    def post(self, path: str, **kwargs) -> requests.Response:
+        """非流式请求：发往负载最低的节点，连接失败或502/503/504时换下一个节点"""
+        tried = []
+        while True:
+            backend = self.acquire(tried)
+            tried.append(backend)
+            start = time.monotonic()
+            latency = None
+            try:
+                response = self.session.post(f"{backend.url}{path}", **kwargs)
+                if response.status_code in self.NODE_FAILURE_STATUS:
+                    self.mark_failed(backend, f"HTTP {response.status_code}")
+                    if len(tried) < len(self.backends):
+                        continue
+                else:
+                    latency = time.monotonic() - start
+                return response
+            except requests.exceptions.ConnectionError as e:
+                self.mark_failed(backend, e)
+                if len(tried) >= len(self.backends):
+                    raise
+            finally:
+                self.release(backend, latency)
+    
+    def stats(self) -> List[dict]:
+        """各节点的状态"""
+        with self._lock:
+            return [{
+                "url": backend.url,
+                "healthy": backend.healthy,
+                "in_flight": backend.in_flight,
+                "latency_ms": backend.latency * 1000 if backend.latency is not None else None,
+                "requests": backend.requests,
+                "failures": backend.failures,
+                "last_error": backend.last_error,
+            } for backend in self.backends]
+
+_ollama_router = None
+_ollama_router_lock = threading.Lock()
+
+def get_ollama_router() -> OllamaRouter:
+    """获取全局共享的Ollama节点路由（节点由OLLAMA_BACKENDS配置）"""
+    global _ollama_router
+    if _ollama_router is None:
+        with _ollama_router_lock:
+            if _ollama_router is None:
+                _ollama_router = OllamaRouter(OLLAMA_BACKENDS)
+    return _ollama_router
+
+# 请求优先级：数值越小越优先
+PRIORITY_INTERACTIVE = 0   # 对话、提示词优化、翻译
+PRIORITY_SINGLE_TASK = 1   # 单个分析任务
+PRIORITY_BULK = 2          # 综合分析等批量任务
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: "交互", PRIORITY_SINGLE_TASK: "单任务", PRIORITY_BULK: "批量"}
+
+# 当前请求的(优先级, 用户)，由界面处理函数设置，asyncio任务和to_thread会自动继承
+_ollama_request_context = contextvars.ContextVar("ollama_request_context", default=(PRIORITY_SINGLE_TASK, None))
+
+@contextmanager
+def ollama_request_context(priority: int, user: str = None):
+    """在此范围内发出的Ollama请求使用指定的优先级和用户（只用于普通函数和协程，不要跨yield使用）"""
+    token = _ollama_request_context.set((priority, user))
+    try:
+        yield
+    finally:
+        _ollama_request_context.reset(token)
+
+def request_user(request) -> str:
+    """从gr.Request中取出会话标识，用于按用户公平调度"""
+    return getattr(request, "session_hash", None) if request is not None else None
+
+class _SchedulerWaiter:
+    """排队中的一个请求"""
+    
+    __slots__ = ("priority", "user", "grant", "enqueued", "granted")
+    
+    def __init__(self, priority: int, user, grant):
+        self.priority = priority
+        self.user = user
+        self.grant = grant
+        self.enqueued = time.monotonic()
+        self.granted = False
+
+class OllamaScheduler:
+    """所有Ollama请求的统一调度
+
+    按优先级（交互 > 单任务 > 批量）分配并发名额，同一优先级内按用户轮流，避免一个大文档
+    占满队列。slots个名额所有请求共用，另有interactive_slots个只给交互请求，
+    因此即使批量任务占满了后台名额，对话也不必排队。支持线程和asyncio两种等待方式。
+    """
+    
+    def __init__(self, slots: int = OLLAMA_SCHEDULER_SLOTS, interactive_slots: int = OLLAMA_INTERACTIVE_SLOTS):
+        self.slots = max(1, slots)
+        self.interactive_slots = max(0, interactive_slots)
+        self._lock = threading.Lock()
+        # 每个优先级：用户 -> 该用户的等待队列，OrderedDict的顺序即轮转顺序
+        self._queues = {priority: OrderedDict() for priority in PRIORITY_NAMES}
+        self._running = {priority: 0 for priority in PRIORITY_NAMES}
+        self._granted = {priority: 0 for priority in PRIORITY_NAMES}
+        self._total_wait = {priority: 0.0 for priority in PRIORITY_NAMES}
+        self._max_wait = {priority: 0.0 for priority in PRIORITY_NAMES}
+    
+    def _limit(self, priority: int) -> int:
+        return self.slots + self.interactive_slots if priority == PRIORITY_INTERACTIVE else self.slots
+    
+    def _enqueue(self, priority: int, user, grant) -> _SchedulerWaiter:
+        waiter = _SchedulerWaiter(priority, user, grant)
+        with self._lock:
+            self._queues[priority].setdefault(user, deque()).append(waiter)
+            self._dispatch()
+        return waiter
+    
+    def _dispatch(self):
+        """在持有锁时调用：按优先级和用户轮转把空闲名额分给等待中的请求"""
+        running = sum(self._running.values())
+        for priority in sorted(self._queues):
+            users = self._queues[priority]
+            while users and running < self._limit(priority):
+                user, waiters = next(iter(users.items()))
+                waiter = waiters.popleft()
+                if waiters:
+                    users.move_to_end(user)
+                else:
+                    del users[user]
+                
+                waited = time.monotonic() - waiter.enqueued
+                self._granted[priority] += 1
+                self._total_wait[priority] += waited
+                self._max_wait[priority] = max(self._max_wait[priority], waited)
+                self._running[priority] += 1
+                running += 1
+                waiter.granted = True
+                waiter.grant()
+    
+    def _cancel(self, waiter: _SchedulerWaiter):
+        """等待被取消：还在排队就移出队列，已分到名额就归还"""
+        with self._lock:
+            if not waiter.granted:
+                waiters = self._queues[waiter.priority].get(waiter.user)
+                if waiters is not None:
+                    waiters.remove(waiter)
+                    if not waiters:
+                        del self._queues[waiter.priority][waiter.user]
+                return
+        self.release(waiter)
+    
+    def release(self, waiter: _SchedulerWaiter):
+        with self._lock:
+            self._running[waiter.priority] -= 1
+            self._dispatch()
+    
+    @contextmanager
+    def slot(self, priority: int = None, user: str = None):
+        """在线程中占用一个名额；未指定时使用当前请求上下文的优先级和用户"""
+        if priority is None:
+            priority, user = _ollama_request_context.get()
+        event = threading.Event()
+        waiter = self._enqueue(priority, user, event.set)
+        try:
+            event.wait()
+        except BaseException:
+            self._cancel(waiter)
+            raise
+        try:
+            yield
+        finally:
+            self.release(waiter)
+    
+    @asynccontextmanager
+    async def aslot(self, priority: int = None, user: str = None):
+        """在协程中占用一个名额；未指定时使用当前请求上下文的优先级和用户"""
+        if priority is None:
+            priority, user = _ollama_request_context.get()
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        
+        def grant():
+            # 名额可能在其他线程或事件循环中释放
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+        
+        waiter = self._enqueue(priority, user, grant)
+        try:
+            await future
+        except BaseException:
+            self._cancel(waiter)
+            raise
+        try:
+            yield
+        finally:
+            self.release(waiter)
+    
+    def stats(self) -> dict:
+        """各优先级的排队数、运行数和等待时间"""
+        now = time.monotonic()
+        with self._lock:
+            result = {}
+            for priority, name in PRIORITY_NAMES.items():
+                queued = [waiter for waiters in self._queues[priority].values() for waiter in waiters]
+                granted = self._granted[priority]
+                result[name] = {
+                    "queued": len(queued),
+                    "queued_users": len(self._queues[priority]),
+                    "running": self._running[priority],
+                    "granted": granted,
+                    "avg_wait_ms": self._total_wait[priority] / granted * 1000 if granted else 0.0,
+                    "max_wait_ms": self._max_wait[priority] * 1000,
+                    "oldest_wait_ms": max((now - waiter.enqueued for waiter in queued), default=0.0) * 1000,
+                }
+            return result
+    
+    def summary(self) -> str:
+        """调度状态摘要"""
+        parts = []
+        for name, item in self.stats().items():
+            parts.append(f"{name} 运行{item['running']}/排队{item['queued']}，平均等待{item['avg_wait_ms'] / 1000:.1f}s")
+        return "；".join(parts)
+
+_ollama_scheduler = None
+_ollama_scheduler_lock = threading.Lock()
+
+def get_ollama_scheduler() -> OllamaScheduler:
+    """获取全局共享的Ollama请求调度器"""
+    global _ollama_scheduler
+    if _ollama_scheduler is None:
+        with _ollama_scheduler_lock:
+            if _ollama_scheduler is None:
+                _ollama_scheduler = OllamaScheduler()
+    return _ollama_scheduler
+
+class EventLimiter:
+    """界面事件的并发数和排队长度限制
+
+    超过 concurrency_limit + max_queue 的请求不再排队，直接得到繁忙提示，避免用户一直
+    等到超时；排队中的请求复用OllamaScheduler按用户轮流获得名额。
+    """
+    
+    def __init__(self, name: str, concurrency_limit: int, max_queue: int):
+        self.name = name
+        self.concurrency_limit = max(1, concurrency_limit)
+        self.max_queue = max(0, max_queue)
+        self.scheduler = OllamaScheduler(self.concurrency_limit, 0)
+        self.rejected = 0
+        self._admitted = 0
+        self._lock = threading.Lock()
+    
+    def _admit(self) -> bool:
+        with self._lock:
+            if self._admitted >= self.concurrency_limit + self.max_queue:
+                self.rejected += 1
+                return False
+            self._admitted += 1
+            return True
+    
+    def _leave(self):
+        with self._lock:
+            self._admitted -= 1
+    
+    @contextmanager
+    def slot(self, user: str = None):
+        """在线程中进入事件，返回是否获准；获准时等到有空闲名额才返回"""
+        if not self._admit():
+            yield False
+            return
+        try:
+            with self.scheduler.slot(PRIORITY_SINGLE_TASK, user):
+                yield True
+        finally:
+            self._leave()
+    
+    @asynccontextmanager
+    async def aslot(self, user: str = None):
+        """在协程中进入事件，返回是否获准；获准时等到有空闲名额才返回"""
+        if not self._admit():
+            yield False
+            return
+        try:
+            async with self.scheduler.aslot(PRIORITY_SINGLE_TASK, user):
+                yield True
+        finally:
+            self._leave()
+    
+    def stats(self) -> dict:
+        item = self.scheduler.stats()[PRIORITY_NAMES[PRIORITY_SINGLE_TASK]]
+        item.update(concurrency_limit=self.concurrency_limit, max_queue=self.max_queue, rejected=self.rejected)
+        return item
+    
+    def busy_message(self) -> str:
+        """超出限制时返回给用户的提示"""
+        item = self.stats()
+        return (f"⏳ 系统繁忙：当前已有 {item['running']} 个请求在处理、{item['queued']} 个在排队"
+                f"（上限 {self.concurrency_limit} 个并发、{self.max_queue} 个排队），请稍后再试")
+
+def load_event_limits(path: str = EVENT_LIMITS_FILE) -> dict:
+    """读取各事件的限制：默认值 < JSON配置文件 < 环境变量"""
+    limits = {name: dict(values) for name, values in DEFAULT_EVENT_LIMITS.items()}
+    if path and os.path.exists(path):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                for name, values in json.load(f).items():
+                    limits.setdefault(name, {"concurrency_limit": 1, "max_queue": 0}).update(values)
+        except (OSError, ValueError, AttributeError) as e:
+            print(f"读取事件限制配置失败 {path}: {str(e)}")
+    for name, values in limits.items():
+        for key, suffix in (("concurrency_limit", "CONCURRENCY"), ("max_queue", "MAX_QUEUE")):
+            value = os.environ.get(f"{name.upper()}_{suffix}")
+            if value:
+                values[key] = int(value)
+    return limits
+
+_event_limiters = {}
+_event_limiters_lock = threading.Lock()
+
+def get_event_limiter(name: str) -> EventLimiter:
+    """获取指定事件的限制器（按load_event_limits的配置创建）"""
+    with _event_limiters_lock:
+        if not _event_limiters:
+            for event_name, values in load_event_limits().items():
+                _event_limiters[event_name] = EventLimiter(event_name, values["concurrency_limit"], values["max_queue"])
+        if name not in _event_limiters:
+            _event_limiters[name] = EventLimiter(name, GRADIO_DEFAULT_CONCURRENCY, 0)
+        return _event_limiters[name]
+
+class StreamDecoder:
+    """Ollama NDJSON流的逐行解码器
+
+    直接解析bytes，不先解码为str；安装了orjson时使用orjson，否则使用标准库json。
+    每行只取出response和done两个字段，并记录该流的行数和解码耗时。
+    """
+    
+    def __init__(self, loads=None):
+        if loads is None:
+            loads = orjson.loads if orjson is not None else json.loads
+        self.loads = loads
+        self.backend = "orjson" if orjson is not None and loads is orjson.loads else getattr(loads, "__module__", "custom")
+        self.lines = 0
+        self.errors = 0
+        self.decode_seconds = 0.0
+    
+    def decode(self, line: bytes):
+        """解析一行，返回(response片段, 是否结束)；无法解析的行返回None"""
+        start = time.perf_counter()
+        try:
+            data = self.loads(line)
+        except ValueError:
+            # json.JSONDecodeError和orjson.JSONDecodeError都是ValueError的子类
+            self.errors += 1
+            return None
+        finally:
+            self.decode_seconds += time.perf_counter() - start
+            self.lines += 1
+        return data.get("response", ""), data.get("done", False)
+    
+    def stats(self) -> dict:
+        """该流的解码统计"""
+        return {
+            "backend": self.backend,
+            "lines": self.lines,
+            "errors": self.errors,
+            "decode_ms": self.decode_seconds * 1000,
+            "us_per_line": self.decode_seconds * 1e6 / self.lines if self.lines else 0.0,
+        }
 
 class OllamaClient:
     """Ollama客户端"""
     
-    def __init__(self, base_url: str = "http://localhost:11434"):
-        self.base_url = base_url
+    # 流式响应的解码器，可替换为其他实现（需提供decode和stats方法）
+    decoder_factory = StreamDecoder
+    
+    # 提示词与文本内容的拼接格式
+    CONTEXT_TEMPLATE = "{prompt}\n\n文本内容：\n{context}"
+    
+    def __init__(self, base_url: str = None, session: OllamaSession = None, router: OllamaRouter = None,
+                 scheduler: OllamaScheduler = None):
+        self.session = session or get_ollama_session()
+        self.scheduler = scheduler or get_ollama_scheduler()
+        # 指定base_url时只使用该节点，否则在OLLAMA_BACKENDS的各节点间负载均衡
+        if router is None:
+            router = OllamaRouter([base_url], session=self.session) if base_url else get_ollama_router()
+        self.router = router
+        self.base_url = router.backends[0].url
         self.model = "gemma3:12b"
+        self.num_ctx = OLLAMA_NUM_CTX
+        # 输出上限与分块时预留的输出空间一致，提示词+输出不会超出num_ctx
+        self.num_predict = OLLAMA_RESPONSE_RESERVE
+        # 解码耗时统计：最近一个流的统计，以及该客户端所有流的累计
+        self.last_decode_stats = None
+        self.decode_totals = {"streams": 0, "lines": 0, "decode_ms": 0.0}
+        # 同一客户端可能被多个线程（并行翻译、分块分析）同时使用
+        self._stats_lock = threading.Lock()
     
-    def generate_stream(self, prompt: str, context: str = "") -> Generator[str, None, None]:
-        """流式生成响应"""
+    def _record_decode_stats(self, decoder):
+        stats = decoder.stats()
+        with self._stats_lock:
+            self.last_decode_stats = stats
+            self.decode_totals["streams"] += 1
+            self.decode_totals["lines"] += stats["lines"]
+            self.decode_totals["decode_ms"] += stats["decode_ms"]
+    
+    def build_payload(self, prompt: str, context: str = "") -> dict:
+        """构建生成请求的负载"""
         if context:
-            full_prompt = f"{prompt}\n\n文本内容：\n{context}"
+            full_prompt = self.CONTEXT_TEMPLATE.format(prompt=prompt, context=context)
         else:
             full_prompt = prompt
         
-        payload = {
+        return {
             "model": self.model,
             "prompt": full_prompt,
             "stream": True,
             "options": {
                 "temperature": 0.7,
-                "num_ctx": 4096
+                "num_ctx": self.num_ctx,
+                "num_predict": self.num_predict
             }
         }
+    
+    def generate_stream(self, prompt: str, context: str = "", priority: int = None, user: str = None) -> Generator[str, None, None]:
+        """流式生成响应；priority/user未指定时取当前请求上下文，在调度器分到名额后才发出请求"""
+        payload = self.build_payload(prompt, context)
+        decoder = self.decoder_factory()
+        tried = []
         
         try:
-            response = requests.post(
-                f"{self.base_url}/api/generate",
-                json=payload,
-                stream=True,
-                timeout=300
-            )
-            
-            if response.status_code == 200:
-                for line in response.iter_lines():
-                    if line:
-                        try:
-                            data = json.loads(line.decode('utf-8'))
-                            if 'response' in data:
-                                yield data['response']
-                            if data.get('done', False):
-                                break
-                        except json.JSONDecodeError:
-                            continue
-            else:
-                yield f"错误: HTTP {response.status_code}"
-                
-        except requests.exceptions.RequestException as e:
-            yield f"连接错误: {str(e)}"
+            with self.scheduler.slot(priority, user):
+                while True:
+                    backend = self.router.acquire(tried)
+                    tried.append(backend)
+                    start = time.monotonic()
+                    latency = None
+                    try:
+                        # 使用with确保连接在流结束（或提前关闭）后归还连接池
+                        with self.session.post(
+                            f"{backend.url}/api/generate",
+                            json=payload,
+                            stream=True
+                        ) as response:
+                            if response.status_code in self.router.NODE_FAILURE_STATUS:
+                                self.router.mark_failed(backend, f"HTTP {response.status_code}")
+                                if len(tried) < len(self.router.backends):
+                                    continue
+                            else:
+                                latency = time.monotonic() - start
+                            
+                            if response.status_code == 200:
+                                for line in response.iter_lines():
+                                    if line:
+                                        decoded = decoder.decode(line)
+                                        if decoded is None:
+                                            continue
+                                        text, done = decoded
+                                        if text:
+                                            yield text
+                                        if done:
+                                            break
+                            else:
+                                yield f"错误: HTTP {response.status_code}"
+                        return
+                    
+                    except requests.exceptions.ConnectionError as e:
+                        # 还没有收到响应时才算节点故障并换下一个节点重试；输出途中的读取超时只算该请求失败
+                        if latency is None:
+                            self.router.mark_failed(backend, e)
+                            if len(tried) < len(self.router.backends):
+                                continue
+                        yield f"连接错误: {str(e)}"
+                        return
+                    except requests.exceptions.RequestException as e:
+                        yield f"连接错误: {str(e)}"
+                        return
+                    finally:
+                        self.router.release(backend, latency)
+        finally:
+            self._record_decode_stats(decoder)
+
+_async_http_clients = weakref.WeakKeyDictionary()
+
+def get_async_http_client() -> "httpx.AsyncClient":
+    """获取当前事件循环共享的异步HTTP连接池"""
+    loop = asyncio.get_running_loop()
+    client = _async_http_clients.get(loop)
+    if client is None or client.is_closed:
+        limits = httpx.Limits(max_connections=OLLAMA_POOL_SIZE, max_keepalive_connections=OLLAMA_POOL_SIZE)
+        client = httpx.AsyncClient(
+            timeout=httpx.Timeout(OLLAMA_READ_TIMEOUT, connect=OLLAMA_CONNECT_TIMEOUT),
+            transport=httpx.AsyncHTTPTransport(limits=limits, retries=OLLAMA_MAX_RETRIES)
+        )
+        _async_http_clients[loop] = client
+    return client
+
+async def close_async_http_client():
+    """关闭当前事件循环的异步HTTP连接池"""
+    client = _async_http_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+def run_coroutine_sync(coro):
+    """在新的事件循环中运行协程（供同步调用方使用）"""
+    async def runner():
+        try:
+            return await coro
+        finally:
+            await close_async_http_client()
+    
+    return asyncio.run(runner())
+
+class UpdateCoalescer:
+    """合并流式输出的界面刷新，避免每个token都推送一次websocket消息"""
+    
+    def __init__(self, interval: float = UI_STREAM_INTERVAL, max_bytes: int = UI_STREAM_MAX_BYTES):
+        self.interval = interval
+        self.max_bytes = max_bytes
+        self._last_flush = 0.0   # 第一段输出立即推送
+        self._pending_bytes = 0
+        self.pending = False     # 是否还有未推送到界面的内容
+    
+    def add(self, text: str) -> bool:
+        """记录新到的文本，返回是否应该推送一次界面更新"""
+        self._pending_bytes += len(text.encode("utf-8"))
+        now = time.monotonic()
+        if now - self._last_flush >= self.interval or self._pending_bytes >= self.max_bytes:
+            self._last_flush = now
+            self._pending_bytes = 0
+            self.pending = False
+            return True
+        self.pending = True
+        return False
+
+class ProgressDispatcher:
+    """节流的分析进度分发器
+
+    按已完成的(任务, 文本块)请求数计算实际进度，以progress_callback(进度, 说明)的形式
+    回调（与gr.Progress的参数一致），每秒最多回调max_rate次。未设置回调时不做任何事情，
+    说明文本也只在真正回调时才生成。
+    """
+    
+    def __init__(self, callback=None, max_rate: float = PROGRESS_MAX_RATE):
+        self.callback = callback
+        self.enabled = callback is not None
+        self.min_interval = 1.0 / max_rate if max_rate > 0 else 0.0
+        self.total = 0
+        self.done = 0
+        self._fraction = 0.0
+        self._last_report = 0.0
+    
+    def add_total(self, count: int = 1):
+        """登记新的待完成请求"""
+        self.total += count
+    
+    def complete(self, count: int = 1):
+        """标记请求已完成"""
+        self.done += count
+    
+    @property
+    def fraction(self) -> float:
+        # 文本块边提取边登记，总数会增长；进度不倒退
+        if self.total:
+            self._fraction = max(self._fraction, min(1.0, self.done / self.total))
+        return self._fraction
+    
+    def report(self, message, force: bool = False):
+        """回调进度；message可以是返回说明文本的函数，被节流时不会调用"""
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        if not force and now - self._last_report < self.min_interval:
+            return
+        self._last_report = now
+        self.callback(self.fraction, message() if callable(message) else message)
+    
+    def finish(self, message):
+        """全部请求完成后回调最终状态，不受节流限制，使进度停在100%和最后的说明上"""
+        self.done = max(self.done, self.total)
+        self.report(message, force=True)
+
+class AsyncOllamaClient(OllamaClient):
+    """异步Ollama客户端，供async的Gradio处理函数使用，不占用工作线程"""
+    
+    async def agenerate_stream(self, prompt: str, context: str = "", priority: int = None, user: str = None) -> AsyncGenerator[str, None]:
+        """异步流式生成响应
+
+        priority/user未指定时取当前请求上下文，在调度器分到名额后才发出请求。
+        取消调用方任务或关闭该生成器时，HTTP请求会随之中断，Ollama停止生成。
+        """
+        payload = self.build_payload(prompt, context)
+        decoder = self.decoder_factory()
+        tried = []
+        
+        try:
+            async with self.scheduler.aslot(priority, user):
+                while True:
+                    backend = self.router.acquire(tried)
+                    tried.append(backend)
+                    start = time.monotonic()
+                    latency = None
+                    try:
+                        async with get_async_http_client().stream(
+                            "POST",
+                            f"{backend.url}/api/generate",
+                            json=payload
+                        ) as response:
+                            if response.status_code in self.router.NODE_FAILURE_STATUS:
+                                self.router.mark_failed(backend, f"HTTP {response.status_code}")
+                                if len(tried) < len(self.router.backends):
+                                    continue
+                            else:
+                                latency = time.monotonic() - start
+                            
+                            if response.status_code == 200:
+                                async for line in self._aiter_raw_lines(response):
+                                    decoded = decoder.decode(line)
+                                    if decoded is None:
+                                        continue
+                                    text, done = decoded
+                                    if text:
+                                        yield text
+                                    if done:
+                                        break
+                            else:
+                                yield f"错误: HTTP {response.status_code}"
+                        return
+                    
+                    except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+                        # 还没有收到响应时才算节点故障并换下一个节点重试
+                        if latency is None:
+                            self.router.mark_failed(backend, e)
+                            if len(tried) < len(self.router.backends):
+                                continue
+                        yield f"连接错误: {str(e)}"
+                        return
+                    except httpx.HTTPError as e:
+                        yield f"连接错误: {str(e)}"
+                        return
+                    finally:
+                        self.router.release(backend, latency)
+        finally:
+            self._record_decode_stats(decoder)
+    
+    @staticmethod
+    async def _aiter_raw_lines(response) -> AsyncGenerator[bytes, None]:
+        """按行返回响应体的bytes（aiter_lines会先解码为str）"""
+        pending = b""
+        async for data in response.aiter_bytes():
+            lines = (pending + data).split(b"\n")
+            pending = lines.pop()
+            for line in lines:
+                if line.strip():
+                    yield line
+        if pending.strip():
+            yield pending
 
 class TextSplitter:
     """文本分割器"""
     
+    @staticmethod
+    def split_spans(text: str, max_length: int = 3000, measure=None) -> List[Tuple[int, int]]:
+        """返回各文本块在原文中的(起点, 终点)，不复制文本"""
+        splitter = IncrementalSplitter(max_length, measure)
+        return splitter.feed_spans(text) + splitter.flush_spans()
+    
     @staticmethod
     def split_text(text: str, max_length: int = 3000) -> List[str]:
         """将文本分割成较小的块"""
-        if len(text) <= max_length:
-            return [text]
-        
-        # 按段落分割
-        paragraphs = text.split('\n\n')
-        chunks = []
-        current_chunk = ""
-        
-        for paragraph in paragraphs:
-            if len(current_chunk) + len(paragraph) <= max_length:
-                current_chunk += paragraph + "\n\n"
-            else:
-                if current_chunk:
-                    chunks.append(current_chunk.strip())
-                current_chunk = paragraph + "\n\n"
-        
-        if current_chunk:
-            chunks.append(current_chunk.strip())
-        
-        # 如果单个段落太长，按句子分割
-        final_chunks = []
-        for chunk in chunks:
-            if len(chunk) <= max_length:
-                final_chunks.append(chunk)
+        return [text[start:end] for start, end in TextSplitter.split_spans(text, max_length)]
+    
+    @staticmethod
+    def split_text_by_tokens(text: str, prompt: str, num_ctx: int = OLLAMA_NUM_CTX,
+                             reserve_tokens: int = OLLAMA_RESPONSE_RESERVE, overlap_tokens: int = CHUNK_OVERLAP_TOKENS) -> List[str]:
+        """按token预算分割文本，使提示词+文本块+预留输出不超过num_ctx"""
+        return TokenBudgetSplitter.for_prompts([prompt], num_ctx, reserve_tokens, overlap_tokens).split_text(text)
+
+class TokenCounter:
+    """按字符类别估算token数（中文每字约1个token，英文约3.5个字符1个token），无需加载分词器"""
+    
+    CJK_PATTERN = re.compile(r'[\u3000-\u303f\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]+')
+    
+    def __init__(self, tokens_per_cjk_char: float = TOKENS_PER_CJK_CHAR, chars_per_token: float = CHARS_PER_TOKEN):
+        self.tokens_per_cjk_char = tokens_per_cjk_char
+        self.chars_per_token = chars_per_token
+    
+    def count(self, text: str) -> float:
+        """估算token数；结果可加，拼接文本的估算值等于各部分之和"""
+        cjk_chars = len(text) - len(self.CJK_PATTERN.sub('', text))
+        return cjk_chars * self.tokens_per_cjk_char + (len(text) - cjk_chars) / self.chars_per_token
+
+class IncrementalSplitter:
+    """增量文本分割器
+
+    边接收文本片段边输出已经填满的文本块，结果与一次性分割完整文本一致，
+    使分析可以在文档尚未提取完时开始。依次在段落、句子（含中文标点）、换行处切分，
+    仍超长时硬切。文本块以输入流中的(起点, 终点)区间表示，只在输出时切片一次，
+    耗时与文本长度成线性关系。
+    """
+    
+    PARAGRAPH_BREAK = re.compile(r'\n\s*\n\s*')
+    SENTENCE_BREAK = re.compile(r'(?:[.!?]+[”’"\')）」』]*(?=\s)|[。！？；…]+[”’"\')）」』]*)\s*')
+    LINE_BREAK = re.compile(r'\n\s*')
+    BOUNDARIES = (PARAGRAPH_BREAK, SENTENCE_BREAK, LINE_BREAK)  # 由粗到细；再下一级为硬切
+    BOUNDARY_CHARS = frozenset(' \t\n\r\f\v.!?。！？；…”’"\')）」』')
+    
+    def __init__(self, max_length: float = 3000, measure=None, overlap: float = 0):
+        self.budget = max_length
+        self.measure = measure    # 计量函数，None表示按字符数
+        self.overlap = min(overlap, max_length / 2)
+        self._text = ""           # 输入流中从_base开始、尚未释放的文本
+        self._base = 0
+        self._pos = 0             # 此前的文本已切分为单元
+        self._depth = 0           # 正在枚举的边界级别，更粗的级别上是尚未结束的超长单元
+        self._matches = {}        # 各级别下一个边界的查找结果：{级别: ((起点, 终点)或None, 查找时的文本末尾)}
+        self._units = []          # 当前块中的(起点, 终点, 长度)
+        self._size = 0.0
+        self._carried = 0         # _units开头来自上一块重叠部分的单元数
+    
+    def feed(self, text: str) -> List[str]:
+        """接收一段文本，返回已经填满的文本块"""
+        return [self._slice(start, end) for start, end in self.feed_spans(text)]
+    
+    def flush(self) -> List[str]:
+        """输入结束，返回剩余的文本块"""
+        return [self._slice(start, end) for start, end in self.flush_spans()]
+    
+    def feed_spans(self, text: str) -> List[Tuple[int, int]]:
+        """同feed，但返回文本块在输入流中的(起点, 终点)"""
+        self._release()
+        self._text += text
+        return self._advance(final=False)
+    
+    def flush_spans(self) -> List[Tuple[int, int]]:
+        """同flush，但返回文本块在输入流中的(起点, 终点)"""
+        spans = self._advance(final=True)
+        if len(self._units) > self._carried:
+            self._emit(spans)
+        self._units = []
+        self._size = 0.0
+        self._carried = 0
+        self._depth = 0
+        self._matches = {}
+        return spans
+    
+    def _slice(self, start: int, end: int) -> str:
+        return self._text[start - self._base:end - self._base]
+    
+    def _length(self, start: int, end: int) -> float:
+        if self.measure is None:
+            return end - start
+        return self.measure(self._slice(start, end))
+    
+    def _release(self):
+        # 丢弃已输出的文本；只在可丢弃部分多于剩余部分时复制，摊还后仍为线性
+        keep = self._units[0][0] if self._units else self._pos
+        for found, _ in self._matches.values():
+            if found is not None:
+                keep = min(keep, found[0])
+        keep = self._run_start(keep)
+        if keep - self._base > len(self._text) // 2:
+            self._text = self._text[keep - self._base:]
+            self._base = keep
+    
+    def _run_start(self, position: int) -> int:
+        """位置可能落在边界的空白或标点中间（硬切时），返回这一串字符的开头"""
+        while position > self._base and self._text[position - 1 - self._base] in self.BOUNDARY_CHARS:
+            position -= 1
+        return position
+    
+    def _boundary(self, level: int, end: int, final: bool):
+        """返回当前位置之后第level级的下一个完整边界的结束位置"""
+        cached = self._matches.get(level)
+        if cached is None:
+            start = self._pos
+        else:
+            found, searched_end = cached
+            if found is not None and found[1] <= self._pos:
+                start = self._pos
+            elif searched_end < end:
+                # 又接收了文本：未结束的边界可能变长，末尾也可能出现新的边界
+                start = found[0] if found is not None else searched_end
             else:
-                sentences = re.split(r'[.!?]+', chunk)
-                temp_chunk = ""
-                for sentence in sentences:
-                    if len(temp_chunk) + len(sentence) <= max_length:
-                        temp_chunk += sentence + ". "
-                    else:
-                        if temp_chunk:
-                            final_chunks.append(temp_chunk.strip())
-                        temp_chunk = sentence + ". "
-                if temp_chunk:
-                    final_chunks.append(temp_chunk.strip())
-        
-        return final_chunks
+                start = None
+        if start is not None:
+            found = None
+            for match in self.BOUNDARIES[level].finditer(self._text, self._run_start(start) - self._base):
+                if match.end() + self._base > self._pos:
+                    found = (match.start() + self._base, match.end() + self._base)
+                    break
+            self._matches[level] = (found, end)
+        else:
+            found = cached[0]
+        if found is None:
+            return None
+        if found[1] >= end and not final:
+            # 边界后面的空白可能还没接收完
+            return None
+        return found[1]
+    
+    def _advance(self, final: bool) -> List[Tuple[int, int]]:
+        spans = []
+        end = self._base + len(self._text)
+        while self._pos < end:
+            depth = self._depth
+            # 外层超长单元最近的结束位置，其中剩余的文本可以一次切分完
+            close, close_level = None, None
+            for level in range(depth):
+                stop = self._boundary(level, end, final)
+                if stop is not None and (close is None or stop < close):
+                    close, close_level = stop, level
+            if close is None and final:
+                close, close_level = end, 0
+            if close is not None:
+                self._add_children(self._pos, close, depth, spans)
+                self._pos = close
+                self._depth = close_level
+                continue
+            
+            if depth < len(self.BOUNDARIES):
+                # 外层单元都未结束，当前级别已完整的单元可以直接添加
+                position = self._pos
+                for match in self.BOUNDARIES[depth].finditer(self._text, self._run_start(self._pos) - self._base):
+                    stop = match.end() + self._base
+                    if stop <= self._pos:
+                        continue
+                    if stop >= end:
+                        # 边界后面的空白可能还没接收完
+                        break
+                    self._add_span(position, stop, depth, spans)
+                    position = stop
+                self._pos = position
+                if self._pos == end:
+                    break
+                if self._length(self._pos, end) > self.budget:
+                    # 当前单元尚未结束就已超长，进入下一级边界
+                    self._depth += 1
+                    continue
+                break
+            
+            # 没有任何边界的超长文本，保留最后一段不完整的部分
+            pieces = self._cut(self._pos, end)
+            for start, stop in pieces[:-1]:
+                self._add_unit(start, stop, self._length(start, stop), spans)
+            self._pos = pieces[-1][0]
+            break
+        return spans
+    
+    def _add_span(self, start: int, end: int, level: int, spans: List[Tuple[int, int]]):
+        """添加一个第level级单元，超长时在下一级边界处继续切分"""
+        length = self._length(start, end)
+        if length <= self.budget:
+            self._add_unit(start, end, length, spans)
+        else:
+            self._add_children(start, end, level + 1, spans)
+    
+    def _add_children(self, start: int, end: int, level: int, spans: List[Tuple[int, int]]):
+        """在第level级边界处切分[start, end)并逐个添加"""
+        if level == len(self.BOUNDARIES):
+            for piece_start, piece_end in self._cut(start, end):
+                self._add_unit(piece_start, piece_end, self._length(piece_start, piece_end), spans)
+            return
+        position = start
+        for match in self.BOUNDARIES[level].finditer(self._text, start - self._base, end - self._base):
+            self._add_span(position, match.end() + self._base, level, spans)
+            position = match.end() + self._base
+        if position < end:
+            self._add_span(position, end, level, spans)
+    
+    def _cut(self, start: int, end: int) -> List[Tuple[int, int]]:
+        """没有任何边界的超长文本按预算硬切"""
+        if self.measure is None:
+            size = max(1, int(self.budget))
+            return [(position, min(position + size, end)) for position in range(start, end, size)]
+        pieces = []
+        piece_start = start
+        length = 0.0
+        for index in range(start, end):
+            weight = self.measure(self._text[index - self._base])
+            if length + weight > self.budget and index > piece_start:
+                pieces.append((piece_start, index))
+                piece_start = index
+                length = 0.0
+            length += weight
+        pieces.append((piece_start, end))
+        return pieces
+    
+    def _add_unit(self, start: int, end: int, length: float, spans: List[Tuple[int, int]]):
+        if self._size + length > self.budget:
+            if len(self._units) > self._carried:
+                self._emit(spans)
+            # 重叠部分放不下时从最早的单元开始丢弃
+            while self._units and self._size + length > self.budget:
+                self._size -= self._units.pop(0)[2]
+                self._carried -= 1
+        self._units.append((start, end, length))
+        self._size += length
+    
+    def _emit(self, spans: List[Tuple[int, int]]):
+        start, end = self._units[0][0], self._units[-1][1]
+        while start < end and self._text[start - self._base].isspace():
+            start += 1
+        while end > start and self._text[end - 1 - self._base].isspace():
+            end -= 1
+        if start < end:
+            spans.append((start, end))
+        
+        # 保留末尾不超过重叠预算的单元作为下一块的开头
+        carried = 0
+        carried_size = 0.0
+        for _, _, length in reversed(self._units):
+            if carried_size + length > self.overlap:
+                break
+            carried += 1
+            carried_size += length
+        self._units = self._units[len(self._units) - carried:]
+        self._size = carried_size
+        self._carried = carried
+
+class TokenBudgetSplitter(IncrementalSplitter):
+    """按token预算增量分割文本
+
+    每个文本块连同提示词和预留的输出空间都不超过模型的上下文窗口(num_ctx)；
+    切分规则与IncrementalSplitter相同，按估算的token数计量。
+    相邻文本块可以重叠末尾的若干单元。
+    """
+    
+    MIN_BUDGET = 256
+    
+    def __init__(self, budget_tokens: float, overlap_tokens: float = 0, counter: TokenCounter = None):
+        self.counter = counter or TokenCounter()
+        super().__init__(max(self.MIN_BUDGET, budget_tokens), self.counter.count, overlap_tokens)
+    
+    @classmethod
+    def for_prompts(cls, prompts: List[str], num_ctx: int = OLLAMA_NUM_CTX, reserve_tokens: int = OLLAMA_RESPONSE_RESERVE,
+                    overlap_tokens: int = CHUNK_OVERLAP_TOKENS, counter: TokenCounter = None) -> "TokenBudgetSplitter":
+        """根据最长的提示词计算文本块预算，使同一组文本块适用于所有提示词"""
+        counter = counter or TokenCounter()
+        prompt_tokens = max(
+            (counter.count(OllamaClient.CONTEXT_TEMPLATE.format(prompt=prompt, context="")) for prompt in prompts),
+            default=0
+        )
+        return cls(num_ctx - reserve_tokens - prompt_tokens, overlap_tokens, counter)
+    
+    def split_text(self, text: str) -> List[str]:
+        """一次性分割完整文本"""
+        return self.feed(text) + self.flush()
 
 class PromptEnhancer:
     """提示词优化器"""
     
     def __init__(self):
-        self.ollama = OllamaClient()
+        self.ollama = AsyncOllamaClient()
         self.enhancement_methods = self._get_enhancement_methods()
     
     def _get_enhancement_methods(self):
@@ -270,14 +1749,52 @@ class PromptEnhancer:
                 progress_callback(f"生成中: {result[-50:]}")
         
         return result
+    
+    async def enhance_prompt_stream(self, original_prompt: str, method: str, user: str = None) -> AsyncGenerator[str, None]:
+        """异步流式优化提示词，逐段返回模型输出；作为交互请求优先调度"""
+        if method not in self.enhancement_methods:
+            yield "未知的优化方法"
+            return
+        
+        enhancement_prompt = self.enhancement_methods[method].format(original_prompt=original_prompt)
+        async for response_part in self.ollama.agenerate_stream(enhancement_prompt, priority=PRIORITY_INTERACTIVE, user=user):
+            yield response_part
+    
+    async def enhance_prompt_async(self, original_prompt: str, method: str, progress_callback=None) -> str:
+        """异步优化提示词"""
+        if progress_callback and method in self.enhancement_methods:
+            progress_callback(f"正在使用{method}优化提示词...")
+        
+        result = ""
+        async for response_part in self.enhance_prompt_stream(original_prompt, method):
+            result += response_part
+            if progress_callback:
+                progress_callback(f"生成中: {result[-50:]}")
+        
+        return result
 
 class DocumentAnalyzer:
     """文档分析主类"""
     
-    def __init__(self):
-        self.processor = DocumentProcessor()
-        self.ollama = OllamaClient()
+    # 汇总模式下合并部分结果的提示词，原任务提示词（含思维模式）附在后面，适用于所有任务
+    REDUCE_TEMPLATE = """The text below contains partial results. Each one was produced by applying the same instructions to a different consecutive part of one long document. Merge them into ONE complete result for the whole document:
+- Follow the original instructions exactly, including the required structure, sections and length limits.
+- Combine overlapping items and remove duplicates instead of listing them twice.
+- Keep the order in which the material appears in the document (chronological order for timelines).
+- Do not mention that the input was split into parts.
+
+Original instructions:
+{prompt}"""
+    
+    def __init__(self, max_concurrency: int = OLLAMA_MAX_CONCURRENCY, cache: DiskCache = None):
+        self.processor = DocumentProcessor(get_extraction_cache())
+        self.ollama = AsyncOllamaClient()
         self.splitter = TextSplitter()
+        self.max_concurrency = max(1, max_concurrency)
+        self.cache = cache or get_analysis_cache()
+        self.response_reserve_tokens = OLLAMA_RESPONSE_RESERVE
+        self.chunk_overlap_tokens = CHUNK_OVERLAP_TOKENS
+        self.reduce_fan_in = max(2, REDUCE_FAN_IN)
         
         # 定义基础提示词
         self.base_prompts = self._get_base_prompts()
@@ -467,17 +1984,11 @@ Ensure the dialogue balances informative depth with a casual, friendly vibe."""
         }
     
     def extract_text_from_file(self, file_path: str) -> str:
-        """从文件提取文本"""
-        file_extension = Path(file_path).suffix.lower()
-        
-        if file_extension == '.pdf':
-            return self.processor.extract_text_from_pdf(file_path)
-        elif file_extension == '.docx':
-            return self.processor.extract_text_from_docx(file_path)
-        elif file_extension == '.txt':
-            return self.processor.extract_text_from_txt(file_path)
-        else:
+        """从文件提取文本（命中提取缓存时跳过解析）"""
+        document = self.processor.extract_document(file_path)
+        if document is None:
             return "不支持的文件格式"
+        return document["text"]
     
     def create_output_document(self, results: dict, filename: str) -> str:
         """创建输出Word文档"""
@@ -517,6 +2028,11 @@ Ensure the dialogue balances informative depth with a casual, friendly vibe."""
         doc.save(output_path)
         return output_path
     
+    def cache_summary(self) -> str:
+        """缓存命中情况的简要说明"""
+        stats = self.cache.stats()
+        return f"缓存命中 {stats['hits']} 次 / 未命中 {stats['misses']} 次，共 {stats['entries']} 条"
+    
     def get_combined_prompt(self, task_name: str, thinking_mode: str) -> str:
         """组合基础提示词和思维模式前缀"""
         base_prompt = self.base_prompts.get(task_name, "")
@@ -527,81 +2043,1038 @@ Ensure the dialogue balances informative depth with a casual, friendly vibe."""
         else:
             return base_prompt
     
-    def analyze_single_task(self, file_path: str, task_name: str, thinking_mode: str = "标准模式", progress_callback=None) -> dict:
-        """分析单个任务"""
-        # 提取文本
-        if progress_callback:
-            progress_callback("正在提取文本...")
-        
-        text = self.extract_text_from_file(file_path)
-        if not text or text == "不支持的文件格式":
-            return {"error": "无法提取文本或不支持的文件格式"}
-        
-        # 分割文本
-        text_chunks = self.splitter.split_text(text)
-        
-        if task_name not in self.base_prompts:
-            return {"error": f"未找到任务: {task_name}"}
-        
-        # 获取组合后的提示词
-        prompt = self.get_combined_prompt(task_name, thinking_mode)
-        task_results = []
+    def get_reduce_prompt(self, task_name: str, thinking_mode: str) -> str:
+        """汇总模式下合并部分结果所用的提示词"""
+        return self.REDUCE_TEMPLATE.format(prompt=self.get_combined_prompt(task_name, thinking_mode))
+    
+    def create_splitter(self, prompts: List[str]) -> TokenBudgetSplitter:
+        """按当前模型的上下文窗口为一组提示词创建token预算分割器"""
+        return TokenBudgetSplitter.for_prompts(
+            prompts, self.ollama.num_ctx, self.response_reserve_tokens, self.chunk_overlap_tokens
+        )
+
+    def _produce_chunks(self, file_path: str, splitter: TokenBudgetSplitter, emit, stop_event: threading.Event):
+        """逐页提取文本并增量分割，每填满一个文本块就调用emit（在线程中运行）"""
+        pieces = self.processor.iter_document_text(file_path)
+        try:
+            for piece in pieces:
+                if stop_event.is_set():
+                    return
+                for chunk in splitter.feed(piece):
+                    emit(chunk)
+            for chunk in splitter.flush():
+                emit(chunk)
+        finally:
+            pieces.close()
+
+    async def _run_job(self, label: str, prompt: str, chunk: str, semaphore: asyncio.Semaphore, progress: ProgressDispatcher) -> str:
+        """执行单个(提示词, 文本块)任务，优先读取缓存"""
+        # 缓存键覆盖模型、完整提示词（含文本块）和生成参数
+        cache_key = self.cache.make_key(self.ollama.build_payload(prompt, chunk))
+        cached = self.cache.get(cache_key)
+        if cached is not None:
+            progress.complete()
+            progress.report(lambda: f"{label}: 命中缓存")
+            return cached
         
-        for chunk_idx, chunk in enumerate(text_chunks):
-            if progress_callback:
-                progress_callback(f"正在处理: {task_name} ({thinking_mode}) - 第 {chunk_idx+1}/{len(text_chunks)} 部分")
+        try:
+            async with semaphore:
+                chunk_result = ""
+                async for response_part in self.ollama.agenerate_stream(prompt, chunk):
+                    chunk_result += response_part
+                    # 实时更新进度（节流，未设置回调时跳过）
+                    if progress.enabled:
+                        progress.report(lambda: f"{label}: {chunk_result[-50:]}")
+        finally:
+            progress.complete()
+        
+        if chunk_result and not chunk_result.startswith(OLLAMA_ERROR_PREFIXES):
+            self.cache.set(cache_key, chunk_result)
+        return chunk_result
+
+    async def _run_chunk_jobs(self, jobs: List[Tuple[str, str, str]], progress_callback=None) -> List[str]:
+        """并发执行(标签, 提示词, 文本块)任务，结果按原顺序返回"""
+        # 信号量限制同时在途的请求数
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        progress = ProgressDispatcher(progress_callback)
+        progress.add_total(len(jobs))
+        results = list(await asyncio.gather(*(self._run_job(*job, semaphore, progress) for job in jobs)))
+        progress.finish(f"已完成 {len(jobs)} 个请求")
+        return results
+
+    def _group_for_reduce(self, parts: List[str], budget: float) -> List[List[str]]:
+        """把相邻的部分结果分组，每组（含各部分的标题行）不超过token预算和合并扇入数
+
+        单独就超出预算的部分先切成不超过半个预算的片段，相邻片段可以两两合并；
+        放不进当前组的部分另起一组，只有一项的组原样进入下一轮。
+        """
+        counter = TokenCounter()
+        header_tokens = counter.count("--- 部分结果 00 ---\n")
+        groups = []
+        group = []
+        group_tokens = 0.0
+        for part in parts:
+            pieces = [part]
+            if counter.count(part) + header_tokens > budget:
+                pieces = TokenBudgetSplitter(budget / 2 - header_tokens, counter=counter).split_text(part)
+            for piece in pieces:
+                tokens = counter.count(piece) + header_tokens
+                if group and (group_tokens + tokens > budget or len(group) >= self.reduce_fan_in):
+                    groups.append(group)
+                    group = []
+                    group_tokens = 0.0
+                group.append(piece)
+                group_tokens += tokens
+        if group:
+            groups.append(group)
+        return groups
+    
+    @staticmethod
+    def _is_failed(result: str) -> bool:
+        return not result or result.startswith(OLLAMA_ERROR_PREFIXES)
+    
+    async def _reduce_results(self, task_name: str, thinking_mode: str, results: List[str],
+                              semaphore: asyncio.Semaphore, progress: ProgressDispatcher) -> List[str]:
+        """分轮合并各部分结果直到只剩一份；每轮内的合并请求并发执行
+
+        分析失败的部分不参与合并，在结果末尾注明；某组合并失败时重试一次，仍失败则停止合并，
+        返回目前为止（部分合并）的结果并附上错误说明，不丢弃已经完成的内容。
+        """
+        failed_chunks = [number for number, result in enumerate(results, 1) if self._is_failed(result)]
+        parts = [result for result in results if not self._is_failed(result)]
+        if not parts:
+            return results
+        notes = []
+        if failed_chunks:
+            first_error = next(result for result in results if self._is_failed(result)) or "没有返回内容"
+            notes.append(f"⚠️ 第 {'、'.join(map(str, failed_chunks))} 部分分析失败，合并结果不包含这些部分（{first_error}）")
+        
+        prompt = self.get_reduce_prompt(task_name, thinking_mode)
+        budget = self.create_splitter([prompt]).budget
+        level = 0
+        while len(parts) > 1:
+            level += 1
+            groups = self._group_for_reduce(parts, budget)
+            if all(len(group) == 1 for group in groups):
+                # 相邻两份合起来都超出预算，再合并也不会减少
+                notes.append(f"⚠️ 剩余 {len(parts)} 份结果过长，合在一起超出上下文窗口，以上为未完全合并的结果")
+                return parts + ["\n".join(notes)]
             
-            chunk_result = ""
-            for response_part in self.ollama.generate_stream(prompt, chunk):
-                chunk_result += response_part
-                # 实时更新进度
-                if progress_callback:
-                    progress_callback(f"{task_name} ({thinking_mode}) - 第 {chunk_idx+1} 部分: {chunk_result[-50:]}")
+            def merge_job(index, group, retry=False):
+                label = f"{task_name} ({thinking_mode}) - 第 {level} 轮合并 {index}/{len(groups)}{'（重试）' if retry else ''}"
+                context = "\n\n".join(f"--- 部分结果 {number} ---\n{part}" for number, part in enumerate(group, 1))
+                return self._run_job(label, prompt, context, semaphore, progress)
             
-            task_results.append(chunk_result)
-        
-        return {f"{task_name} ({thinking_mode})": task_results}
+            progress.add_total(sum(1 for group in groups if len(group) > 1))
+            jobs = []
+            for index, group in enumerate(groups, 1):
+                if len(group) == 1:
+                    # 落单的部分直接进入下一轮
+                    jobs.append(asyncio.sleep(0, result=group[0]))
+                else:
+                    jobs.append(merge_job(index, group))
+            merged = list(await asyncio.gather(*jobs))
+            
+            # 合并失败多为临时错误，重试一次
+            retry_indexes = [index for index, result in enumerate(merged) if self._is_failed(result)]
+            if retry_indexes:
+                progress.add_total(len(retry_indexes))
+                retried = await asyncio.gather(*(merge_job(index + 1, groups[index], retry=True) for index in retry_indexes))
+                for index, result in zip(retry_indexes, retried):
+                    merged[index] = result
+            
+            failed = [result for result in merged if self._is_failed(result)]
+            if failed:
+                # 保留已合并的组，失败的组保留其原始部分
+                remaining = []
+                for group, result in zip(groups, merged):
+                    remaining.extend(group if self._is_failed(result) else [result])
+                notes.append(f"⚠️ 第 {level} 轮合并失败，以上为未完全合并的 {len(remaining)} 份结果（{failed[0] or '没有返回内容'}）")
+                return remaining + ["\n".join(notes)]
+            parts = merged
+        if notes:
+            return [parts[0] + "\n\n" + "\n".join(notes)]
+        return parts
 
-    def analyze_document(self, file_path: str, thinking_mode: str = "标准模式", progress_callback=None) -> dict:
-        """分析文档"""
-        # 提取文本
-        if progress_callback:
-            progress_callback("正在提取文本...")
+    async def _analyze_streaming(self, file_path: str, task_names: List[str], thinking_mode: str, progress_callback=None,
+                                 merge_results: bool = False) -> dict:
+        """流式分析：文本块一旦分割出来就立即提交给各任务，无需等待整份文档提取完成
+
+        progress_callback(进度, 说明)按已完成的请求数报告0~1的进度，并限制回调频率。
+        """
+        progress = ProgressDispatcher(progress_callback)
+        progress.report("正在提取文本...", force=True)
         
-        text = self.extract_text_from_file(file_path)
-        if not text or text == "不支持的文件格式":
-            return {"error": "无法提取文本或不支持的文件格式"}
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        stop_event = threading.Event()
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        prompts = {task_name: self.get_combined_prompt(task_name, thinking_mode) for task_name in task_names}
         
-        # 分割文本
-        text_chunks = self.splitter.split_text(text)
+        def emit(chunk):
+            loop.call_soon_threadsafe(queue.put_nowait, chunk)
         
-        results = {}
-        total_tasks = len(self.base_prompts)
+        # 提取和分割是阻塞操作，放到线程中执行；结束后放入None作为结束标记
+        splitter = self.create_splitter(list(prompts.values()))
+        producer = asyncio.ensure_future(asyncio.to_thread(self._produce_chunks, file_path, splitter, emit, stop_event))
+        producer.add_done_callback(lambda _: queue.put_nowait(None))
         
-        for i, task_name in enumerate(self.base_prompts.keys()):
-            if progress_callback:
-                progress_callback(f"正在处理: {task_name} ({thinking_mode}) ({i+1}/{total_tasks})")
+        job_tasks = {task_name: [] for task_name in task_names}
+        chunk_count = 0
+        try:
+            while True:
+                chunk = await queue.get()
+                if chunk is None:
+                    break
+                chunk_count += 1
+                progress.add_total(len(task_names))
+                progress.report(lambda: f"正在处理: 第 {chunk_count} 部分 ({len(task_names)} 个任务, {thinking_mode})，并发数 {self.max_concurrency}")
+                for task_name in task_names:
+                    label = f"{task_name} ({thinking_mode}) - 第 {chunk_count} 部分"
+                    job_tasks[task_name].append(asyncio.ensure_future(
+                        self._run_job(label, prompts[task_name], chunk, semaphore, progress)
+                    ))
             
-            # 获取组合后的提示词
-            prompt = self.get_combined_prompt(task_name, thinking_mode)
-            task_results = []
+            # 提取过程中的异常在这里抛出
+            await producer
+            if chunk_count == 0:
+                return {"error": "无法提取文本或不支持的文件格式"}
             
-            for chunk_idx, chunk in enumerate(text_chunks):
-                if progress_callback:
-                    progress_callback(f"正在处理: {task_name} ({thinking_mode}) - 第 {chunk_idx+1}/{len(text_chunks)} 部分")
-                
-                chunk_result = ""
-                for response_part in self.ollama.generate_stream(prompt, chunk):
-                    chunk_result += response_part
-                    # 实时更新进度
-                    if progress_callback:
-                        progress_callback(f"{task_name} ({thinking_mode}) - 第 {chunk_idx+1} 部分: {chunk_result[-50:]}")
-                
-                task_results.append(chunk_result)
+            async def finish_task(task_name):
+                results = list(await asyncio.gather(*job_tasks[task_name]))
+                if merge_results and len(results) > 1:
+                    # 汇总模式：各任务的合并互不等待，与其他任务的分块分析共用并发限制
+                    results = await self._reduce_results(task_name, thinking_mode, results, semaphore, progress)
+                return results
             
-            results[f"{task_name} ({thinking_mode})"] = task_results
+            finished = await asyncio.gather(*(finish_task(task_name) for task_name in task_names))
+            progress.finish(f"分析完成: {chunk_count} 部分 × {len(task_names)} 个任务 ({thinking_mode})")
+            return {f"{task_name} ({thinking_mode})": results for task_name, results in zip(task_names, finished)}
+        finally:
+            # 被取消或出错时停止提取并取消未完成的请求
+            stop_event.set()
+            for tasks in job_tasks.values():
+                for task in tasks:
+                    task.cancel()
+
+    async def analyze_single_task_async(self, file_path: str, task_name: str, thinking_mode: str = "标准模式", progress_callback=None,
+                                        merge_results: bool = False) -> dict:
+        """异步分析单个任务；merge_results为True时把各部分结果合并为一份"""
+        if task_name not in self.base_prompts:
+            return {"error": f"未找到任务: {task_name}"}
         
-        return results
+        return await self._analyze_streaming(file_path, [task_name], thinking_mode, progress_callback, merge_results)
+
+    async def analyze_document_async(self, file_path: str, thinking_mode: str = "标准模式", progress_callback=None,
+                                     merge_results: bool = False) -> dict:
+        """异步分析文档；merge_results为True时每个任务只返回一份合并后的结果"""
+        return await self._analyze_streaming(file_path, list(self.base_prompts.keys()), thinking_mode, progress_callback, merge_results)
+
+    def analyze_single_task(self, file_path: str, task_name: str, thinking_mode: str = "标准模式", progress_callback=None,
+                            merge_results: bool = False) -> dict:
+        """分析单个任务"""
+        return run_coroutine_sync(self.analyze_single_task_async(file_path, task_name, thinking_mode, progress_callback, merge_results))
+
+    def analyze_document(self, file_path: str, thinking_mode: str = "标准模式", progress_callback=None,
+                         merge_results: bool = False) -> dict:
+        """分析文档"""
+        return run_coroutine_sync(self.analyze_document_async(file_path, thinking_mode, progress_callback, merge_results))
+
+class GraphRAGWorkerClient:
+    """GraphRAG常驻查询进程的客户端
+
+    首次查询时在GraphRAG的conda环境中启动 graphrag_worker.py，之后的查询通过本地IPC
+    发给该进程，索引只加载一次。进程意外退出时下次查询会自动重新启动。
+    """
+    
+    WORKER_SCRIPT = str(Path(__file__).resolve().with_name("graphrag_worker.py"))
+    
+    def __init__(self, root: str = GRAPHRAG_ROOT, conda_env: str = GRAPHRAG_CONDA_ENV, port: int = GRAPHRAG_WORKER_PORT,
+                 start_timeout: float = GRAPHRAG_WORKER_START_TIMEOUT):
+        self.root = root
+        self.conda_env = conda_env
+        self.address = ("127.0.0.1", port)
+        self.start_timeout = start_timeout
+        # 可通过环境变量固定密钥，以便复用已在运行的常驻进程
+        self.authkey = os.environ.get("GRAPHRAG_WORKER_AUTHKEY") or secrets.token_hex(16)
+        self.log_path = os.path.join(APP_CACHE_DIR, "graphrag_worker.log")
+        self.process = None
+        self._lock = threading.Lock()
+        # 各会话进行中查询的取消标记，清空或关闭页面时通过cancel_session()设置
+        self._cancel_events = {}
+        self._cancel_lock = threading.Lock()
+    
+    def command(self) -> List[str]:
+        """启动常驻进程的命令（参数列表，不经过shell）"""
+        conda = os.environ.get("CONDA_EXE") or shutil.which("conda") or "conda"
+        return [conda, "run", "-n", self.conda_env, "--no-capture-output", "python", self.WORKER_SCRIPT,
+                "--root", self.root, "--port", str(self.address[1])]
+    
+    def _request(self, message: dict, timeout: float) -> dict:
+        with multiprocessing.connection.Client(self.address, authkey=self.authkey.encode("utf-8")) as conn:
+            conn.send(message)
+            if not conn.poll(timeout):
+                raise TimeoutError(f"GraphRAG常驻进程在 {timeout:.0f} 秒内没有响应")
+            return conn.recv()
+    
+    def _start(self):
+        os.makedirs(APP_CACHE_DIR, exist_ok=True)
+        env = dict(os.environ, GRAPHRAG_WORKER_AUTHKEY=self.authkey)
+        with open(self.log_path, "ab") as log:
+            self.process = subprocess.Popen(self.command(), env=env, stdout=log, stderr=subprocess.STDOUT, **process_group_kwargs())
+        print(f"正在启动GraphRAG常驻进程 (pid {self.process.pid})，日志: {self.log_path}")
+    
+    def _replace_foreign_worker(self):
+        """端口上的进程握手失败（密钥不同，多为之前启动的旧常驻进程）：重启自己的进程，或换一个端口启动新进程"""
+        port = self.address[1]
+        print(f"⚠️ 端口 {port} 上的GraphRAG常驻进程密钥不匹配（可能是使用其他 GRAPHRAG_WORKER_AUTHKEY 启动的旧进程）")
+        if self.process is not None and self.process.poll() is None:
+            kill_process_tree(self.process)
+            print("   已结束本应用启动的常驻进程，重新启动")
+            return
+        with socket.socket() as probe:
+            probe.bind(("127.0.0.1", 0))
+            self.address = ("127.0.0.1", probe.getsockname()[1])
+        print(f"   改为在端口 {self.address[1]} 启动新的常驻进程；可结束占用端口 {port} 的旧进程，或设置相同的 GRAPHRAG_WORKER_AUTHKEY")
+    
+    def ensure_started(self) -> dict:
+        """确认常驻进程可用，必要时启动并等待索引加载完成"""
+        with self._lock:
+            try:
+                return self._request({"op": "ping"}, self.start_timeout)
+            except ConnectionRefusedError:
+                pass
+            except multiprocessing.AuthenticationError:
+                # 不能一直退回命令行查询：换用新的常驻进程
+                self._replace_foreign_worker()
+            
+            if self.process is None or self.process.poll() is not None:
+                self._start()
+            deadline = time.monotonic() + self.start_timeout
+            while time.monotonic() < deadline:
+                if self.process.poll() is not None:
+                    raise RuntimeError(f"GraphRAG常驻进程启动失败（退出码 {self.process.returncode}），详见 {self.log_path}")
+                try:
+                    return self._request({"op": "ping"}, self.start_timeout)
+                except ConnectionRefusedError:
+                    time.sleep(0.5)
+            raise TimeoutError(f"GraphRAG常驻进程在 {self.start_timeout:.0f} 秒内未就绪，详见 {self.log_path}")
+    
+    def query(self, query: str, method: str, timeout: float = GRAPHRAG_QUERY_TIMEOUT, session: str = None) -> dict:
+        """执行查询，返回 {"ok", "response"/"error", "elapsed", "index_version"}"""
+        for reply in self.iter_query(query, method, timeout, session):
+            if reply is not None:
+                return reply
+    
+    def iter_query(self, query: str, method: str, timeout: float = GRAPHRAG_QUERY_TIMEOUT, session: str = None,
+                   poll_interval: float = 1.0) -> Generator[dict, None, None]:
+        """执行查询；等待期间每隔poll_interval秒返回一次None（调用方借此显示进度，或关闭生成器），最后返回结果
+
+        超时、会话被cancel_session()取消或生成器被提前关闭时，通知常驻进程取消该查询。
+        """
+        self.ensure_started()
+        query_id = secrets.token_hex(8)
+        cancel = threading.Event()
+        with self._cancel_lock:
+            self._cancel_events.setdefault(session, set()).add(cancel)
+        finished = False
+        try:
+            with multiprocessing.connection.Client(self.address, authkey=self.authkey.encode("utf-8")) as conn:
+                conn.send({"op": "query", "query": query, "method": method, "query_id": query_id})
+                deadline = time.monotonic() + timeout
+                # 分段等待，以便及时响应取消和超时
+                while not conn.poll(poll_interval):
+                    if cancel.is_set():
+                        yield {"ok": False, "cancelled": True, "error": "查询已取消"}
+                        return
+                    if time.monotonic() >= deadline:
+                        raise TimeoutError(f"GraphRAG常驻进程在 {timeout:.0f} 秒内没有响应，已取消该查询")
+                    yield None
+                reply = conn.recv()
+                finished = True
+                yield reply
+        finally:
+            with self._cancel_lock:
+                events = self._cancel_events.get(session)
+                if events is not None:
+                    events.discard(cancel)
+                    if not events:
+                        del self._cancel_events[session]
+            if not finished:
+                self._cancel_remote(query_id)
+    
+    def _cancel_remote(self, query_id: str):
+        try:
+            self._request({"op": "cancel", "query_id": query_id}, 5)
+        except (OSError, EOFError, TimeoutError, multiprocessing.AuthenticationError) as e:
+            print(f"取消GraphRAG常驻进程中的查询失败: {str(e)}")
+    
+    def cancel_session(self, session: str) -> int:
+        """取消某个会话进行中的查询，返回取消的查询数"""
+        with self._cancel_lock:
+            events = list(self._cancel_events.get(session, ()))
+        for event in events:
+            event.set()
+        return len(events)
+    
+    def close(self):
+        """通知常驻进程退出（只关闭由本客户端启动的进程）"""
+        if self.process is None or self.process.poll() is not None:
+            return
+        try:
+            self._request({"op": "shutdown"}, 5)
+            self.process.wait(timeout=10)
+        except (OSError, EOFError, multiprocessing.AuthenticationError, subprocess.TimeoutExpired):
+            kill_process_tree(self.process)
+
+_graphrag_worker = None
+_graphrag_worker_lock = threading.Lock()
+
+# GraphRAG查询的状态：进行中、成功、出错，以及取消和超时（不是查询本身出错，auto不会因此改用local）
+GRAPHRAG_STATUS_RUNNING = "running"
+GRAPHRAG_STATUS_OK = "ok"
+GRAPHRAG_STATUS_FAILED = "failed"
+GRAPHRAG_STATUS_CANCELLED = "cancelled"
+GRAPHRAG_STATUS_TIMEOUT = "timeout"
+
+def cancel_graphrag_session(session: str):
+    """结束某个会话进行中的GraphRAG查询（命令行进程和常驻进程中的查询）"""
+    GraphRAGQueryProcess.kill_session(session)
+    if _graphrag_worker is not None:
+        _graphrag_worker.cancel_session(session)
+
+def release_graphrag_session(request: gr.Request):
+    """页面关闭时结束该会话的GraphRAG查询；需注册在最外层Blocks上，嵌套Blocks的unload不会生效"""
+    cancel_graphrag_session(request_user(request))
+
+def get_graphrag_worker() -> GraphRAGWorkerClient:
+    """获取全局共享的GraphRAG常驻进程客户端，程序退出时关闭该进程"""
+    global _graphrag_worker
+    if _graphrag_worker is None:
+        with _graphrag_worker_lock:
+            if _graphrag_worker is None:
+                _graphrag_worker = GraphRAGWorkerClient()
+                atexit.register(_graphrag_worker.close)
+    return _graphrag_worker
+
+class BM25Index:
+    """BM25关键词检索，倒排表以NumPy数组存放，一次查询只需对命中的词项做向量运算"""
+    
+    K1 = 1.5
+    B = 0.75
+    TOKEN_PATTERN = re.compile(r'[a-z0-9]+|[\u4e00-\u9fff]')
+    STOPWORDS = frozenset(
+        "a an and are as at be by can do does for from how in is it of on or that the this to what when where "
+        "which who why with about into their there these those was were will your you".split()
+    )
+    
+    def __init__(self, documents: List[str]):
+        self.size = len(documents)
+        postings = {}
+        lengths = np.zeros(self.size)
+        for index, document in enumerate(documents):
+            counts = Counter(self.tokenize(document))
+            lengths[index] = sum(counts.values())
+            for term, count in counts.items():
+                postings.setdefault(term, []).append((index, count))
+        
+        average_length = lengths.mean() if self.size and lengths.mean() > 0 else 1.0
+        self.norm = self.K1 * (1 - self.B + self.B * lengths / average_length)
+        self.postings = {}
+        for term, items in postings.items():
+            ids, counts = zip(*items)
+            idf = np.log(1 + (self.size - len(ids) + 0.5) / (len(ids) + 0.5))
+            self.postings[term] = (np.array(ids), np.array(counts, dtype=float), idf)
+    
+    @classmethod
+    def tokenize(cls, text: str) -> List[str]:
+        return [token for token in cls.TOKEN_PATTERN.findall(text.lower()) if token not in cls.STOPWORDS]
+    
+    def scores(self, query: str) -> "np.ndarray":
+        """返回每个文档对查询的得分"""
+        scores = np.zeros(self.size)
+        for term in set(self.tokenize(query)):
+            if term in self.postings:
+                ids, counts, idf = self.postings[term]
+                scores[ids] += idf * counts * (self.K1 + 1) / (counts + self.norm[ids])
+        return scores
+
+class NativeLocalSearch:
+    """应用内置的GraphRAG本地检索
+
+    一次性把ragtest/output中的实体、关系、文本单元和社区报告表读入pandas，用BM25为实体、
+    报告排序，再沿实体关联的关系和文本单元扩展上下文，最后只调用一次Ollama生成回答，
+    不需要conda环境和graphrag命令行。索引文件变化时自动重新加载。
+    """
+    
+    TABLES = {
+        "entities": "create_final_entities",
+        "relationships": "create_final_relationships",
+        "text_units": "create_final_text_units",
+        "community_reports": "create_final_community_reports",
+    }
+    # 各表必须有的列（任选其一，兼容不同GraphRAG版本）；缺少时改用命令行查询
+    REQUIRED_COLUMNS = {
+        "entities": [("title", "name")],
+        "relationships": [("source",), ("target",)],
+        "text_units": [("id",), ("text",)],
+        "community_reports": [("full_content", "summary")],
+    }
+    TOP_ENTITIES = 10
+    TOP_REPORTS = 3
+    # 上下文预算按GraphRAG本地检索的比例分配：社区报告、文本单元，其余给实体和关系
+    REPORT_SHARE = 0.15
+    TEXT_UNIT_SHARE = 0.5
+    
+    PROMPT_TEMPLATE = """---Role---
+
+You are a helpful assistant responding to questions about data in the tables provided.
+
+---Goal---
+
+Generate a response of the target length and format that responds to the user's question, summarizing all information in the input data tables appropriate for the response length and format, and incorporating any relevant general knowledge.
+
+If you don't know the answer, just say so. Do not make anything up. Do not include information where the supporting evidence for it is not provided.
+
+---Target response length and format---
+
+Multiple Paragraphs
+
+---Data tables---
+
+{context}
+
+---Question---
+
+{query}"""
+    
+    def __init__(self, root: str = GRAPHRAG_ROOT, ollama: OllamaClient = None):
+        self.root = root
+        self.ollama = ollama or OllamaClient()
+        self.counter = TokenCounter()
+        self.version = None
+        self.tables = {}
+        self._lock = threading.Lock()
+    
+    def _find_table(self, name: str):
+        """在output目录（含带时间戳的子目录）中查找最新的表文件"""
+        candidates = list((Path(self.root) / "output").rglob(f"{name}.parquet"))
+        return max(candidates, key=lambda path: path.stat().st_mtime) if candidates else None
+    
+    @staticmethod
+    def _column(frame, *names):
+        """兼容不同GraphRAG版本的列名"""
+        for name in names:
+            if name in frame.columns:
+                return frame[name]
+        return pd.Series([""] * len(frame), index=frame.index)
+    
+    def load(self):
+        """读取索引表并建立检索结构"""
+        if pd is None or np is None:
+            raise RuntimeError("内置检索需要安装pandas、pyarrow和numpy")
+        start = time.perf_counter()
+        version = graphrag_index_version(self.root)
+        tables = {}
+        for key, name in self.TABLES.items():
+            path = self._find_table(name)
+            if path is None:
+                raise FileNotFoundError(f"找不到GraphRAG索引文件: {name}.parquet（{Path(self.root) / 'output'}）")
+            tables[key] = pd.read_parquet(path).reset_index(drop=True)
+            for alternatives in self.REQUIRED_COLUMNS[key]:
+                if not any(name in tables[key].columns for name in alternatives):
+                    raise ValueError(f"索引表 {name} 缺少列 {'/'.join(alternatives)}（现有列: {', '.join(map(str, tables[key].columns))}）")
+        
+        entities = tables["entities"]
+        entities["_title"] = self._column(entities, "title", "name").fillna("").astype(str)
+        entities["_description"] = self._column(entities, "description").fillna("").astype(str)
+        reports = tables["community_reports"]
+        reports["_title"] = self._column(reports, "title").fillna("").astype(str)
+        reports["_content"] = self._column(reports, "full_content", "summary").fillna("").astype(str)
+        relationships = tables["relationships"]
+        relationships["_weight"] = pd.to_numeric(self._column(relationships, "combined_degree", "rank", "weight"), errors="coerce").fillna(0)
+        relationships["_source"] = self._column(relationships, "source").fillna("").astype(str)
+        relationships["_target"] = self._column(relationships, "target").fillna("").astype(str)
+        relationships["_description"] = self._column(relationships, "description").fillna("").astype(str)
+        text_units = tables["text_units"]
+        text_units["_text"] = self._column(text_units, "text").fillna("").astype(str)
+        
+        # 实体标题重复计入，使名称匹配比描述匹配更重要
+        self.entity_index = BM25Index((entities["_title"] + " " + entities["_title"] + " " + entities["_description"]).tolist())
+        self.report_index = BM25Index((reports["_title"] + " " + reports["_content"]).tolist())
+        self.text_unit_rows = {str(unit_id): row for row, unit_id in enumerate(self._column(text_units, "id"))}
+        self.tables = tables
+        self.version = version
+        print(f"已加载GraphRAG索引用于内置检索: {len(entities)} 个实体、{len(relationships)} 条关系、"
+              f"{len(text_units)} 个文本单元、{len(reports)} 份报告，用时 {time.perf_counter() - start:.1f}s")
+    
+    def available(self) -> bool:
+        """依赖已安装且索引表齐全时可用（不加载索引）"""
+        return pd is not None and np is not None and all(self._find_table(name) for name in self.TABLES.values())
+    
+    def ensure_loaded(self):
+        with self._lock:
+            if not self.tables or graphrag_index_version(self.root) != self.version:
+                self.load()
+    
+    @staticmethod
+    def _cell(text) -> str:
+        """表格单元格内去掉换行和分隔符"""
+        return str(text).replace("\n", " ").replace("|", "/")
+    
+    def _add_rows(self, header: str, rows: List[str], budget: float) -> str:
+        """在预算内尽量多地加入表格行"""
+        lines = [header]
+        used = self.counter.count(header)
+        for row in rows:
+            tokens = self.counter.count(row)
+            if used + tokens > budget:
+                break
+            lines.append(row)
+            used += tokens
+        return "\n".join(lines) if len(lines) > 1 else ""
+    
+    def build_context(self, query: str, budget: float) -> str:
+        """按查询选出相关的报告、实体、关系和原文，组成不超过预算的上下文表格"""
+        self.ensure_loaded()
+        entities = self.tables["entities"]
+        relationships = self.tables["relationships"]
+        text_units = self.tables["text_units"]
+        reports = self.tables["community_reports"]
+        
+        entity_scores = self.entity_index.scores(query)
+        top_entities = [index for index in np.argsort(-entity_scores)[:self.TOP_ENTITIES] if entity_scores[index] > 0]
+        report_scores = self.report_index.scores(query)
+        top_reports = [index for index in np.argsort(-report_scores)[:self.TOP_REPORTS] if report_scores[index] > 0]
+        
+        # 与选中实体相连的关系，按图中的重要程度排序
+        titles = set(entities["_title"].iloc[top_entities])
+        linked = relationships[relationships["_source"].isin(titles) | relationships["_target"].isin(titles)].sort_values("_weight", ascending=False)
+        
+        # 文本单元按被多少个选中实体引用排序，相同时按实体排名
+        unit_votes = Counter()
+        for rank, index in enumerate(top_entities):
+            unit_ids = entities["text_unit_ids"].iloc[index] if "text_unit_ids" in entities.columns else None
+            for unit_id in (unit_ids if unit_ids is not None else []):
+                unit_votes[str(unit_id)] += len(top_entities) - rank
+        unit_rows = [self.text_unit_rows[unit_id] for unit_id, _ in unit_votes.most_common() if unit_id in self.text_unit_rows]
+        
+        clean = self._cell
+        report_budget = budget * self.REPORT_SHARE
+        unit_budget = budget * self.TEXT_UNIT_SHARE
+        graph_budget = budget - report_budget - unit_budget
+        
+        sections = [
+            self._add_rows("-----Reports-----\nid|title|content",
+                           [f"{index}|{clean(reports['_title'].iloc[index])}|{clean(reports['_content'].iloc[index])}" for index in top_reports],
+                           report_budget),
+            self._add_rows("-----Entities-----\nid|entity|description",
+                           [f"{index}|{clean(entities['_title'].iloc[index])}|{clean(entities['_description'].iloc[index])}" for index in top_entities],
+                           graph_budget / 2),
+            self._add_rows("-----Relationships-----\nid|source|target|description",
+                           [f"{index}|{clean(source)}|{clean(target)}|{clean(description)}"
+                            for index, source, target, description in zip(linked.index, linked["_source"], linked["_target"], linked["_description"])],
+                           graph_budget / 2),
+            self._add_rows("-----Sources-----\nid|text",
+                           [f"{row}|{clean(text_units['_text'].iloc[row])}" for row in unit_rows],
+                           unit_budget),
+        ]
+        return "\n\n".join(section for section in sections if section)
+    
+    def search_stream(self, query: str, user: str = None) -> Generator[str, None, None]:
+        """检索上下文并流式返回Ollama生成的回答"""
+        overhead = self.counter.count(self.PROMPT_TEMPLATE) + self.counter.count(query)
+        # 按实际使用的客户端的上下文长度计算预算
+        budget = max(self.ollama.num_ctx - OLLAMA_RESPONSE_RESERVE - overhead, 512)
+        context = self.build_context(query, budget)
+        if not context:
+            yield "在索引中没有找到与问题相关的实体或报告，请换一种问法或使用global查询"
+            return
+        prompt = self.PROMPT_TEMPLATE.format(context=context, query=query)
+        yield from self.ollama.generate_stream(prompt, priority=PRIORITY_INTERACTIVE, user=user)
+
+_native_local_search = None
+_native_local_search_lock = threading.Lock()
+
+def get_native_local_search() -> NativeLocalSearch:
+    """获取全局共享的内置本地检索（首次查询时加载索引）"""
+    global _native_local_search
+    if _native_local_search is None:
+        with _native_local_search_lock:
+            if _native_local_search is None:
+                _native_local_search = NativeLocalSearch()
+    return _native_local_search
+
+class GraphRAGMethodRouter:
+    """auto查询方法：用本地规则给问题分类，选择能回答它的最省时的方法
+
+    global会对所有社区报告做map-reduce，比local慢一到两个数量级，只有明确面向整个语料的问题
+    （全书、整本书等），或没有具体对象的概览/总结/比较（主要主题、整体等）才使用；比较两个概念、
+    总结某一章仍按local处理。探索演变、关联和影响的问题用drift；其余按local处理，内置检索可用时优先用native。
+    所选方法失败时改用local。每次决策和实际耗时写入GRAPHRAG_ROUTING_LOG。
+    """
+    
+    # 明确面向整个语料的表述：没有限定到某一章节时直接用global
+    WHOLE_CORPUS_PATTERNS = [re.compile(pattern, re.IGNORECASE) for pattern in (
+        r"\b(entire|whole) (book|document|corpus|text|collection)\b",
+        r"\bas a whole\b",
+        r"\b(across|throughout) (the )?(book|document|corpus|text|chapters|sections)\b",
+        r"\ball (the )?(chapters|sections|documents)\b",
+        r"(全书|整本|通篇|各章)",
+    )]
+    # 概览类表述：也常用于具体问题（"What are the key differences between X and Y"），只在问题没有具体对象时才用global
+    CORPUS_PATTERNS = [re.compile(pattern, re.IGNORECASE) for pattern in (
+        r"\b(overall|overview|in general|throughout|landscape)\b",
+        r"\ball (the )?(topics|themes)\b",
+        r"\b(main|key|major|central|recurring) (themes?|topics?|ideas?|takeaways?)\b",
+        r"\bwhat are the (main|key|major|fundamental|common|most important)\b",
+        r"(整体|总体|所有|全部|贯穿|主要主题|核心主题)",
+    )]
+    # 总结、比较类表述：只在问题没有具体对象时才说明需要全局信息
+    AGGREGATE_PATTERNS = [re.compile(pattern, re.IGNORECASE) for pattern in (
+        r"\b(summar(y|ize|ise)|compare|comparison|contrast|differ(ences?|ent|s)?|versus|vs\.?)\b",
+        r"(总结|概述|概括|比较|对比|区别|异同|主要)",
+    )]
+    # 具体对象：章节、缩写或专有名词、连字符术语、引号中的内容、中文问题里的英文术语
+    SECTION_PATTERN = re.compile(r"\b(chapter|section|part|page|appendix)s?\s+[\w.]+|第\s*[\d一二三四五六七八九十百]+\s*[章节部分页篇]", re.IGNORECASE)
+    SPECIFIC_PATTERNS = [
+        re.compile(r"(?<![A-Za-z0-9])(?:[A-Z]{2,}[a-z]*|[A-Z][a-z]+[A-Z][A-Za-z0-9]*)(?![A-Za-z0-9])"),
+        re.compile(r"(?<![A-Za-z])[A-Za-z]+(?:-[A-Za-z]+)+(?![A-Za-z])"),
+        re.compile(r"[\"“「『][^\"”」』]+[\"”」』]"),
+    ]
+    CAPITALIZED_WORD = re.compile(r"(?<=\s)[A-Z][a-z]+\b")
+    LATIN_TERM = re.compile(r"[A-Za-z][A-Za-z0-9_-]*")
+    DRIFT_PATTERNS = [re.compile(pattern, re.IGNORECASE) for pattern in (
+        r"\b(evolv(e|ed|ing)|evolution|emerg(e|ing)|trends?|future|over time)\b",
+        r"\b(relat(e|es|ed|ion|ionship)s? (to|between)|connect(ion|ed)s?|implications?|impact of|influence)\b",
+        r"\b(psycholog\w*|cognitive|underlying|principles? behind)\b",
+        r"(演变|演化|发展趋势|趋势|未来|关联|联系|影响|原理|背后)",
+    )]
+    LOCAL_PATTERNS = [re.compile(pattern, re.IGNORECASE) for pattern in (
+        r"^\s*(what|who) (is|was|are) (a |an |the )?\w+(\s\w+)?\s*\??\s*$",
+        r"\b(define|definition|example|examples|steps?|step-by-step|how (do|to|can) (i|you|we)|template|specific)\b",
+        r"(是什么|什么是|定义|例子|示例|步骤|怎么|如何|模板)",
+    )]
+    
+    def __init__(self, log_path: str = GRAPHRAG_ROUTING_LOG, native: "NativeLocalSearch" = None):
+        self.log_path = log_path
+        self.native = native
+        self._lock = threading.Lock()
+        self._latencies = {}
+    
+    @staticmethod
+    def _score(patterns, query: str) -> int:
+        return sum(1 for pattern in patterns if pattern.search(query))
+    
+    def local_method(self) -> str:
+        """内置检索可用时用native（无需conda），否则用local"""
+        native = self.native or get_native_local_search()
+        return "native" if native.available() else "local"
+    
+    def specific_terms(self, query: str) -> List[str]:
+        """问题中提到的具体对象（章节、术语、专有名词）"""
+        terms = [match.group(0) for match in self.SECTION_PATTERN.finditer(query)]
+        for pattern in self.SPECIFIC_PATTERNS:
+            terms.extend(match.group(0) for match in pattern.finditer(query))
+        terms.extend(word for word in self.CAPITALIZED_WORD.findall(query) if word != "I")
+        if TokenCounter.CJK_PATTERN.search(query):
+            terms.extend(self.LATIN_TERM.findall(query))
+        return list(dict.fromkeys(terms))
+    
+    def choose(self, query: str) -> Tuple[str, str]:
+        """返回(查询方法, 决策原因)"""
+        whole_score = self._score(self.WHOLE_CORPUS_PATTERNS, query)
+        corpus_score = self._score(self.CORPUS_PATTERNS, query)
+        aggregate_score = self._score(self.AGGREGATE_PATTERNS, query)
+        drift_score = self._score(self.DRIFT_PATTERNS, query)
+        local_score = self._score(self.LOCAL_PATTERNS, query)
+        specifics = self.specific_terms(query)
+        scores = (f"whole={whole_score} corpus={corpus_score} aggregate={aggregate_score} "
+                  f"specific={len(specifics)} drift={drift_score} local={local_score}")
+        
+        # global要对所有社区报告做map-reduce：只有明确面向整个语料、或没有具体对象的概览/总结/比较才值得
+        if whole_score and not self.SECTION_PATTERN.search(query):
+            return "global", f"需要全局概览（{scores}）"
+        if not specifics and (corpus_score > local_score or (aggregate_score and not local_score)):
+            return "global", f"没有具体对象的概览、总结或比较（{scores}）"
+        if drift_score and drift_score >= local_score:
+            return "drift", f"探索演变、关联或影响（{scores}）"
+        if specifics:
+            return self.local_method(), f"具体问题，涉及 {'、'.join(specifics[:3])}（{scores}）"
+        return self.local_method(), f"具体问题（{scores}）"
+    
+    def record(self, query: str, method: str, reason: str, latency: float, status: str):
+        """记录一次auto决策、查询状态及实际耗时；取消和超时的查询不计入平均耗时"""
+        entry = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "query": query,
+            "method": method,
+            "reason": reason,
+            "latency_seconds": round(latency, 3),
+            "status": status,
+        }
+        print(f"GraphRAG auto路由: {method}（{status}），用时 {latency:.1f}s，{reason}")
+        with self._lock:
+            if status not in (GRAPHRAG_STATUS_CANCELLED, GRAPHRAG_STATUS_TIMEOUT):
+                self._latencies.setdefault(method, []).append(latency)
+            try:
+                os.makedirs(os.path.dirname(self.log_path) or ".", exist_ok=True)
+                with open(self.log_path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            except OSError as e:
+                print(f"写入路由记录失败: {e}")
+    
+    def stats(self) -> dict:
+        """本次运行中各方法的次数和平均耗时"""
+        with self._lock:
+            return {method: {"count": len(values), "avg_latency_seconds": sum(values) / len(values)}
+                    for method, values in self._latencies.items()}
+
+_graphrag_method_router = None
+_graphrag_method_router_lock = threading.Lock()
+
+def get_graphrag_method_router() -> GraphRAGMethodRouter:
+    """获取全局共享的auto查询方法路由"""
+    global _graphrag_method_router
+    if _graphrag_method_router is None:
+        with _graphrag_method_router_lock:
+            if _graphrag_method_router is None:
+                _graphrag_method_router = GraphRAGMethodRouter()
+    return _graphrag_method_router
+
+class TranslationMemory:
+    """段落级翻译记忆
+
+    以原文的哈希精确查找译文；近似匹配时只规范化空白并把数字视为占位符后查找，数字不同时按顺序
+    替换成当前原文中的数字。大小写和Markdown标记会原样出现在译文中（标题、粗体、英文术语），
+    因此不参与规范化。译文保存在DiskCache中，重启后仍然有效，按LRU淘汰。
+    """
+    
+    NUMBER = re.compile(r'\d+(?:[.,]\d+)*')
+    WHITESPACE = re.compile(r'\s+')
+    
+    def __init__(self, cache: DiskCache, model: str = "", prompt: str = "", near_match: bool = TRANSLATION_MEMORY_NEAR_MATCH):
+        self.cache = cache
+        self.near_match = near_match
+        # 模型或提示词变化后旧译文不再命中
+        self.namespace = hashlib.sha256(f"{model}\n{prompt}".encode("utf-8")).hexdigest()[:16]
+        self._lock = threading.Lock()
+        self.exact_hits = 0
+        self.near_hits = 0
+        self.misses = 0
+    
+    def normalize(self, text: str) -> str:
+        text = self.NUMBER.sub("0", text)
+        return self.WHITESPACE.sub(" ", text).strip()
+    
+    def _exact_key(self, text: str) -> str:
+        return self.cache.make_key("translation", self.namespace, text.strip())
+    
+    def _near_key(self, text: str) -> str:
+        return self.cache.make_key("translation_near", self.namespace, self.normalize(text))
+    
+    def _adapt_numbers(self, source: str, translation: str, text: str):
+        """把缓存译文中的数字换成当前原文的数字；无法一一对应时返回None"""
+        old_numbers = self.NUMBER.findall(source)
+        new_numbers = self.NUMBER.findall(text)
+        if old_numbers == new_numbers:
+            return translation
+        if len(old_numbers) != len(new_numbers):
+            return None
+        parts = []
+        position = 0
+        for old, new in zip(old_numbers, new_numbers):
+            index = translation.find(old, position)
+            if index < 0:
+                return None
+            parts.append(translation[position:index] + new)
+            position = index + len(old)
+        return "".join(parts) + translation[position:]
+    
+    def lookup(self, text: str, near: bool = True):
+        """返回已有的译文，没有时返回None；near为False时只做精确查找"""
+        translation = None
+        entry = self.cache.get(self._exact_key(text))
+        if entry is not None:
+            translation = entry["translation"]
+            kind = "exact"
+        elif self.near_match and near:
+            entry = self.cache.get(self._near_key(text))
+            if entry is not None:
+                translation = self._adapt_numbers(entry["source"], entry["translation"], text)
+                kind = "near"
+        with self._lock:
+            if translation is None:
+                self.misses += 1
+            elif kind == "exact":
+                self.exact_hits += 1
+            else:
+                self.near_hits += 1
+        return translation
+    
+    def store(self, text: str, translation: str, near: bool = True):
+        """保存一段原文的译文；near为False时只供精确查找"""
+        if not text.strip() or not translation.strip():
+            return
+        entry = {"source": text.strip(), "translation": translation}
+        self.cache.set(self._exact_key(text), entry)
+        if self.near_match and near:
+            self.cache.set(self._near_key(text), entry)
+    
+    def stats(self) -> dict:
+        with self._lock:
+            return {"exact_hits": self.exact_hits, "near_hits": self.near_hits, "misses": self.misses,
+                    **{f"cache_{name}": value for name, value in self.cache.stats().items()}}
+
+class ChunkedTranslator:
+    """分段并行翻译
+
+    在章节标题和段落处切分原文（超长段落再按句子切分），先从翻译记忆中取已有的译文，
+    其余同一章节内相邻的段落合并成不超过segment_chars的批次，多批同时交给Ollama翻译，
+    按原文顺序逐段输出，段间保留原来的空行。长文本不会因单个请求超时而整体失败，
+    用户也不必等全部译完才看到结果；译完的段落自动写入翻译记忆。
+    """
+    
+    # 章节开头：Markdown标题、===== 标记或单独一行的粗体标题
+    SECTION_BREAK = re.compile(r'\n\s*\n(?=[ \t]*(?:#{1,6}\s|=====|\*\*[^\n*]+\*\*[ \t]*\n))')
+    PARAGRAPH_BREAK = IncrementalSplitter.PARAGRAPH_BREAK
+    
+    PROMPT = (
+        "You are a professional translator. Please translate the following English text to Chinese. "
+        "The text may be one part of a longer document.\n"
+        "Requirements:\n"
+        "1. Maintain the original structure and formatting, including the blank lines between paragraphs\n"
+        "2. Ensure the translation is natural and fluent in Chinese\n"
+        "3. Keep any special formatting, numbers, and section headers\n"
+        "4. Use appropriate Chinese punctuation\n"
+        "5. Preserve any technical terms with both English and Chinese translations when necessary\n"
+        "6. Output only the Chinese translation, without explanations or the original text\n\n"
+        "Original text:\n{text}\n\n"
+        "Chinese translation:"
+    )
+    
+    def __init__(self, client: OllamaClient = None, segment_chars: int = TRANSLATION_SEGMENT_CHARS,
+                 max_workers: int = TRANSLATION_WORKERS, memory: TranslationMemory = None):
+        self.client = client or OllamaClient()
+        self.segment_chars = max(200, segment_chars)
+        self.max_workers = max(1, max_workers)
+        self.memory = memory
+    
+    def segment_spans(self, text: str) -> List[Tuple[int, int, int]]:
+        """各段落在原文中的(起点, 终点, 所属章节序号)；超长段落按句子切分"""
+        spans = []
+        section_start = 0
+        for section_index, match in enumerate([*self.SECTION_BREAK.finditer(text), None]):
+            section_end = match.start() if match else len(text)
+            paragraph_start = section_start
+            for paragraph in [*self.PARAGRAPH_BREAK.finditer(text, section_start, section_end), None]:
+                paragraph_end = paragraph.start() if paragraph else section_end
+                if text[paragraph_start:paragraph_end].strip():
+                    spans.extend((paragraph_start + start, paragraph_start + end, section_index)
+                                 for start, end in TextSplitter.split_spans(text[paragraph_start:paragraph_end], self.segment_chars))
+                if paragraph:
+                    paragraph_start = paragraph.end()
+            if match:
+                section_start = match.end()
+        return spans
+    
+    def batches(self, spans: List[Tuple[int, int, int]], cached: list) -> List[Tuple[int, int]]:
+        """把翻译记忆中没有的相邻段落（同一章节内）合并成批，返回各批的(首段序号, 末段序号+1)"""
+        batches = []
+        for index, (start, end, section) in enumerate(spans):
+            if cached[index] is not None:
+                continue
+            if batches:
+                first, last = batches[-1]
+                if (last == index and spans[first][2] == section
+                        and end - spans[first][0] <= self.segment_chars):
+                    batches[-1] = (first, index + 1)
+                    continue
+            batches.append((index, index + 1))
+        return batches
+    
+    def translate_segment(self, segment: str, user: str = None, stop: threading.Event = None) -> Tuple[str, bool]:
+        """翻译一段，返回(译文, 是否成功)；失败时保留原文并注明原因"""
+        output = ""
+        for part in self.client.generate_stream(self.PROMPT.format(text=segment), "", PRIORITY_INTERACTIVE, user):
+            if stop is not None and stop.is_set():
+                return output, False
+            output += part
+        translated = output.strip()
+        if not translated or translated.startswith(OLLAMA_ERROR_PREFIXES):
+            return f"{segment}\n（本段翻译失败：{translated or '没有返回内容'}）", False
+        return translated, True
+    
+    def translate_batch(self, text: str, spans: List[Tuple[int, int, int]], user: str = None,
+                        stop: threading.Event = None) -> str:
+        """翻译相邻的几段；译文段落数与原文一致时逐段写入翻译记忆
+
+        整批只做精确匹配：多段合起来近似匹配时，各段的差异会被一并忽略。
+        """
+        source = text[spans[0][0]:spans[-1][1]]
+        if self.memory is not None and len(spans) > 1:
+            cached = self.memory.lookup(source, near=False)
+            if cached is not None:
+                return cached
+        translated, succeeded = self.translate_segment(source, user, stop)
+        if succeeded and self.memory is not None:
+            self.memory.store(source, translated, near=len(spans) == 1)
+            paragraphs = [part for part in self.PARAGRAPH_BREAK.split(translated) if part.strip()]
+            if len(spans) > 1 and len(paragraphs) == len(spans):
+                for (start, end, _section), paragraph in zip(spans, paragraphs):
+                    self.memory.store(text[start:end], paragraph)
+        return translated
+    
+    def translate_stream(self, text: str, user: str = None) -> Generator[Tuple[str, int, int], None, None]:
+        """逐段返回(目前为止的译文, 已完成段数, 总段数)；生成器关闭时取消尚未开始的批次"""
+        spans = self.segment_spans(text)
+        if not spans:
+            return
+        cached = [self.memory.lookup(text[start:end]) if self.memory is not None else None for start, end, _ in spans]
+        batches = self.batches(spans, cached)
+        stop = threading.Event()
+        executor = ThreadPoolExecutor(max_workers=max(1, min(self.max_workers, len(batches))))
+        try:
+            futures = {first: (last, executor.submit(self.translate_batch, text, spans[first:last], user, stop))
+                       for first, last in batches}
+            output = ""
+            index = 0
+            while index < len(spans):
+                if index:
+                    # 段间沿用原文的分隔（空行或空格）
+                    output += text[spans[index - 1][1]:spans[index][0]] or "\n\n"
+                if index in futures:
+                    last, future = futures[index]
+                    output += future.result()
+                    index = last
+                else:
+                    output += cached[index]
+                    index += 1
+                    # 连续命中的段落一起输出
+                    if index < len(spans) and index not in futures:
+                        continue
+                yield output, index, len(spans)
+        finally:
+            stop.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+
+_chunked_translator = None
+_chunked_translator_lock = threading.Lock()
+
+def get_chunked_translator() -> ChunkedTranslator:
+    """获取全局共享的分段翻译器"""
+    global _chunked_translator
+    if _chunked_translator is None:
+        with _chunked_translator_lock:
+            if _chunked_translator is None:
+                client = OllamaClient()
+                memory = TranslationMemory(
+                    DiskCache(os.path.join(APP_CACHE_DIR, "translation"), TRANSLATION_MEMORY_MAX_MB * 1024 * 1024),
+                    model=client.model,
+                    prompt=ChunkedTranslator.PROMPT,
+                )
+                _chunked_translator = ChunkedTranslator(client, memory=memory)
+    return _chunked_translator
 
 def create_course_introduction_interface():
     """创建课程说明界面"""
@@ -965,23 +3438,24 @@ def create_prompt_writing_interface():
     """创建提示词写作界面"""
     enhancer = PromptEnhancer()
     
-    def enhance_prompt_func(original_prompt, method, progress=gr.Progress()):
+    async def enhance_prompt_func(original_prompt, method, request: gr.Request = None):
         if not original_prompt.strip():
-            return "请输入要优化的提示词"
-        
-        progress(0.1, desc=f"正在使用{method}优化提示词...")
+            yield "请输入要优化的提示词"
+            return
         
         try:
+            # 边生成边显示，界面刷新按时间/字节数合并
             result = ""
-            for response_part in enhancer.enhance_prompt(original_prompt, method):
+            coalescer = UpdateCoalescer()
+            async for response_part in enhancer.enhance_prompt_stream(original_prompt, method, request_user(request)):
                 result += response_part
-                progress(0.5, desc=f"正在生成优化结果...")
-            
-            progress(1.0, desc="优化完成!")
-            return result
+                if coalescer.add(response_part):
+                    yield result
+            if coalescer.pending or not result:
+                yield result
             
         except Exception as e:
-            return f"优化错误: {str(e)}"
+            yield f"优化错误: {str(e)}"
     
     with gr.Column() as interface:
         gr.Markdown("## ✍️ 提示词写作优化")
@@ -1052,16 +3526,18 @@ def create_rag_interface():
     """创建RAG文档分析界面"""
     analyzer = DocumentAnalyzer()
     
-    def process_single_task(file, task_name, thinking_mode, progress=gr.Progress()):
+    async def process_single_task(file, task_name, thinking_mode, merge_results=True, progress=gr.Progress(), request: gr.Request = None):
         if file is None:
             return "请上传文件", "", None
         
         try:
-            def update_progress(message):
-                progress(0.1, desc=message)
+            def update_progress(fraction, message):
+                # 分析占总进度的5%~90%，之后是生成输出文档
+                progress(0.05 + 0.85 * fraction, desc=message)
             
             # 分析单个任务
-            results = analyzer.analyze_single_task(file.name, task_name, thinking_mode, update_progress)
+            with ollama_request_context(PRIORITY_SINGLE_TASK, request_user(request)):
+                results = await analyzer.analyze_single_task_async(file.name, task_name, thinking_mode, update_progress, merge_results)
             
             if "error" in results:
                 return results["error"], "", None
@@ -1083,21 +3559,27 @@ def create_rag_interface():
                     display_text += result
             
             progress(1.0, desc="完成!")
-            return "分析完成!", display_text, output_file
+            return f"分析完成! ({analyzer.cache_summary()}；{get_ollama_scheduler().summary()})", display_text, output_file
             
         except Exception as e:
             return f"处理错误: {str(e)}", "", None
     
-    def process_all_tasks(file, thinking_mode, progress=gr.Progress()):
+    async def process_all_tasks(file, thinking_mode, merge_results=True, progress=gr.Progress(), request: gr.Request = None):
         if file is None:
             return "请上传文件", "", None
         
         try:
-            def update_progress(message):
-                progress(0.1, desc=message)
+            def update_progress(fraction, message):
+                # 分析占总进度的5%~90%，之后是生成输出文档
+                progress(0.05 + 0.85 * fraction, desc=message)
             
-            # 分析所有任务
-            results = analyzer.analyze_document(file.name, thinking_mode, update_progress)
+            # 分析所有任务：批量请求，优先级低于对话和单个任务；同时进行的综合分析数受事件限制
+            progress(0.0, desc="排队等待中...")
+            async with get_event_limiter("process_all_tasks").aslot(request_user(request)) as admitted:
+                if not admitted:
+                    return get_event_limiter("process_all_tasks").busy_message(), "", None
+                with ollama_request_context(PRIORITY_BULK, request_user(request)):
+                    results = await analyzer.analyze_document_async(file.name, thinking_mode, update_progress, merge_results)
             
             if "error" in results:
                 return results["error"], "", None
@@ -1123,11 +3605,17 @@ def create_rag_interface():
                 display_text += "\n\n"
             
             progress(1.0, desc="完成!")
-            return "分析完成!", display_text, output_file
+            return f"分析完成! ({analyzer.cache_summary()}；{get_ollama_scheduler().summary()})", display_text, output_file
             
         except Exception as e:
             return f"处理错误: {str(e)}", "", None
     
+    def create_task_handler(task_name):
+        """为单独任务按钮创建异步处理函数"""
+        async def handler(file, mode, merge_results, progress=gr.Progress(), request: gr.Request = None):
+            return await process_single_task(file, task_name, mode, merge_results, progress, request)
+        return handler
+    
     # 创建界面
     with gr.Blocks() as interface:
         gr.Markdown("# 📄 RAG文档智能分析")
@@ -1173,6 +3661,12 @@ def create_rag_interface():
                     info="不同的思维模式会影响AI的分析方式和深度"
                 )
                 
+                merge_results = gr.Checkbox(
+                    label="🔗 汇总为一份报告",
+                    value=True,
+                    info="长文档先逐块分析，再分轮并行合并，每个任务只输出一份结果"
+                )
+                
                 gr.Markdown("### 选择分析任务")
                 
                 # 单独任务按钮
@@ -1205,40 +3699,42 @@ def create_rag_interface():
         
         # 绑定事件 - 单独任务
         study_btn.click(
-            fn=lambda file, mode, progress=gr.Progress(): process_single_task(file, "学习指南", mode, progress),
-            inputs=[file_input, thinking_mode],
+            fn=create_task_handler("学习指南"),
+            inputs=[file_input, thinking_mode, merge_results],
             outputs=[status_output, result_output, download_file]
         )
         
         brief_btn.click(
-            fn=lambda file, mode, progress=gr.Progress(): process_single_task(file, "简报文件", mode, progress),
-            inputs=[file_input, thinking_mode],
+            fn=create_task_handler("简报文件"),
+            inputs=[file_input, thinking_mode, merge_results],
             outputs=[status_output, result_output, download_file]
         )
         
         faq_btn.click(
-            fn=lambda file, mode, progress=gr.Progress(): process_single_task(file, "FAQ文档", mode, progress),
-            inputs=[file_input, thinking_mode],
+            fn=create_task_handler("FAQ文档"),
+            inputs=[file_input, thinking_mode, merge_results],
             outputs=[status_output, result_output, download_file]
         )
         
         timeline_btn.click(
-            fn=lambda file, mode, progress=gr.Progress(): process_single_task(file, "时间线", mode, progress),
-            inputs=[file_input, thinking_mode],
+            fn=create_task_handler("时间线"),
+            inputs=[file_input, thinking_mode, merge_results],
             outputs=[status_output, result_output, download_file]
         )
         
         dialogue_btn.click(
-            fn=lambda file, mode, progress=gr.Progress(): process_single_task(file, "对话", mode, progress),
-            inputs=[file_input, thinking_mode],
+            fn=create_task_handler("对话"),
+            inputs=[file_input, thinking_mode, merge_results],
             outputs=[status_output, result_output, download_file]
         )
         
         # 绑定事件 - 综合分析
         all_btn.click(
             fn=process_all_tasks,
-            inputs=[file_input, thinking_mode],
-            outputs=[status_output, result_output, download_file]
+            inputs=[file_input, thinking_mode, merge_results],
+            outputs=[status_output, result_output, download_file],
+            # 并发和排队由get_event_limiter("process_all_tasks")控制，超出时直接提示繁忙
+            concurrency_limit=None
         )
         
         # 添加说明
@@ -1255,6 +3751,7 @@ def create_rag_interface():
         3. **分析模式**: 
            - **单独任务**: 选择特定分析类型，快速完成
            - **综合分析**: 一次性完成所有5种分析
+           - **汇总为一份报告**: 勾选时多部分文档的结果会分轮合并为一份；取消勾选则按"第 N 部分"分别输出
         4. **分析内容**: 
            - 📚 学习指南（总结、理解问题、分析问题、术语表）
            - 📊 简报文件（主要主题、关键见解、实用建议）
@@ -1263,8 +3760,19 @@ def create_rag_interface():
            - 💬 对话格式（播客风格讨论）
         
         ## ⚙️ 技术要求
-        - 确保Ollama服务运行在 `localhost:11434`
+        - 确保Ollama服务运行在 `localhost:11434`（可通过环境变量 `OLLAMA_BASE_URL` 修改）
         - 需要安装 `gemma3:4b` 模型: `ollama pull gemma3:4b`
+        - 文本块会并发发送给Ollama，并发数由环境变量 `OLLAMA_MAX_CONCURRENCY` 控制（默认4），服务端需相应设置 `OLLAMA_NUM_PARALLEL`
+        - 所有请求经统一调度：对话/提示词优化/翻译优先，其次是单个任务，最后是综合分析；同一优先级内各用户轮流。后台任务共用 `OLLAMA_SCHEDULER_SLOTS` 个并发名额，另有 `OLLAMA_INTERACTIVE_SLOTS` 个（默认1）只留给对话等交互请求；分析完成后状态栏会显示各优先级的排队数和平均等待时间
+        - 多台Ollama服务器可通过 `OLLAMA_BACKENDS`（逗号分隔的地址）共同分担请求，每个请求发往在途请求最少的节点；故障节点暂时移出，每隔 `OLLAMA_HEALTH_CHECK_INTERVAL` 秒检查一次，恢复后自动加入
+        - 分析结果按(模型, 提示词, 文本块, 生成参数)缓存在 `./cache/analysis`，重复分析同一文档会直接返回；容量由 `ANALYSIS_CACHE_MAX_MB` 控制
+        - 提取的文本按文件内容哈希缓存在 `./cache/extraction`，同一文档切换任务时无需重新解析；容量由 `EXTRACTION_CACHE_MAX_MB` 控制
+        - 页数较多的PDF会用多进程并行提取，进程数由 `PDF_EXTRACT_WORKERS` 控制，单页失败时仅该页改用PyPDF2
+        - 文档边提取边分析：每凑满一个文本块就立即发送给模型，无需等待整份文档解析完成
+        - 文本块按token预算切分：提示词+文本块+预留输出不超过 `OLLAMA_NUM_CTX`（默认4096），预留输出由 `OLLAMA_RESPONSE_RESERVE` 控制（同时作为每次生成的输出上限num_predict），块间重叠由 `CHUNK_OVERLAP_TOKENS` 控制
+        - 进度条按已完成的(任务, 文本块)请求数显示实际进度，刷新频率由 `PROGRESS_MAX_RATE`（每秒次数，默认4）限制
+        - 汇总模式下每轮最多合并 `REDUCE_FAN_IN`（默认4）份部分结果，同一轮的合并请求并发执行
+        - 依次在段落、句子（支持。！？；等中文标点）、换行处切分，耗时与文本长度成线性关系，可运行 `python benchmarks/bench_text_splitter.py` 验证
         
         ## 🧪 实验建议
         对同一文档尝试不同思维模式，比较分析质量和深度的差异！
@@ -1948,44 +4456,53 @@ def create_ollama_chat_interface():
         "openthinker:32b"
     ]
     
-    def chat_with_ollama(message, model_name, history, progress=gr.Progress()):
+    async def chat_with_ollama(message, model_name, history, request: gr.Request = None):
         if not message.strip():
-            return history, ""
+            yield history, ""
+            return
         
         # 创建临时的Ollama客户端，使用选定的模型
-        temp_client = OllamaClient()
+        temp_client = AsyncOllamaClient()
         temp_client.model = model_name
         
+        if history is None:
+            history = []
+        
+        # 构建对话历史上下文
+        context = ""
+        for user_msg, bot_msg in history:
+            context += f"用户: {user_msg}\n助手: {bot_msg}\n\n"
+        context += f"用户: {message}\n助手: "
+        
+        # 先显示用户消息并清空输入框，再边生成边更新回答
+        history.append((message, ""))
+        yield history, ""
+        
         try:
-            progress(0.1, desc=f"正在使用 {model_name} 处理您的问题...")
-            
-            # 构建对话历史上下文
-            context = ""
-            if history:
-                for user_msg, bot_msg in history:
-                    context += f"用户: {user_msg}\n助手: {bot_msg}\n\n"
-            context += f"用户: {message}\n助手: "
-            
-            # 获取模型响应
-            response = ""
-            for response_part in temp_client.generate_stream(message):
-                response += response_part
-                progress(0.5, desc=f"正在生成回答...")
-            
-            # 更新对话历史
-            if history is None:
-                history = []
-            history.append((message, response))
-            
-            progress(1.0, desc="完成!")
-            return history, ""
+            limiter = get_event_limiter("chat_with_ollama")
+            async with limiter.aslot(request_user(request)) as admitted:
+                if not admitted:
+                    history[-1] = (message, limiter.busy_message())
+                    yield history, ""
+                    return
+                
+                response = ""
+                coalescer = UpdateCoalescer()
+                # 对话为交互请求，优先于文档分析调度
+                async for response_part in temp_client.agenerate_stream(message, priority=PRIORITY_INTERACTIVE, user=request_user(request)):
+                    response += response_part
+                    if coalescer.add(response_part):
+                        history[-1] = (message, response)
+                        yield history, ""
+                
+                if coalescer.pending:
+                    history[-1] = (message, response)
+                    yield history, ""
             
         except Exception as e:
             error_msg = f"错误: {str(e)}"
-            if history is None:
-                history = []
-            history.append((message, error_msg))
-            return history, ""
+            history[-1] = (message, error_msg)
+            yield history, ""
     
     def clear_history():
         return [], ""
@@ -2082,13 +4599,15 @@ def create_ollama_chat_interface():
         msg_input.submit(
             fn=chat_with_ollama,
             inputs=[msg_input, model_selector, chatbot],
-            outputs=[chatbot, msg_input]
+            outputs=[chatbot, msg_input],
+            concurrency_limit=None
         )
         
         send_btn.click(
             fn=chat_with_ollama,
             inputs=[msg_input, model_selector, chatbot],
-            outputs=[chatbot, msg_input]
+            outputs=[chatbot, msg_input],
+            concurrency_limit=None
         )
         
         clear_btn.click(
@@ -2113,6 +4632,7 @@ def create_ollama_chat_interface():
         - ⏱️ 大模型响应时间较长，请耐心等待
         - 💾 对话历史会在当前会话中保持，切换模型不会清空
         - 🔄 支持上下文理解，可以进行连续对话
+        - 📡 回答边生成边显示，界面刷新按 `UI_STREAM_INTERVAL`（秒）或 `UI_STREAM_MAX_BYTES`（字节）合并推送
         """)
     
     return interface
@@ -2406,9 +4926,9 @@ def create_graphrag_interface():
     """创建GraphRAG查询界面"""
     
     # 定义虚拟环境和 GraphRag 命令路径
-    CONDA_ENV = "graphrag-0.50"
+    CONDA_ENV = GRAPHRAG_CONDA_ENV
     GRAPH_RAG_COMMAND = "graphrag query"
-    ROOT_PATH = "./ragtest"
+    ROOT_PATH = GRAPHRAG_ROOT
 
     def format_response(text):
         """
@@ -2434,53 +4954,21 @@ def create_graphrag_interface():
         
         return formatted_text.strip()
 
-    def translate_to_chinese(text):
+    def translate_to_chinese(text, session=None):
         """
-        Translate the refined result to Chinese
+        Translate the result to Chinese segment by segment, yielding (translated so far, segments done, total segments)
         """
         if not text or not isinstance(text, str):
-            return "输入文本无效"
-
+            yield "输入文本无效", 0, 0
+            return
+        
         try:
-            url = "http://localhost:11434/api/generate"
-            headers = {"Content-Type": "application/json"}
-            
-            prompt = (
-                "You are a professional translator. Please translate the following English text to Chinese. "
-                "Requirements:\n"
-                "1. Maintain the original structure and formatting\n"
-                "2. Ensure the translation is natural and fluent in Chinese\n"
-                "3. Keep any special formatting, numbers, and section headers\n"
-                "4. Use appropriate Chinese punctuation and please provide a high-quality Chinese translation.\n"
-                "5. Preserve any technical terms with both English and Chinese translations when necessary\n\n"
-                f"Original text:\n{text}\n\n"
-                "Please translate:"
-            )
-            
-            data = {
-                "model": "gemma3:12b",
-                "prompt": prompt,
-                "stream": False,
-                "temperature": 0.7,
-                "max_tokens": 8000,
-                "top_p": 0.95
-            }
-            
-            response = requests.post(url, headers=headers, json=data, timeout=120)
-            
-            if response.status_code == 200:
-                result = response.json()
-                translated = result.get("response", "翻译失败")
-                return format_response(translated)
-            else:
-                return f"请求失败（状态码: {response.status_code}）"
-                
-        except requests.exceptions.Timeout:
-            return "翻译请求超时，请重试"
+            for translated, done, total in get_chunked_translator().translate_stream(text, session):
+                yield format_response(translated), done, total
         except requests.exceptions.ConnectionError:
-            return "无法连接到Ollama服务，请确保服务正在运行"
+            yield "无法连接到Ollama服务，请确保服务正在运行", 0, 0
         except Exception as e:
-            return f"翻译错误：{str(e)}"
+            yield f"翻译错误：{str(e)}", 0, 0
 
     def refine_result_with_glm4(text):
         """
@@ -2490,7 +4978,6 @@ def create_graphrag_interface():
             return "输入文本无效"
         
         try:
-            url = "http://localhost:11434/api/generate"
             headers = {"Content-Type": "application/json"}
             
             prompt = (
@@ -2514,7 +5001,9 @@ def create_graphrag_interface():
                 "frequency_penalty": 0.5
             }
             
-            response = requests.post(url, headers=headers, json=data, timeout=120)
+            # 与对话同属交互请求，不必排在文档分析之后
+            with get_ollama_scheduler().slot(PRIORITY_INTERACTIVE):
+                response = get_ollama_router().post("/api/generate", headers=headers, json=data)
             
             if response.status_code == 200:
                 result = response.json()
@@ -2531,23 +5020,144 @@ def create_graphrag_interface():
             return f"优化错误：{str(e)}"
 
     def graphrag_query(query, method):
-        """Execute GraphRag query"""
+        """Execute GraphRag query and return the final result"""
+        result = ""
+        for result in graphrag_query_stream(query, method):
+            pass
+        return result
+    
+    def graphrag_query_stream(query, method, session=None):
+        """执行GraphRAG查询，逐步返回目前为止的输出，最后一次为完整结果；同一索引上的重复查询直接返回缓存"""
+        for result, _status in graphrag_query_results(query, method, session):
+            yield result
+    
+    def graphrag_query_results(query, method, session=None):
+        """同graphrag_query_stream，逐步返回(目前为止的输出, 查询状态GRAPHRAG_STATUS_*)"""
         if not query.strip():
-            return "查询内容不能为空"
+            yield "查询内容不能为空", GRAPHRAG_STATUS_FAILED
+            return
+        if method == "auto":
+            for result, status, _method, _reason in auto_query_results(query, session):
+                yield result, status
+            return
+        
+        # 缓存键包含索引版本，重新建索引后自动失效
+        cache = get_graphrag_cache()
+        index_version = graphrag_index_version(ROOT_PATH)
+        cached = cache.get(cache.make_key("graphrag_query", query.strip(), method, index_version))
+        if cached is not None:
+            yield cached, GRAPHRAG_STATUS_OK
+            return
+        
+        result, status, used_method = "", GRAPHRAG_STATUS_FAILED, method
+        for result, status, used_method in execute_graphrag_query(query, method, session):
+            yield result, status
+        # 只缓存成功的结果，出错、取消或超时的查询下次重新执行；
+        # native不可用时改用local得到的结果记在local下，之后native可用时不会取到local的回答
+        if status == GRAPHRAG_STATUS_OK:
+            cache.set(cache.make_key("graphrag_query", query.strip(), used_method, index_version), result)
+    
+    def auto_query_results(query, session=None):
+        """auto：按问题类型选择方法执行，逐步返回(输出, 查询状态, 实际使用的方法, 决策原因)
+
+        所选方法出错时改用local；用户取消或超时则直接结束（改用local会让清空后又开始新查询、超时等待加倍）。
+        结束后记录决策、状态和总耗时。
+        """
+        router = get_graphrag_method_router()
+        method, reason = router.choose(query)
+        start = time.monotonic()
+        result, status = "", GRAPHRAG_STATUS_FAILED
         try:
-            command = (
-                f"conda run -n {CONDA_ENV} {GRAPH_RAG_COMMAND} "
-                f"--root {ROOT_PATH} --method {method} --query \"{query}\""
-            )
-            result = subprocess.check_output(command, shell=True, text=True, stderr=subprocess.STDOUT)
-            save_query_result(query, result, method)
-            return result
-        except subprocess.CalledProcessError as e:
-            error_message = f"GraphRAG查询失败:\n错误代码: {e.returncode}\n错误信息: {e.output}"
-            save_query_result(query, error_message, method)
-            return error_message
+            for result, status in graphrag_query_results(query, method, session):
+                yield result, status, method, reason
         except Exception as e:
-            return f"查询过程中发生意外错误: {str(e)}"
+            result, status = f"{method}查询出错: {str(e)}", GRAPHRAG_STATUS_FAILED
+        if status == GRAPHRAG_STATUS_FAILED and method != "local":
+            print(f"GraphRAG auto路由: {method} 失败，改用local（{result[:200]}）")
+            reason = f"{reason}；{method}失败，改用local"
+            method = "local"
+            for result, status in graphrag_query_results(query, method, session):
+                yield result, status, method, reason
+        router.record(query, method, reason, time.monotonic() - start, status)
+    
+    def execute_graphrag_query(query, method, session=None):
+        """实际执行GraphRAG查询，逐步返回(目前为止的输出, 查询状态, 实际使用的方法)，最后一项为最终结果
+
+        内置检索不可用时实际使用的方法为local。
+        """
+        if method == "native":
+            # 内置检索：在应用进程内读取索引，只调用一次Ollama
+            try:
+                output = ""
+                coalescer = UpdateCoalescer()
+                for response_part in get_native_local_search().search_stream(query, session):
+                    output += response_part
+                    if coalescer.add(response_part):
+                        yield output, GRAPHRAG_STATUS_RUNNING, method
+                result = output
+                save_query_result(query, result, method)
+                succeeded = bool(result) and not result.startswith(OLLAMA_ERROR_PREFIXES)
+                yield result, GRAPHRAG_STATUS_OK if succeeded else GRAPHRAG_STATUS_FAILED, method
+                return
+            except (OSError, RuntimeError, ValueError, KeyError) as e:
+                # 索引缺失、依赖未安装或表结构不兼容时改用local查询（常驻进程或命令行）
+                print(f"内置检索不可用，改用local查询: {str(e)}")
+                method = "local"
+        
+        if GRAPHRAG_USE_WORKER:
+            # 常驻进程已加载索引，无需每次激活conda和重新读取parquet
+            try:
+                # 分段等待并定期刷新界面，使清空、关闭页面和超时能及时结束等待并取消查询
+                start = time.monotonic()
+                reply = None
+                for reply in get_graphrag_worker().iter_query(query, method, GRAPHRAG_QUERY_TIMEOUT, session):
+                    if reply is None:
+                        yield f"⏳ 常驻进程查询中，已用时 {time.monotonic() - start:.0f} 秒...", GRAPHRAG_STATUS_RUNNING, method
+                if reply.get("cancelled"):
+                    yield "GraphRAG查询已取消", GRAPHRAG_STATUS_CANCELLED, method
+                    return
+                if reply.get("ok"):
+                    result = reply["response"]
+                else:
+                    result = f"GraphRAG查询失败:\n错误信息: {reply.get('error', '')}"
+                save_query_result(query, result, method)
+                yield result, GRAPHRAG_STATUS_OK if reply.get("ok") else GRAPHRAG_STATUS_FAILED, method
+                return
+            except TimeoutError as e:
+                yield f"GraphRAG查询超时: {str(e)}", GRAPHRAG_STATUS_TIMEOUT, method
+                return
+            except (OSError, EOFError, RuntimeError, multiprocessing.AuthenticationError) as e:
+                print(f"GraphRAG常驻进程不可用，改用命令行查询: {str(e)}")
+        
+        # 命令行查询：参数列表不经过shell，输出逐行显示，超时或取消时结束整个进程树
+        conda = os.environ.get("CONDA_EXE") or shutil.which("conda") or "conda"
+        command = [conda, "run", "-n", CONDA_ENV, "--no-capture-output", *GRAPH_RAG_COMMAND.split(),
+                   "--root", ROOT_PATH, "--method", method, "--query", query]
+        try:
+            output = ""
+            coalescer = UpdateCoalescer()
+            with GraphRAGQueryProcess(command, GRAPHRAG_QUERY_TIMEOUT, session) as process:
+                for line in process.iter_lines():
+                    output += line
+                    if coalescer.add(line):
+                        yield output, GRAPHRAG_STATUS_RUNNING, method
+            
+            result = output
+            if process.timed_out:
+                error_message = f"{result}\n\nGraphRAG查询超时：超过 {GRAPHRAG_QUERY_TIMEOUT:.0f} 秒，已终止"
+                save_query_result(query, error_message, method)
+                yield error_message, GRAPHRAG_STATUS_TIMEOUT, method
+            elif process.cancelled:
+                yield f"{result}\n\nGraphRAG查询已取消", GRAPHRAG_STATUS_CANCELLED, method
+            elif process.returncode != 0:
+                error_message = f"GraphRAG查询失败:\n错误代码: {process.returncode}\n错误信息: {result}"
+                save_query_result(query, error_message, method)
+                yield error_message, GRAPHRAG_STATUS_FAILED, method
+            else:
+                save_query_result(query, result, method)
+                yield result, GRAPHRAG_STATUS_OK, method
+        except Exception as e:
+            yield f"查询过程中发生意外错误: {str(e)}", GRAPHRAG_STATUS_FAILED, method
 
     def save_query_result(query, result, method):
         """Save query results to file"""
@@ -2623,6 +5233,20 @@ def create_graphrag_interface():
             "description": "提示词质量和性能的衡量评估方法"
         }
     ]
+    
+    def prewarm_preset_questions():
+        """在后台依次执行预设问题并写入缓存，之后点击预设按钮可立即返回结果"""
+        limiter = get_event_limiter("graphrag_query")
+        start = time.monotonic()
+        for q_data in PRESET_QUESTIONS:
+            # 与用户查询共用并发限制；队列已满时跳过，等用户点击时再查询
+            with limiter.slot() as admitted:
+                if admitted:
+                    graphrag_query(q_data["question"], q_data["method"])
+        print(f"GraphRAG预设问题预热完成，用时 {time.monotonic() - start:.1f}s ({get_graphrag_cache().stats()})")
+    
+    if GRAPHRAG_PREWARM and graphrag_index_version(ROOT_PATH):
+        threading.Thread(target=prewarm_preset_questions, daemon=True).start()
 
     # 界面构建
     with gr.Blocks() as interface:
@@ -2711,18 +5335,20 @@ def create_graphrag_interface():
                 
             with gr.Column(scale=1):
                 method_dropdown = gr.Dropdown(
-                    choices=["local", "global", "drift"],
+                    choices=["auto", "local", "global", "drift", "native"],
                     label="📊 查询方法",
-                    value="local",
+                    value="auto",
                     info="选择GraphRAG查询模式，详见下方说明"
                 )
                 
                 # 查询方法简要说明
                 gr.Markdown("""
                 <div style="background-color: #F8FAFC; padding: 10px; border-radius: 6px; margin: 5px 0; font-size: 13px;">
+                <strong>🤖 Auto:</strong> 根据问题自动选择最省时的方法（默认）<br>
                 <strong>🔍 Local:</strong> 基于本地社区的查询，适合具体问题<br>
                 <strong>🌍 Global:</strong> 全数据集查询，适合宏观分析<br>
-                <strong>🌊 Drift:</strong> 探索性查询，发现潜在关联
+                <strong>🌊 Drift:</strong> 探索性查询，发现潜在关联<br>
+                <strong>🚀 Native:</strong> 应用内置的快速本地检索，无需conda环境，几秒内返回
                 </div>
                 """)
         
@@ -2799,17 +5425,36 @@ def create_graphrag_interface():
                 )
 
         # 执行查询函数
-        def query_action(query, method, progress=gr.Progress()):
+        def query_action(query, method, progress=gr.Progress(), request: gr.Request = None):
             if not query.strip():
-                return "⚠️ 查询内容不能为空", gr.update(value="")
+                yield "⚠️ 查询内容不能为空", gr.update(value="")
+                return
             
             try:
-                progress(0.1, desc="正在执行GraphRAG查询...")
-                result = graphrag_query(query, method)
+                limiter = get_event_limiter("graphrag_query")
+                progress(0.0, desc="排队等待中...")
+                with limiter.slot(request_user(request)) as admitted:
+                    if not admitted:
+                        yield limiter.busy_message(), gr.update()
+                        return
+                    progress(0.1, desc="正在执行GraphRAG查询...")
+                    
+                    # auto：按问题类型选择最省时的方法，失败时改用local，并记录决策和耗时
+                    if method == "auto":
+                        results = auto_query_results(query, request_user(request))
+                    else:
+                        results = ((result, status, method, None)
+                                   for result, status in graphrag_query_results(query, method, request_user(request)))
+                    
+                    # 命令行查询的输出边运行边显示
+                    result, method_note = "", ""
+                    for result, _status, used_method, reason in results:
+                        method_note = f"（auto → {used_method}：{reason}）" if reason else ""
+                        yield f"⏳ GraphRAG查询执行中{method_note}...", result
                 progress(1.0, desc="查询完成!")
-                return "✅ GraphRAG查询执行完成", result
+                yield f"✅ GraphRAG查询执行完成{method_note}", result
             except Exception as e:
-                return f"❌ 查询出错: {str(e)}", ""
+                yield f"❌ 查询出错: {str(e)}", ""
         
 
         # 优化结果函数
@@ -2826,20 +5471,28 @@ def create_graphrag_interface():
                 return f"❌ 优化出错: {str(e)}", ""
         
         # 翻译结果函数
-        def translate_action(text, progress=gr.Progress()):
+        def translate_action(text, progress=gr.Progress(), request: gr.Request = None):
             if not text.strip():
-                return "⚠️ 没有可翻译的内容", gr.update(value="")
+                yield "⚠️ 没有可翻译的内容", gr.update(value="")
+                return
             
             try:
                 progress(0.1, desc="正在翻译成中文...")
-                result = translate_to_chinese(text)
+                # 各段译完即按原文顺序显示
+                result = ""
+                for result, done, total in translate_to_chinese(text, request_user(request)):
+                    if total:
+                        progress(done / total, desc=f"正在翻译成中文（{done}/{total}段）...")
+                    yield f"⏳ 正在翻译（{done}/{total}段）...", result
                 progress(1.0, desc="翻译完成!")
-                return "✅ 翻译完成", result
+                yield "✅ 翻译完成", result
             except Exception as e:
-                return f"❌ 翻译出错: {str(e)}", ""
+                yield f"❌ 翻译出错: {str(e)}", ""
         
         # 清空所有函数
-        def clear_action():
+        def clear_action(request: gr.Request = None):
+            # 结束该会话仍在运行的命令行查询和常驻进程中的查询
+            cancel_graphrag_session(request_user(request))
             return (
                 "🔄 系统已重置，准备新的查询", 
                 gr.update(value=""), 
@@ -2849,34 +5502,46 @@ def create_graphrag_interface():
             )
         
         # 事件绑定
-        query_btn.click(
+        # GraphRAG查询的并发和排队由get_event_limiter("graphrag_query")控制
+        query_event = query_btn.click(
             query_action, 
             inputs=[query_input, method_dropdown], 
-            outputs=[status_display, raw_result]
+            outputs=[status_display, raw_result],
+            concurrency_limit=None
         )
         
         # 为每个预设问题按钮绑定事件
+        preset_events = []
         for btn, question_data in preset_buttons:
             def create_preset_handler(q_data):
-                def handler(progress=gr.Progress()):
+                def handler(progress=gr.Progress(), request: gr.Request = None):
                     try:
-                        progress(0.1, desc=f"正在执行预设查询 ({q_data['method'].upper()})...")
-                        result = graphrag_query(q_data["question"], q_data["method"])
+                        limiter = get_event_limiter("graphrag_query")
+                        progress(0.0, desc="排队等待中...")
+                        with limiter.slot(request_user(request)) as admitted:
+                            if not admitted:
+                                yield limiter.busy_message(), gr.update(), gr.update(), gr.update()
+                                return
+                            progress(0.1, desc=f"正在执行预设查询 ({q_data['method'].upper()})...")
+                            result = ""
+                            for result in graphrag_query_stream(q_data["question"], q_data["method"], request_user(request)):
+                                yield "⏳ 预设问题查询执行中...", q_data["question"], q_data["method"], result
                         progress(1.0, desc="查询完成!")
-                        return (
+                        yield (
                             f"✅ 预设问题查询完成",
                             q_data["question"], 
                             q_data["method"], 
                             result
                         )
                     except Exception as e:
-                        return f"❌ 预设查询出错: {str(e)}", "", "local", ""
+                        yield f"❌ 预设查询出错: {str(e)}", "", "local", ""
                 return handler
             
-            btn.click(
+            preset_events.append(btn.click(
                 create_preset_handler(question_data),
-                outputs=[status_display, query_input, method_dropdown, raw_result]
-            )
+                outputs=[status_display, query_input, method_dropdown, raw_result],
+                concurrency_limit=None
+            ))
         
         refine_btn.click(
             refine_action, 
@@ -2890,10 +5555,12 @@ def create_graphrag_interface():
             outputs=[status_display, translated_result]
         )
         
+        # 清空时取消正在进行的查询
         clear_btn.click(
             clear_action,
             inputs=[],
-            outputs=[status_display, query_input, raw_result, refined_result, translated_result]
+            outputs=[status_display, query_input, raw_result, refined_result, translated_result],
+            cancels=[query_event, *preset_events]
         )
 
         # 系统要求和配置
@@ -2910,6 +5577,13 @@ def create_graphrag_interface():
         - ✅ GraphRAG包已正确安装
         - ✅ 数据目录: `./ragtest`
         - ✅ Ollama服务运行在localhost:11434
+        - ✅ 查询结果按(问题, 方法, 索引版本)缓存在 `./cache/graphrag`，重复查询立即返回，索引文件更新后旧结果自动失效；启动时会在后台预先查询全部预设问题（`GRAPHRAG_PREWARM=0` 可关闭）
+        - ✅ 首次查询时会在该环境中启动常驻查询进程 `graphrag_worker.py`（端口 `GRAPHRAG_WORKER_PORT`，默认8765），索引只加载一次，索引文件更新后自动重新加载；日志位于 `./cache/graphrag_worker.log`。设置 `GRAPHRAG_USE_WORKER=0` 可改回每次调用命令行
+        - ✅ 默认的 `auto` 方法按问题内容自动选择：面向全书的问题、以及没有具体对象的概览问题（整体、主要主题等）用global，探索演变和关联的问题用drift，其余（包括比较两个概念、总结某一章）用native（不可用时用local），所选方法出错时改用local（取消或超时不会）；每次选择和实际耗时记录在 `./cache/graphrag_routing.jsonl`，便于调整规则
+        - ✅ `native` 方法在应用内直接读取 `./ragtest/output` 的parquet索引（需要pandas、pyarrow），按关键词为实体、关系、原文和社区报告排序后只调用一次Ollama，适合具体的local类问题；缺少依赖、索引文件或所需的列时自动改用local查询
+        - ✅ 命令行查询的输出会实时显示在原始结果中；超过 `GRAPHRAG_QUERY_TIMEOUT` 秒（默认600）、点击清空或关闭页面时自动结束查询进程；常驻进程中的查询同样会在超时、清空或关闭页面时取消
+        - ✅ 中文翻译按章节和段落分段（每段最多 `TRANSLATION_SEGMENT_CHARS` 字符，默认1500），同时翻译 `TRANSLATION_WORKERS` 段（默认4），按原文顺序逐段显示
+        - ✅ 译过的段落保存在翻译记忆 `./cache/translation` 中（`TRANSLATION_MEMORY_MAX_MB`，默认64），重复出现的段落和章节标题直接复用译文，只有新段落才交给模型；仅空白或数字不同的段落也会复用（数字替换为新原文中的数字）（`TRANSLATION_MEMORY_NEAR_MATCH=0` 可关闭）
         
         **安装命令:**
         ```bash
@@ -3049,6 +5723,9 @@ def create_main_interface():
             with gr.TabItem("🕸️ GraphRAG"):
                 graphrag_interface = create_graphrag_interface()
         
+        # 用户关闭页面时结束其GraphRAG查询进程和常驻进程中的查询
+        demo.unload(release_graphrag_session)
+        
         # 全局说明
         gr.Markdown("""
         ---
@@ -3101,6 +5778,10 @@ def create_main_interface():
         
         ## ⚙️ 系统要求
         - Ollama服务: `http://localhost:11434`
+        - 连接池配置: `OLLAMA_POOL_SIZE`、`OLLAMA_MAX_RETRIES`、`OLLAMA_CONNECT_TIMEOUT`、`OLLAMA_READ_TIMEOUT`
+        - 多节点: `OLLAMA_BACKENDS`、`OLLAMA_HEALTH_CHECK_INTERVAL`
+        - 请求调度: `OLLAMA_SCHEDULER_SLOTS`、`OLLAMA_INTERACTIVE_SLOTS`
+        - 界面并发: 综合分析、GraphRAG查询、模型对话各自有并发数和排队长度上限，超出时立即提示繁忙。可在 `event_limits.json`（路径由 `EVENT_LIMITS_FILE` 指定）中按事件名配置，如 `{"process_all_tasks": {"concurrency_limit": 2, "max_queue": 4}}`，或用环境变量 `PROCESS_ALL_TASKS_CONCURRENCY`、`GRAPHRAG_QUERY_MAX_QUEUE`、`CHAT_WITH_OLLAMA_CONCURRENCY` 等覆盖；其他事件由 `GRADIO_DEFAULT_CONCURRENCY`、`GRADIO_QUEUE_MAX_SIZE` 控制
         - 推荐模型: `gemma3:12b` (平衡性能)
         - 启动命令: `ollama serve`
         - 模型下载: `ollama pull 模型名`
@@ -3139,6 +5820,7 @@ if __name__ == "__main__":
     
     # 启动应用
     demo = create_main_interface()
+    demo.queue(default_concurrency_limit=GRADIO_DEFAULT_CONCURRENCY, max_size=GRADIO_QUEUE_MAX_SIZE)
     demo.launch(
         server_name="127.0.0.1",
         server_port=7860,
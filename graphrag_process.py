@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+GraphRAG命令行查询的子进程管理
+
+`conda run` 会再启动一个python子进程执行 graphrag query，只结束conda进程时该子进程仍会继续运行
+（继续占用模型），Windows上还会一直占着输出管道。这里让查询进程自成一个进程组，超时或取消时
+结束整个进程树。界面（document_analyzer.py）和批量查询脚本共用。
+"""
+
+import os
+import queue
+import signal
+import subprocess
+import threading
+import time
+from typing import Generator, List
+
+def process_group_kwargs() -> dict:
+    """让子进程自成一个进程组，之后可以连同其子进程（conda run启动的python）一起结束"""
+    if os.name == "nt":
+        return {"creationflags": subprocess.CREATE_NEW_PROCESS_GROUP}
+    return {"start_new_session": True}
+
+def kill_process_tree(process: subprocess.Popen):
+    """结束进程及其所有子进程"""
+    if process.poll() is not None:
+        return
+    try:
+        if os.name == "nt":
+            subprocess.run(["taskkill", "/F", "/T", "/PID", str(process.pid)], capture_output=True)
+        else:
+            os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+        process.kill()
+    try:
+        process.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+class GraphRAGQueryProcess:
+    """以子进程运行一次 graphrag query 命令行查询，逐行读取输出
+
+    超过deadline秒（None表示不限）、调用kill()或离开with块时结束整个进程树；运行中的进程按会话登记，
+    用户清空页面或关闭页面时可通过kill_session()结束（之后cancelled为True）。merge_stderr为False时错误输出单独收集到stderr。
+    """
+
+    _active = {}
+    _active_lock = threading.Lock()
+
+    def __init__(self, command: List[str], deadline: float = None, session: str = None, merge_stderr: bool = True):
+        self.command = command
+        self.deadline = deadline
+        self.session = session
+        self.merge_stderr = merge_stderr
+        self.process = None
+        self.timed_out = False
+        self.cancelled = False
+        self._stderr_lines = []
+        self._stderr_reader = None
+
+    def __enter__(self):
+        env = dict(os.environ, PYTHONIOENCODING="utf-8")
+        self.process = subprocess.Popen(
+            self.command, stdout=subprocess.PIPE, stdin=subprocess.DEVNULL,
+            stderr=subprocess.STDOUT if self.merge_stderr else subprocess.PIPE,
+            text=True, encoding="utf-8", errors="replace", bufsize=1, env=env, **process_group_kwargs()
+        )
+        if not self.merge_stderr:
+            self._stderr_reader = threading.Thread(target=lambda: self._stderr_lines.extend(self.process.stderr), daemon=True)
+            self._stderr_reader.start()
+        with self._active_lock:
+            self._active.setdefault(self.session, set()).add(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.kill()
+        with self._active_lock:
+            processes = self._active.get(self.session)
+            if processes is not None:
+                processes.discard(self)
+                if not processes:
+                    del self._active[self.session]
+
+    @property
+    def returncode(self):
+        return self.process.returncode if self.process else None
+
+    @property
+    def stderr(self) -> str:
+        """单独收集的错误输出（进程结束后完整）"""
+        if self._stderr_reader is not None:
+            self._stderr_reader.join(timeout=5)
+        return "".join(self._stderr_lines)
+
+    def kill(self):
+        if self.process is not None:
+            kill_process_tree(self.process)
+
+    @classmethod
+    def kill_session(cls, session: str) -> int:
+        """结束某个会话的所有查询进程，返回结束的进程数"""
+        with cls._active_lock:
+            processes = list(cls._active.get(session, ()))
+        for process in processes:
+            process.cancelled = True
+            process.kill()
+        return len(processes)
+
+    def iter_lines(self) -> Generator[str, None, None]:
+        """逐行返回输出，直到进程结束或超过deadline"""
+        lines = queue.Queue()
+
+        def read_output():
+            for line in self.process.stdout:
+                lines.put(line)
+            lines.put(None)
+
+        threading.Thread(target=read_output, daemon=True).start()
+        deadline = time.monotonic() + self.deadline if self.deadline is not None else None
+        while True:
+            remaining = deadline - time.monotonic() if deadline is not None else 1.0
+            if remaining <= 0:
+                self.timed_out = True
+                self.kill()
+                return
+            try:
+                # 分段等待，以便及时发现超时
+                line = lines.get(timeout=min(remaining, 1.0))
+            except queue.Empty:
+                continue
+            if line is None:
+                break
+            yield line
+        self.process.wait()
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+GraphRAG常驻查询进程
+
+在graphrag conda环境中运行，只加载一次配置和索引（parquet文件），
+通过本地IPC通道（multiprocessing.connection）为界面提供local/global/drift查询，
+避免每次查询都重新激活conda、启动解释器、导入GraphRAG和读取索引。
+
+用法:
+    conda run -n graphrag-0.50 --no-capture-output python graphrag_worker.py --root ./ragtest --port 8765
+
+连接密钥从环境变量 GRAPHRAG_WORKER_AUTHKEY 读取。
+"""
+
+import argparse
+import asyncio
+import concurrent.futures
+import hashlib
+import inspect
+import os
+import threading
+import time
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener
+from pathlib import Path
+
+import pandas as pd
+
+# 各查询方法需要的索引表，缺少时按空值处理的表放在OPTIONAL_TABLES中
+INDEX_TABLES = [
+    "create_final_nodes",
+    "create_final_entities",
+    "create_final_communities",
+    "create_final_community_reports",
+    "create_final_text_units",
+    "create_final_relationships",
+    "create_final_covariates",
+]
+OPTIONAL_TABLES = {"create_final_communities", "create_final_covariates"}
+
+# 与 graphrag query 命令行的默认参数一致
+DEFAULT_COMMUNITY_LEVEL = 2
+DEFAULT_RESPONSE_TYPE = "Multiple Paragraphs"
+
+class GraphRAGIndex:
+    """已加载的GraphRAG配置和索引，索引文件变化时自动重新加载"""
+
+    def __init__(self, root: str):
+        self.root = Path(root).resolve()
+        self.config = None
+        self.output_dir = None
+        self.tables = {}
+        self.version = None
+        self._lock = threading.Lock()
+
+    def _load_config(self):
+        from graphrag.config.load_config import load_config
+        config = load_config(self.root, None)
+        try:
+            from graphrag.config.resolve_path import resolve_paths
+            resolve_paths(config)
+        except ImportError:
+            pass
+        output_dir = Path(config.storage.base_dir)
+        if not output_dir.is_absolute():
+            output_dir = self.root / output_dir
+        return config, output_dir
+
+    def _index_files(self, output_dir: Path) -> list:
+        # 与界面的graphrag_index_version一致，包括子目录中的parquet文件
+        return sorted(output_dir.rglob("*.parquet"))
+
+    def current_version(self, output_dir: Path = None) -> str:
+        """按各parquet文件的相对路径、大小和修改时间计算索引版本"""
+        output_dir = output_dir or self.output_dir
+        digest = hashlib.sha256()
+        for path in self._index_files(output_dir):
+            stat = path.stat()
+            digest.update(f"{path.relative_to(output_dir).as_posix()}:{stat.st_size}:{stat.st_mtime_ns}\n".encode("utf-8"))
+        return digest.hexdigest()[:16]
+
+    def load(self):
+        """读取配置和全部索引表"""
+        start = time.perf_counter()
+        config, output_dir = self._load_config()
+        version = self.current_version(output_dir)
+        tables = {}
+        for name in INDEX_TABLES:
+            path = output_dir / f"{name}.parquet"
+            if path.exists():
+                tables[name] = pd.read_parquet(path)
+            elif name not in OPTIONAL_TABLES:
+                raise FileNotFoundError(f"找不到索引文件: {path}")
+        self.config, self.output_dir, self.tables, self.version = config, output_dir, tables, version
+        print(f"✅ 已加载GraphRAG索引 {output_dir}（版本 {version}），用时 {time.perf_counter() - start:.1f}s", flush=True)
+
+    def ensure_current(self):
+        """索引文件发生变化（重新建索引）时重新加载"""
+        with self._lock:
+            if self.config is None or self.current_version() != self.version:
+                self.load()
+            return self.config, self.tables, self.version
+
+class GraphRAGWorker:
+    """在后台事件循环中执行查询，每个连接一个线程"""
+
+    def __init__(self, index: GraphRAGIndex):
+        self.index = index
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        # 进行中的查询：query_id -> Future，客户端取消或超时时通过cancel请求结束
+        self.running = {}
+        self._running_lock = threading.Lock()
+
+    def _search_function(self, method: str):
+        from graphrag import api
+        functions = {"local": api.local_search, "global": api.global_search, "drift": getattr(api, "drift_search", None)}
+        function = functions.get(method)
+        if function is None:
+            raise ValueError(f"不支持的查询方法: {method}")
+        return function
+
+    def search(self, query: str, method: str, community_level: int = DEFAULT_COMMUNITY_LEVEL,
+               response_type: str = DEFAULT_RESPONSE_TYPE, query_id: str = None) -> dict:
+        config, tables, version = self.index.ensure_current()
+        function = self._search_function(method)
+        available = {
+            "config": config,
+            "nodes": tables.get("create_final_nodes"),
+            "entities": tables.get("create_final_entities"),
+            "communities": tables.get("create_final_communities"),
+            "community_reports": tables.get("create_final_community_reports"),
+            "text_units": tables.get("create_final_text_units"),
+            "relationships": tables.get("create_final_relationships"),
+            "covariates": tables.get("create_final_covariates"),
+            "community_level": community_level,
+            "dynamic_community_selection": False,
+            "response_type": response_type,
+            "query": query,
+        }
+        # 不同GraphRAG版本的API参数略有差别，只传入该版本接受的参数
+        parameters = inspect.signature(function).parameters
+        kwargs = {name: value for name, value in available.items() if name in parameters}
+
+        start = time.perf_counter()
+        future = asyncio.run_coroutine_threadsafe(function(**kwargs), self.loop)
+        if query_id:
+            with self._running_lock:
+                self.running[query_id] = future
+        try:
+            response, _context = future.result()
+        except concurrent.futures.CancelledError:
+            return {"ok": False, "cancelled": True, "error": "查询已取消", "elapsed": time.perf_counter() - start}
+        finally:
+            if query_id:
+                with self._running_lock:
+                    self.running.pop(query_id, None)
+        return {
+            "ok": True,
+            "response": response if isinstance(response, str) else str(response),
+            "method": method,
+            "elapsed": time.perf_counter() - start,
+            "index_version": version,
+        }
+
+    def handle(self, message: dict) -> dict:
+        op = message.get("op")
+        if op == "ping":
+            _, _, version = self.index.ensure_current()
+            return {"ok": True, "pid": os.getpid(), "root": str(self.index.root), "index_version": version}
+        if op == "query":
+            return self.search(
+                message["query"],
+                message.get("method", "local"),
+                message.get("community_level", DEFAULT_COMMUNITY_LEVEL),
+                message.get("response_type", DEFAULT_RESPONSE_TYPE),
+                message.get("query_id"),
+            )
+        if op == "cancel":
+            with self._running_lock:
+                future = self.running.get(message.get("query_id"))
+            cancelled = future is not None and future.cancel()
+            if cancelled:
+                print(f"查询 {message.get('query_id')} 已取消", flush=True)
+            return {"ok": True, "cancelled": cancelled}
+        return {"ok": False, "error": f"未知的请求: {op}"}
+
+    def serve_connection(self, conn):
+        with conn:
+            try:
+                message = conn.recv()
+            except EOFError:
+                return
+            if message.get("op") == "shutdown":
+                conn.send({"ok": True})
+                print("GraphRAG常驻进程退出", flush=True)
+                os._exit(0)
+            try:
+                reply = self.handle(message)
+            except Exception as e:
+                reply = {"ok": False, "error": f"{type(e).__name__}: {str(e)}"}
+            try:
+                conn.send(reply)
+            except OSError:
+                # 客户端已断开（超时或被取消）
+                pass
+
+def main():
+    parser = argparse.ArgumentParser(description="GraphRAG常驻查询进程")
+    parser.add_argument("--root", default="./ragtest", help="GraphRAG项目目录")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    authkey = os.environ.get("GRAPHRAG_WORKER_AUTHKEY", "")
+    if not authkey:
+        print("❌ 请设置环境变量 GRAPHRAG_WORKER_AUTHKEY")
+        raise SystemExit(1)
+
+    index = GraphRAGIndex(args.root)
+    index.load()
+    worker = GraphRAGWorker(index)
+
+    with Listener((args.host, args.port), authkey=authkey.encode("utf-8")) as listener:
+        print(f"🚀 GraphRAG常驻进程已就绪: {args.host}:{args.port}", flush=True)
+        while True:
+            try:
+                conn = listener.accept()
+            except (OSError, AuthenticationError) as e:
+                # 密钥错误等握手失败不影响后续连接
+                print(f"连接被拒绝: {str(e)}", flush=True)
+                continue
+            threading.Thread(target=worker.serve_connection, args=(conn,), daemon=True).start()
+
+if __name__ == "__main__":
+    main()
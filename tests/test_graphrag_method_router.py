@@ -0,0 +1,40 @@
+"""auto查询方法路由规则"""
+
+import pytest
+
+from document_analyzer import GraphRAGMethodRouter, NativeLocalSearch
+
+CASES = [
+    # 明确面向整个语料
+    ("Give me a summary of the whole book", "global"),
+    ("How do the main themes develop across the entire book, especially RAG?", "global"),
+    ("总结全书的主要观点", "global"),
+    # 没有具体对象的概览、总结或比较
+    ("What are the main themes?", "global"),
+    ("What are the fundamental frameworks and methodologies for effective prompt engineering?", "global"),
+    ("比较不同提示词技术的区别", "global"),
+    # 概览类表述，但有具体对象或限定章节
+    ("What are the key differences between zero-shot and few-shot prompting?", "local"),
+    ("What are the main ideas in Chapter 2?", "local"),
+    ("Compare ReAct and CoT prompting", "local"),
+    ("Summarize chapter 3", "local"),
+    ("比较 few-shot 和 zero-shot 的区别", "local"),
+    ("第三章讲了什么？", "local"),
+    # 具体问题
+    ("What is a prompt template?", "local"),
+    ("What are the main steps for writing a prompt?", "local"),
+    ("Can you provide concrete examples of successful prompt templates for different AI tasks?", "local"),
+    # 演变、关联
+    ("How has prompt engineering evolved and what are the emerging trends?", "drift"),
+    ("What are the psychological and cognitive principles behind effective prompt design?", "drift"),
+]
+
+@pytest.fixture
+def router(tmp_path):
+    # 索引不存在，内置检索不可用，具体问题路由到local
+    return GraphRAGMethodRouter(str(tmp_path / "routing.jsonl"), NativeLocalSearch(str(tmp_path)))
+
+@pytest.mark.parametrize("query, expected", CASES)
+def test_choose(router, query, expected):
+    method, reason = router.choose(query)
+    assert method == expected, reason
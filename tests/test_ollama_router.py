@@ -0,0 +1,155 @@
+"""多节点Ollama路由：负载均衡、故障转移与健康检查恢复（用本地HTTP服务模拟节点）"""
+
+import json
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from document_analyzer import OllamaClient, OllamaRouter, OllamaScheduler, OllamaSession
+
+class MockOllamaHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status: int, body: bytes, content_type: str = "application/json"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.server.tags_requests += 1
+        self._reply(self.server.tags_status, b'{"models": []}')
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.server.generate_requests += 1
+        if self.server.generate_status != 200:
+            self._reply(self.server.generate_status, b'{"error": "mock"}')
+            return
+        lines = [{"response": f"{self.server.name} ", "done": False}, {"response": "ok", "done": True}]
+        self._reply(200, "".join(json.dumps(line) + "\n" for line in lines).encode("utf-8"), "application/x-ndjson")
+
+class MockOllama(ThreadingHTTPServer):
+    """一个模拟节点：/api/generate 和 /api/tags 返回可配置的状态码"""
+
+    daemon_threads = True
+
+    def __init__(self, name: str):
+        super().__init__(("127.0.0.1", 0), MockOllamaHandler)
+        self.name = name
+        self.generate_status = 200
+        self.tags_status = 200
+        self.generate_requests = 0
+        self.tags_requests = 0
+        self.url = f"http://127.0.0.1:{self.server_address[1]}"
+        threading.Thread(target=self.serve_forever, args=(0.05,), daemon=True).start()
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+@pytest.fixture
+def nodes():
+    created = [MockOllama("a"), MockOllama("b")]
+    yield created
+    for node in created:
+        node.close()
+
+@pytest.fixture
+def refused_url():
+    # 取一个空闲端口后关闭，连接该端口会被拒绝
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    return f"http://127.0.0.1:{port}"
+
+def make_router(urls, interval: float = 60.0) -> OllamaRouter:
+    # 关闭连接池自身的重试，只测路由的故障转移
+    return OllamaRouter(urls, health_check_interval=interval, session=OllamaSession(max_retries=0))
+
+def generate(router: OllamaRouter, prompt: str = "hi") -> str:
+    client = OllamaClient(router=router, session=router.session, scheduler=OllamaScheduler())
+    return "".join(client.generate_stream(prompt))
+
+def test_picks_least_loaded_node(nodes):
+    router = make_router([node.url for node in nodes])
+    busy = router.acquire()
+    assert busy.url == nodes[0].url
+    response = router.post("/api/generate", json={"prompt": "hi"})
+    router.release(busy)
+    assert response.status_code == 200
+    assert (nodes[0].generate_requests, nodes[1].generate_requests) == (0, 1)
+
+def test_prefers_lower_latency_when_load_is_equal(nodes):
+    router = make_router([node.url for node in nodes])
+    router.release(router.acquire(), 0.5)
+    router.release(router.acquire(), 0.1)
+    assert router.acquire().url == nodes[1].url
+
+def test_fails_over_on_connection_refused(nodes, refused_url):
+    router = make_router([refused_url, nodes[0].url])
+    assert router.post("/api/generate", json={"prompt": "hi"}).status_code == 200
+    stats = {item["url"]: item for item in router.stats()}
+    assert not stats[refused_url]["healthy"]
+    assert stats[nodes[0].url]["healthy"]
+    # 之后的请求不再发往故障节点
+    assert generate(router) == "a ok"
+    assert nodes[0].generate_requests == 2
+
+@pytest.mark.parametrize("status", [502, 503, 504])
+def test_fails_over_on_gateway_errors(nodes, status):
+    nodes[0].generate_status = status
+    router = make_router([node.url for node in nodes])
+    assert router.post("/api/generate", json={"prompt": "hi"}).status_code == 200
+    assert [item["healthy"] for item in router.stats()] == [False, True]
+    assert nodes[1].generate_requests == 1
+
+@pytest.mark.parametrize("status", [502, 503, 504])
+def test_stream_fails_over_on_gateway_errors(nodes, status):
+    nodes[0].generate_status = status
+    router = make_router([node.url for node in nodes])
+    assert generate(router) == "b ok"
+    assert [item["healthy"] for item in router.stats()] == [False, True]
+
+def test_plain_500_does_not_fail_over(nodes):
+    nodes[0].generate_status = 500
+    # 各用一个新路由，保证请求先发往第一个节点
+    assert make_router([node.url for node in nodes]).post("/api/generate", json={"prompt": "hi"}).status_code == 500
+    router = make_router([node.url for node in nodes])
+    assert generate(router) == "错误: HTTP 500"
+    assert [item["healthy"] for item in router.stats()] == [True, True]
+    assert nodes[1].generate_requests == 0
+
+def test_health_loop_restores_recovered_node(nodes):
+    nodes[0].generate_status = 503
+    nodes[0].tags_status = 503
+    router = make_router([node.url for node in nodes], interval=0.05)
+    assert generate(router) == "b ok"
+    assert not router.stats()[0]["healthy"]
+
+    # 仍然故障时健康检查不会放回轮换
+    deadline = time.monotonic() + 5
+    while nodes[0].tags_requests < 2 and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert nodes[0].tags_requests >= 2
+    assert not router.stats()[0]["healthy"]
+
+    nodes[0].generate_status = 200
+    nodes[0].tags_status = 200
+    deadline = time.monotonic() + 5
+    while not router.stats()[0]["healthy"] and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert router.stats()[0]["healthy"]
+    # 所有节点恢复后健康检查线程退出
+    thread = router._health_thread
+    if thread is not None:
+        thread.join(timeout=5)
+    assert router._health_thread is None
+    assert generate(router) == "a ok"
@@ -0,0 +1,48 @@
+"""汇总模式的分组与逐轮合并"""
+
+import asyncio
+
+import pytest
+
+from document_analyzer import DocumentAnalyzer, OllamaClient, ProgressDispatcher, TokenCounter
+
+BUDGET = 2429
+
+@pytest.fixture(scope="module")
+def analyzer():
+    return DocumentAnalyzer()
+
+def group_tokens(group):
+    counter = TokenCounter()
+    return sum(counter.count(f"--- 部分结果 00 ---\n{part}") for part in group)
+
+def test_groups_stay_within_budget(analyzer):
+    small = "short partial result. " * 20
+    large = "a long partial result sentence. " * 600
+    groups = analyzer._group_for_reduce([small, large, small, small], BUDGET)
+    assert all(group_tokens(group) <= BUDGET for group in groups)
+    # 超出预算的部分切成片段后仍能两两合并
+    assert any(len(group) > 1 for group in groups)
+    assert "".join(part for group in groups for part in group).count("a long partial") == 600
+
+def test_parts_that_do_not_fit_together_are_not_paired(analyzer):
+    part = "x" * int(BUDGET * 0.7 * 3.5)
+    assert analyzer._group_for_reduce([part, part], BUDGET) == [[part], [part]]
+
+def test_reduce_stops_when_nothing_can_merge(analyzer, monkeypatch):
+    calls = []
+    
+    async def fake_job(label, prompt, context, semaphore, progress):
+        calls.append(label)
+        return "merged"
+    
+    monkeypatch.setattr(analyzer, "_run_job", fake_job)
+    budget = analyzer.create_splitter([analyzer.get_reduce_prompt("task", "标准模式")]).budget
+    part = "x" * int(budget * 0.7 * 3.5)
+    result = asyncio.run(analyzer._reduce_results("task", "标准模式", [part, part], asyncio.Semaphore(2), ProgressDispatcher()))
+    assert calls == []
+    assert result[:2] == [part, part] and "未完全合并" in result[2]
+
+def test_payload_caps_output_tokens():
+    client = OllamaClient()
+    assert client.build_payload("prompt")["options"]["num_predict"] == client.num_predict
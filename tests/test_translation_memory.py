@@ -0,0 +1,44 @@
+"""翻译记忆的精确和近似匹配"""
+
+import re
+
+import pytest
+
+from document_analyzer import ChunkedTranslator, DiskCache, TranslationMemory
+
+class FakeClient:
+    """把每段原文"翻译"成 ZH[原文]，并记录收到的原文"""
+    model = "fake"
+    
+    def __init__(self):
+        self.sources = []
+    
+    def generate_stream(self, prompt, context="", priority=None, user=None):
+        source = prompt.split("Original text:\n", 1)[1].rsplit("\n\nChinese translation:", 1)[0]
+        self.sources.append(source)
+        yield "\n\n".join(f"ZH[{part}]" for part in re.split(r"\n\s*\n\s*", source))
+
+@pytest.fixture
+def memory(tmp_path):
+    return TranslationMemory(DiskCache(str(tmp_path), 10 ** 7), "fake", ChunkedTranslator.PROMPT)
+
+def test_near_match_adapts_numbers_and_whitespace(memory):
+    memory.store("Step 3 takes  10 minutes.", "第3步需要10分钟。")
+    assert memory.lookup("Step 4 takes 15 minutes.") == "第4步需要15分钟。"
+    assert memory.stats()["near_hits"] == 1
+
+def test_near_match_keeps_markup_and_case(memory):
+    memory.store("## Summary", "## 总结")
+    assert memory.lookup("**Summary**") is None
+    memory.store("more", "更多")
+    assert memory.lookup("More") is None
+
+def test_batches_are_not_near_matched(memory):
+    client = FakeClient()
+    translator = ChunkedTranslator(client, segment_chars=300, max_workers=1, memory=memory)
+    *_, (first, _, _) = translator.translate_stream("Intro more\n\nsee More")
+    client.sources.clear()
+    *_, (second, _, _) = translator.translate_stream("Intro More\n\nsee more")
+    assert first == "ZH[Intro more]\n\nZH[see More]"
+    assert second == "ZH[Intro More]\n\nZH[see more]"
+    assert client.sources == ["Intro More\n\nsee more"]
@@ -6,8 +6,14 @@ GraphRAG 图书可视化和智能查询系统
 """
 
 import os
+import sys
 import json
+import time
+import shutil
+import argparse
+import threading
 import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
 import pandas as pd
 import networkx as nx
 import matplotlib.pyplot as plt
@@ -20,6 +26,10 @@ from datetime import datetime
 import warnings
 warnings.filterwarnings('ignore')
 
+# 与界面共用命令行查询的进程管理（位于仓库根目录）
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from graphrag_process import GraphRAGQueryProcess
+
 # 设置中文字体
 plt.rcParams['font.sans-serif'] = ['SimHei', 'Microsoft YaHei']
 plt.rcParams['axes.unicode_minus'] = False
@@ -244,8 +254,9 @@ class GraphRAGVisualizer:
 class PromptWritingQueryGenerator:
     """提示词写作深度查询生成器"""
     
-    def __init__(self, ragtest_path):
+    def __init__(self, ragtest_path, conda_env="graphrag-0.50"):
         self.ragtest_path = Path(ragtest_path)
+        self.conda_env = conda_env
         self.questions = []
         
     def generate_deep_questions(self):
@@ -319,34 +330,135 @@ class PromptWritingQueryGenerator:
         self.questions = questions_data
         return questions_data
     
-    def execute_queries(self, max_queries=5):
-        """执行GraphRAG查询（演示模式，仅显示前5个）"""
-        print(f"\n🔍 执行GraphRAG查询（演示前{max_queries}个问题）...")
+    def build_query_command(self, q_data):
+        """构建单个查询的命令（参数列表，不经过shell）"""
+        conda = os.environ.get("CONDA_EXE") or shutil.which("conda") or "conda"
+        return [
+            conda, "run", "-n", self.conda_env, "--no-capture-output",
+            "graphrag", "query",
+            "--root", str(self.ragtest_path),
+            "--method", q_data["method"],
+            "--query", q_data["question"],
+        ]
+    
+    def run_query(self, q_data, timeout=None, session=None):
+        """执行单个查询，记录输出、错误和耗时；session用于中断时结束同一批的查询进程"""
+        command = self.build_query_command(q_data)
+        result = {
+            "question": q_data["question"],
+            "method": q_data["method"],
+            "category": q_data["category"],
+            "command": subprocess.list2cmdline(command),
+            "started_at": datetime.now().isoformat(timespec="seconds"),
+        }
+        start = time.perf_counter()
+        try:
+            # 超时时结束整个进程树，conda run启动的graphrag子进程不会留在后台继续占用模型
+            with GraphRAGQueryProcess(command, timeout, session, merge_stderr=False) as process:
+                stdout = "".join(process.iter_lines())
+            if process.timed_out:
+                result.update(status="超时", returncode=None, stdout=stdout, stderr=process.stderr)
+            else:
+                result.update(
+                    status="成功" if process.returncode == 0 else "失败",
+                    returncode=process.returncode,
+                    stdout=stdout,
+                    stderr=process.stderr,
+                )
+        except OSError as e:
+            result.update(status="无法启动", returncode=None, stdout="", stderr=str(e))
+        result["elapsed_seconds"] = round(time.perf_counter() - start, 3)
+        return result
+    
+    def _write_results(self, filename, results, total, started_at, finished=False):
+        """写入汇总结果文件（先写临时文件再替换，中途中断也能保留已完成的结果）"""
+        ordered = sorted(results, key=lambda item: item["index"])
+        summary = {
+            "ragtest_path": str(self.ragtest_path),
+            "started_at": started_at,
+            "finished_at": datetime.now().isoformat(timespec="seconds") if finished else None,
+            "total": total,
+            "completed": len(ordered),
+            "succeeded": sum(1 for item in ordered if item["status"] == "成功"),
+            "total_query_seconds": round(sum(item["elapsed_seconds"] for item in ordered), 3),
+        }
+        temp_filename = f"{filename}.tmp"
+        with open(temp_filename, 'w', encoding='utf-8') as f:
+            json.dump({"summary": summary, "results": ordered}, f, ensure_ascii=False, indent=2)
+        os.replace(temp_filename, filename)
+    
+    def execute_queries(self, max_queries=None, max_workers=2, timeout=3600, output_file=None, dry_run=False):
+        """执行生成的GraphRAG查询
         
-        results = []
+        Args:
+            max_queries (int): 最多执行的问题数，None表示全部
+            max_workers (int): 同时运行的查询数
+            timeout (float): 单个查询的超时时间（秒）
+            output_file (str): 汇总结果文件，默认 graphrag_query_results_<时间>.json
+            dry_run (bool): 只显示命令，不实际执行
+        """
+        questions = self.questions[:max_queries] if max_queries else list(self.questions)
+        
+        if dry_run:
+            print(f"\n🔍 GraphRAG查询命令（演示前{len(questions)}个问题，未执行）...")
+            results = []
+            for i, q_data in enumerate(questions):
+                command = subprocess.list2cmdline(self.build_query_command(q_data))
+                print(f"\n问题 {i+1}: {q_data['question']}")
+                print(f"查询方法: {q_data['method']}")
+                print(f"类别: {q_data['category']}")
+                print(f"执行命令: {command}")
+                print("=" * 80)
+                results.append({
+                    "question": q_data["question"],
+                    "method": q_data["method"],
+                    "category": q_data["category"],
+                    "command": command,
+                    "status": "准备执行"
+                })
+            return results
+        
+        max_workers = max(1, min(max_workers, len(questions) or 1))
+        started_at = datetime.now().isoformat(timespec="seconds")
+        filename = output_file or f"graphrag_query_results_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+        print(f"\n🔍 执行 {len(questions)} 个GraphRAG查询（并发 {max_workers}，单个超时 {timeout}s）...")
         
-        for i, q_data in enumerate(self.questions[:max_queries]):
-            print(f"\n问题 {i+1}: {q_data['question']}")
-            print(f"查询方法: {q_data['method']}")
-            print(f"类别: {q_data['category']}")
-            
-            # 构建查询命令
-            cmd = f'conda activate graphrag-0.50 && graphrag query --root {self.ragtest_path} --method {q_data["method"]} --query "{q_data["question"]}"'
-            
-            print(f"执行命令: {cmd}")
-            print("=" * 80)
-            
-            # 实际项目中可以执行查询
-            # 这里为了演示，我们跳过实际执行
-            results.append({
-                "question": q_data["question"],
-                "method": q_data["method"],
-                "category": q_data["category"],
-                "command": cmd,
-                "status": "准备执行"
-            })
-        
-        return results
+        results = []
+        lock = threading.Lock()
+        batch_start = time.perf_counter()
+        session = f"batch-{os.getpid()}-{id(results)}"
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        futures = {executor.submit(self.run_query, q_data, timeout, session): index for index, q_data in enumerate(questions, 1)}
+        try:
+            for future in as_completed(futures):
+                result = future.result()
+                result["index"] = futures[future]
+                with lock:
+                    results.append(result)
+                    self._write_results(filename, results, len(questions), started_at)
+                icon = "✅" if result["status"] == "成功" else "❌"
+                print(f"{icon} [{len(results)}/{len(questions)}] 问题 {result['index']} ({result['method']}) "
+                      f"{result['status']}，用时 {result['elapsed_seconds']:.1f}s")
+        except KeyboardInterrupt:
+            # 查询进程自成进程组，收不到Ctrl-C：取消尚未开始的查询，结束正在运行的查询进程树，
+            # 不必等每个查询跑到超时
+            executor.shutdown(wait=False, cancel_futures=True)
+            running = [future for future in futures if not future.done()]
+            print(f"\n⚠️ 已中断，正在结束 {len(running)} 个运行中的查询...")
+            while running:
+                GraphRAGQueryProcess.kill_session(session)
+                _, running = wait(running, timeout=1)
+            with lock:
+                self._write_results(filename, results, len(questions), started_at)
+            print(f"📁 已完成的 {len(results)}/{len(questions)} 个结果已保存到 {filename}")
+            raise
+        executor.shutdown()
+        
+        self._write_results(filename, results, len(questions), started_at, finished=True)
+        succeeded = sum(1 for item in results if item["status"] == "成功")
+        print(f"\n✅ 查询完成: {succeeded}/{len(questions)} 成功，总用时 {time.perf_counter() - batch_start:.1f}s")
+        print(f"📁 结果已保存到 {filename}")
+        return sorted(results, key=lambda item: item["index"])
     
     def save_questions_to_file(self):
         """保存问题到文件"""
@@ -379,14 +491,50 @@ class PromptWritingQueryGenerator:
         print(f"✅ 问题集已保存到 {filename}")
         return filename
 
+def parse_args():
+    """命令行参数"""
+    parser = argparse.ArgumentParser(description="GraphRAG 提示词写作图书可视化与深度查询系统")
+    parser.add_argument("--run-queries", action="store_true",
+                        help="跳过可视化，直接批量执行全部生成的问题并写入汇总结果文件")
+    parser.add_argument("--ragtest", default="C:/Users/13694/ragtest", help="GraphRAG项目目录")
+    parser.add_argument("--conda-env", default="graphrag-0.50", help="GraphRAG所在的conda环境")
+    parser.add_argument("--workers", type=int, default=2, help="同时运行的查询数")
+    parser.add_argument("--timeout", type=float, default=3600, help="单个查询的超时时间（秒）")
+    parser.add_argument("--max-queries", type=int, default=None, help="最多执行的问题数，默认全部")
+    parser.add_argument("--output", default=None, help="汇总结果文件，默认 graphrag_query_results_<时间>.json")
+    return parser.parse_args()
+
+def run_batch_queries(args):
+    """批量执行全部问题（适合定期无人值守运行）"""
+    print("🚀 GraphRAG 深度查询批量执行")
+    print("=" * 60)
+    
+    query_generator = PromptWritingQueryGenerator(args.ragtest, conda_env=args.conda_env)
+    query_generator.generate_deep_questions()
+    try:
+        results = query_generator.execute_queries(
+            max_queries=args.max_queries,
+            max_workers=args.workers,
+            timeout=args.timeout,
+            output_file=args.output
+        )
+    except KeyboardInterrupt:
+        return 130
+    # 有查询失败时返回非零退出码，便于计划任务发现问题
+    return 0 if all(item["status"] == "成功" for item in results) else 1
+
 def main():
     """主函数"""
+    args = parse_args()
+    if args.run_queries:
+        sys.exit(run_batch_queries(args))
+    
     print("🚀 GraphRAG 提示词写作图书可视化与深度查询系统")
     print("=" * 60)
     
     # 设置路径
     artifacts_path = "C:/Users/13694/ragtest/output/20250602-151653/artifacts"
-    ragtest_path = "C:/Users/13694/ragtest"
+    ragtest_path = args.ragtest
     
     # 初始化可视化器
     visualizer = GraphRAGVisualizer(artifacts_path)
@@ -403,7 +551,7 @@ def main():
     
     # 3. 生成深度查询问题
     print("\n🤔 第三步：生成提示词写作深度查询问题")
-    query_generator = PromptWritingQueryGenerator(ragtest_path)
+    query_generator = PromptWritingQueryGenerator(ragtest_path, conda_env=args.conda_env)
     questions = query_generator.generate_deep_questions()
     
     # 4. 显示问题概览
@@ -415,9 +563,9 @@ def main():
     # 5. 保存问题到文件
     query_generator.save_questions_to_file()
     
-    # 6. 演示查询执行
+    # 6. 演示查询执行（只显示命令，批量执行请使用 --run-queries）
     print("\n🔍 第四步：演示查询执行")
-    query_generator.execute_queries(max_queries=3)
+    query_generator.execute_queries(max_queries=3, dry_run=True)
     
     print("\n✅ 程序执行完成！")
     print("📁 生成的文件:")
@@ -427,7 +575,7 @@ def main():
     
     print("\n💡 使用建议:")
     print("  1. 查看生成的可视化图表了解图书结构")
-    print("  2. 使用问题集中的命令执行GraphRAG查询")
+    print("  2. 使用问题集中的命令执行GraphRAG查询，或运行 --run-queries 批量执行全部问题")
     print("  3. 根据查询结果调整和优化问题")
 
 if __name__ == "__main__":